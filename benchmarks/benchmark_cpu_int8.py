@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   benchmark_cpu_int8.py
+'''
+
+# Encoding throughput (sequences/sec) of a BERT-like encoder on CPU, fp32 vs dynamic int8 (sat.quantization.prepare_cpu_inference).
+# The weights are random, the outputs are compared by the cosine similarity of the [CLS] embeddings.
+# Usage: PYTHONPATH=. python benchmarks/benchmark_cpu_int8.py [--num-layers 12 --hidden-size 768] [--threads 4]
+
+# here put the import lib
+import os
+import copy
+import time
+import argparse
+import torch
+
+from sat import mpu
+from sat.model.official import BertModel
+from sat.quantization import prepare_cpu_inference, cpu_forward
+
+
+def init_cpu():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29512')
+    if not torch.distributed.is_initialized():
+        torch.distributed.init_process_group('gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+
+
+def throughput(model, inputs, batch_size, repeats=3):
+    '''the best sequences/sec over `repeats` passes on inputs.'''
+    cpu_forward(model, **inputs)
+    best = 0.
+    for _ in range(repeats):
+        start = time.perf_counter()
+        cpu_forward(model, **inputs)
+        best = max(best, batch_size / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-layers', type=int, default=12)
+    parser.add_argument('--hidden-size', type=int, default=768)
+    parser.add_argument('--num-attention-heads', type=int, default=12)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--seq-length', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None)
+    cmd_args = parser.parse_args()
+    init_cpu()
+
+    args = BertModel.get_args(num_layers=cmd_args.num_layers, vocab_size=30522, hidden_size=cmd_args.hidden_size,
+        num_attention_heads=cmd_args.num_attention_heads, max_sequence_length=512, num_types=2)
+    fp32 = prepare_cpu_inference(BertModel(args), num_threads=cmd_args.threads, quantize=False)
+    int8 = prepare_cpu_inference(copy.deepcopy(fp32))
+
+    b, l = cmd_args.batch_size, cmd_args.seq_length
+    inputs = {
+        'input_ids': torch.randint(30522, (b, l)),
+        'position_ids': torch.arange(l).expand(b, -1),
+        'attention_mask': torch.ones(b, 1, 1, l),
+        'token_type_ids': torch.zeros(b, l, dtype=torch.long),
+    }
+    print(f'{cmd_args.num_layers} layers, hidden {cmd_args.hidden_size}, batch {b} x {l} tokens, {torch.get_num_threads()} threads')
+    results = {}
+    for name, model in (('fp32', fp32), ('int8', int8)):
+        results[name] = throughput(model, inputs, b)
+        print(f'{name}: {results[name]:.1f} sequences/sec')
+    print(f'speedup: {results["int8"] / results["fp32"]:.2f}x')
+
+    # the lm head is skipped, compare the final hidden states of [CLS]
+    for model in (fp32, int8):
+        model.del_mixin('bert-final')
+    cls = [cpu_forward(model, **inputs)[0][:, 0] for model in (fp32, int8)]
+    print(f'[CLS] cosine similarity int8 vs fp32: {torch.cosine_similarity(*cls, dim=-1).min().item():.4f} (min over batch)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   benchmark_hook_dispatch.py
+'''
+
+# Per-step overhead of BaseModel.forward on a tiny CPU model, where the python dispatch dominates the math.
+# `before` reproduces the dispatch without the HookPlan: the hooks are refilled and resolved every forward,
+# and a torch.tensor(i) is allocated per layer. `after` is the current BaseModel.forward.
+# Usage: PYTHONPATH=. python benchmarks/benchmark_hook_dispatch.py [--num-layers 12] [--steps 500]
+
+# here put the import lib
+import os
+import time
+import cProfile
+import pstats
+import argparse
+import torch
+
+from sat import mpu
+from sat.model import CachedAutoregressiveModel
+
+
+def init_cpu():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29511')
+    if not torch.distributed.is_initialized():
+        torch.distributed.init_process_group('gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+
+
+def timeit(fn, steps, warmup=20, repeats=5):
+    '''the best mean time per call over `repeats` runs of `steps` calls, robust to a noisy machine.'''
+    for _ in range(warmup):
+        fn()
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(steps):
+            fn()
+        best = min(best, (time.perf_counter() - start) / steps)
+    return best
+
+
+def legacy_forward(model, *args, **kw_args):
+    '''BaseModel.forward before the HookPlan, on the same transformer.'''
+    transformer = model.transformer
+    transformer.hooks.clear()
+    transformer.hooks.update(model.hooks)
+    transformer.hook_plan = None # resolved per forward
+    transformer._layer_ids = [] # fresh layer_id tensors per forward
+    return transformer(*args, **kw_args)
+
+
+def compare(before, after, steps, rounds=5):
+    '''interleave the two, so that the drift of a shared machine affects both alike.'''
+    best_before = best_after = float('inf')
+    for _ in range(rounds):
+        best_before = min(best_before, timeit(before, steps, repeats=1))
+        best_after = min(best_after, timeit(after, steps, repeats=1))
+    return best_before, best_after
+
+
+def count_calls(fn):
+    '''number of python-level function calls of one call of fn, deterministic unlike the timings.'''
+    profiler = cProfile.Profile()
+    profiler.runcall(fn)
+    return pstats.Stats(profiler).total_calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-layers', type=int, default=12)
+    parser.add_argument('--hidden-size', type=int, default=32)
+    parser.add_argument('--memory-length', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=200)
+    cmd_args = parser.parse_args()
+    init_cpu()
+    torch.set_num_threads(1)
+
+    args = CachedAutoregressiveModel.get_args(num_layers=cmd_args.num_layers, vocab_size=100,
+        hidden_size=cmd_args.hidden_size, num_attention_heads=4, max_sequence_length=256,
+        hidden_dropout=0., attention_dropout=0.)
+    model = CachedAutoregressiveModel(args).eval()
+    print('attention_fn:', model.hook_origins.get('attention_fn'))
+
+    tokens = torch.tensor([[5]])
+    position_ids = torch.tensor([[cmd_args.memory_length]])
+    mask = torch.ones(1, 1, 1, cmd_args.memory_length + 1)
+    mems = torch.zeros(cmd_args.num_layers, 1, cmd_args.memory_length, 2 * cmd_args.hidden_size)
+    decode_inputs = (tokens, position_ids, mask)
+    prefill_inputs = (tokens.expand(1, 16), torch.arange(16)[None], torch.ones(1, 1, 16, 16).tril_())
+    print(f'{cmd_args.num_layers} layers, hidden {cmd_args.hidden_size}')
+    with torch.no_grad():
+        assert torch.equal(legacy_forward(model, *decode_inputs, mems=mems)[0], model(*decode_inputs, mems=mems)[0])
+        for name, inputs, kw_args in [(f'decode step (1 token, {cmd_args.memory_length} mems)', decode_inputs, {'mems': mems}),
+                                      ('prefill (16 tokens)', prefill_inputs, {})]:
+            before, after = compare(lambda: legacy_forward(model, *inputs, **kw_args), lambda: model(*inputs, **kw_args), cmd_args.steps)
+            calls_before = count_calls(lambda: legacy_forward(model, *inputs, **kw_args))
+            calls_after = count_calls(lambda: model(*inputs, **kw_args))
+            print(f'{name}: before {before * 1e6:.1f} us ({calls_before} python calls), '
+                  f'after {after * 1e6:.1f} us ({calls_after} python calls), {1 - after / before:+.1%}')
+
+
+if __name__ == '__main__':
+    main()
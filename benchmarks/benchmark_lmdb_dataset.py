@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   benchmark_lmdb_dataset.py
+'''
+
+# Read throughput (rows/sec) of LMDBDataset on a synthetic local lmdb of int32 token rows:
+# the previous transaction-per-row reads vs the persistent transaction, batched __getitems__, and the serializations.
+# Usage: PYTHONPATH=. python benchmarks/benchmark_lmdb_dataset.py [--num-rows 100000 --row-length 512 --batch-size 64]
+
+# here put the import lib
+import os
+import time
+import pickle
+import tempfile
+import argparse
+import numpy as np
+
+from sat.data_utils import LMDBDataset
+from sat.data_utils.datasets import write_lmdb_dataset
+
+
+def legacy_getitem(env, idx):
+    '''LMDBDataset.__getitem__ before the persistent transaction.'''
+    with env.begin(write=False) as txn:
+        return pickle.loads(txn.get(str(idx).encode('utf-8')))
+
+
+def throughput(fn, num_rows, repeats=3):
+    '''the best rows/sec over `repeats` runs.'''
+    best = 0.
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = max(best, num_rows / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-rows', type=int, default=100000)
+    parser.add_argument('--row-length', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-reads', type=int, default=20000)
+    cmd_args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    indices = rng.integers(cmd_args.num_rows, size=cmd_args.num_reads).tolist()
+    batches = [indices[i:i + cmd_args.batch_size] for i in range(0, len(indices), cmd_args.batch_size)]
+    rows = lambda: (rng.integers(65536, size=cmd_args.row_length, dtype=np.int32) for _ in range(cmd_args.num_rows))
+
+    with tempfile.TemporaryDirectory() as root:
+        results = {}
+        for serialization in ('pickle', 'msgpack', 'numpy'):
+            path = os.path.join(root, serialization)
+            data = rows() if serialization != 'msgpack' else (row.tolist() for row in rows())
+            write_lmdb_dataset(path, data, serialization, dtype=np.int32)
+            dataset = LMDBDataset(path, process_fn=np.asarray, serialization=serialization, dtype=np.int32)
+            if serialization == 'pickle':
+                env = dataset._open()
+                results['pickle, txn per row (before)'] = throughput(lambda: [legacy_getitem(env, i) for i in indices], len(indices))
+                env.close()
+            results[f'{serialization}, __getitem__'] = throughput(lambda: [dataset[i] for i in indices], len(indices))
+            results[f'{serialization}, __getitems__ (batch {cmd_args.batch_size})'] = throughput(
+                lambda: [dataset.__getitems__(b) for b in batches], len(indices))
+    base = results['pickle, txn per row (before)']
+    print(f'{cmd_args.num_rows} rows of {cmd_args.row_length} int32 tokens')
+    for name, rows_per_sec in results.items():
+        print(f'{name}: {rows_per_sec:.0f} rows/sec, {rows_per_sec / base:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   benchmark_random_mapping.py
+'''
+
+# Per-index cost of RandomMappingDataset, the previous RandomState-per-access mapping vs the hash mapping.
+# Usage: PYTHONPATH=. python benchmarks/benchmark_random_mapping.py [--num-indices 20000] [--batch-size 256]
+
+# here put the import lib
+import time
+import random
+import argparse
+import numpy as np
+
+from sat.data_utils.configure_data import RandomMappingDataset
+
+
+def legacy_map_index(index, length):
+    '''the mapping of RandomMappingDataset before the hash.'''
+    rng = random.Random(index)
+    rng = np.random.RandomState(seed=[rng.randint(0, 2**32-1) for _ in range(16)])
+    return rng.randint(length)
+
+
+def timeit(fn, num_indices, repeats=3):
+    '''the best time per index over `repeats` runs.'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, (time.perf_counter() - start) / num_indices)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-indices', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--dataset-size', type=int, default=1000000)
+    cmd_args = parser.parse_args()
+    n, b = cmd_args.num_indices, cmd_args.batch_size
+
+    ds = RandomMappingDataset(range(cmd_args.dataset_size), scale=200)
+    indices = np.random.default_rng(0).integers(len(ds), size=n)
+    results = {
+        'legacy __getitem__': timeit(lambda: [legacy_map_index(int(i), cmd_args.dataset_size) for i in indices], n),
+        'hash __getitem__': timeit(lambda: [ds[int(i)] for i in indices], n),
+        f'hash __getitems__ (batch {b})': timeit(lambda: [ds.__getitems__(indices[i:i+b]) for i in range(0, n, b)], n),
+    }
+    for name, t in results.items():
+        print(f'{name}: {t * 1e6:.2f} us/index, {results["legacy __getitem__"] / t:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
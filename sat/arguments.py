@@ -226,6 +226,11 @@ def add_data_args(parser):
                        help="""Number of workers to use for dataloading""")
     # Sometimes, num-workders > 1 and cpu_offload (zero-stage 2) will make the validation dataloader hang.
     # I have no idea on the reason, and just set the default num-workers to 1.
+    group.add_argument('--max-tokens', type=int, default=None,
+                       help='token budget of a batch on a single GPU (padding included). If set, batches are formed by length '
+                       'from the length index `dataset.lengths` (see TokenBudgetBatchSampler) instead of --batch-size samples.')
+    group.add_argument('--prefetch-batches', type=int, default=0,
+                       help='copy the next N batches to the GPU on a side stream ahead of their use (DevicePrefetcher), 0 to disable.')
     group.add_argument('--block-size', type=int, default=10000,
                        help="""Size of block to reduce memory in dataset, ignore it for most users.""")
 
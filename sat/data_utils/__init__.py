@@ -10,4 +10,7 @@
 
 from .configure_data import make_loaders
 from .datasets import *
-from .hf_dataset import load_hf_dataset
\ No newline at end of file
+from .hf_dataset import load_hf_dataset
+from .packing import PackingCollator, packing_efficiency
+from .indexed_dataset import IndexedDataset, IndexedDatasetBuilder, FixedWindowDataset
+from .prefetcher import DevicePrefetcher
@@ -19,13 +19,22 @@ from bisect import bisect_right
 from functools import partial
 
 from torch.utils import data
-from .samplers import DistributedBatchSampler
+from .samplers import DistributedBatchSampler, TokenBudgetBatchSampler
+from .prefetcher import DevicePrefetcher
 from torch.utils.data import ChainDataset, IterableDataset
 
 from sat import mpu
     
 
 def make_data_loader(dataset, batch_size, args, split, collate_fn=None):
+    '''a DataLoader, wrapped by a DevicePrefetcher if args.prefetch_batches > 0.'''
+    data_loader = _make_data_loader(dataset, batch_size, args, split, collate_fn)
+    if getattr(args, 'prefetch_batches', 0):
+        data_loader = DevicePrefetcher(data_loader, args.prefetch_batches)
+    return data_loader
+
+
+def _make_data_loader(dataset, batch_size, args, split, collate_fn=None):
 
     world_size = torch.distributed.get_world_size(
         group=mpu.get_data_parallel_group())
@@ -48,6 +57,9 @@ def make_data_loader(dataset, batch_size, args, split, collate_fn=None):
             collate_fn=collate_fn
             )
 
+    if getattr(args, 'max_tokens', None) is not None:
+        return make_token_budget_data_loader(dataset, args, split, collate_fn, rank, world_size)
+
     sampler = torch.utils.data.SequentialSampler(dataset)
     # drop_last = distributed
     drop_last = False # TODO will always drop last to keep the consistency.
@@ -93,6 +105,34 @@ def make_data_loader(dataset, batch_size, args, split, collate_fn=None):
     return data_loader
 
 
+def make_token_budget_data_loader(dataset, args, split, collate_fn, rank, world_size):
+    """data loader of batches under the token budget args.max_tokens, by the length index `dataset.lengths`."""
+    lengths = getattr(dataset, 'lengths', None)
+    if lengths is None:
+        raise ValueError('--max-tokens needs a length index: the dataset should have `lengths`, the number of tokens of each sample.')
+    gradient_accumulation_steps = getattr(args, 'gradient_accumulation_steps', 1) or 1
+    if split == 'train':
+        num_steps = None if args.train_iters is None else args.train_iters * gradient_accumulation_steps
+        num_epochs = args.epochs
+    else:
+        num_steps = None if args.strict_eval else (1 + args.train_iters // (args.eval_interval or args.train_iters)) * args.eval_iters
+        num_epochs = 1
+    batch_sampler = TokenBudgetBatchSampler(lengths, args.max_tokens, rank=rank, world_size=world_size,
+                                            shuffle=split == 'train', seed=args.seed, num_epochs=num_epochs or 1,
+                                            gradient_accumulation_steps=gradient_accumulation_steps)
+    if num_steps is not None: # enough epochs to cover the iterations, each runs num_steps(0) steps
+        batch_sampler.num_epochs = max(1, -(-num_steps // max(1, batch_sampler.num_steps(0))))
+    if split in ('val', 'test'):
+        last_shape, drop_number = batch_sampler.last_shape()
+        setattr(args, f'{split}_last_shape', last_shape)
+        setattr(args, f'{split}_drop_number', drop_number)
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_sampler=batch_sampler,
+                                       num_workers=args.num_workers,
+                                       pin_memory=True,
+                                       collate_fn=collate_fn)
+
+
 def make_dataset_full(path, split, args, create_dataset_function, 
         dataset_weights=None, random_mapping=True, is_train_data=False, **kwargs):
     """function to create datasets+tokenizers for common options"""
@@ -193,18 +233,20 @@ def make_loaders(args, create_dataset_function, collate_fn=None):
     valid = None
     test = None
 
+    # --max-tokens batches by the length index of the datasets, and shuffles by itself, without random mapping.
+    random_mapping = getattr(args, 'max_tokens', None) is None
     if args.train_data is not None:
-        train = make_dataset(**data_set_args, args=args, dataset_weights=args.train_data_weights, is_train_data=True)
+        train = make_dataset(**data_set_args, args=args, dataset_weights=args.train_data_weights, is_train_data=True, random_mapping=random_mapping)
         if should_split(split):
             train, valid, test = train
 
     # make training and val dataset if necessary
     if valid is None and args.valid_data is not None:
         eval_set_args['path'] = args.valid_data
-        valid = make_dataset(**eval_set_args, args=args, random_mapping=not args.strict_eval)
+        valid = make_dataset(**eval_set_args, args=args, random_mapping=random_mapping and not args.strict_eval)
     if test is None and args.test_data is not None:
         eval_set_args['path'] = args.test_data
-        test = make_dataset(**eval_set_args, args=args, random_mapping=not args.strict_eval)
+        test = make_dataset(**eval_set_args, args=args, random_mapping=random_mapping and not args.strict_eval)
 
     # wrap datasets with data loader
     if train is not None and args.batch_size > 0:
@@ -328,6 +370,13 @@ class ConcatDataset(data.Dataset):
     def __len__(self):
         return self.cumulative_sizes[-1]
 
+    @property
+    def lengths(self):
+        '''the length index, if all the datasets have one.'''
+        if not all(getattr(d, 'lengths', None) is not None for d in self.datasets):
+            return None
+        return np.concatenate([np.resize(np.asarray(d.lengths), int(len(d) * w)) for d, w in zip(self.datasets, self.weights)])
+
     def __getitem__(self, idx):
         dataset_idx = bisect_right(self.cumulative_sizes, idx)
         if dataset_idx == 0:
@@ -337,23 +386,54 @@ class ConcatDataset(data.Dataset):
         sample_idx = sample_idx % len(self.datasets[dataset_idx])
         return self.datasets[dataset_idx][sample_idx]
 
+_MASK64 = (1 << 64) - 1
+
+def hash_index(index, seed=0):
+    '''splitmix64 of (index, seed), a stateless pseudo-random 64-bit hash.
+        index: int, or array-like (vectorized in numpy uint64, with the same results).
+    '''
+    if isinstance(index, (int, np.integer)):
+        z = (int(index) + (seed + 1) * 0x9E3779B97F4A7C15) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+    z = np.asarray(index).astype(np.uint64)
+    with np.errstate(over='ignore'): # wrapping around is intended
+        z = z + np.uint64(((seed + 1) * 0x9E3779B97F4A7C15) & _MASK64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
 class RandomMappingDataset(data.Dataset):
     '''
     Dataset wrapper to randomly mapping indices to original order.
     Will also enlarge the length
+    The mapping is a stateless hash of (index, seed), reproducible across restarts and workers,
+    and vectorized for batches of indices by __getitems__.
     '''
-    def __init__(self, ds, scale=200, **kwargs):
+    def __init__(self, ds, scale=200, seed=0, **kwargs):
         self.wrapped_data = ds
         self.scale = scale
+        self.seed = seed
 
     def __len__(self):
         return len(self.wrapped_data) * self.scale
 
+    def map_index(self, index):
+        '''index (int or array-like) -> index of the wrapped dataset.'''
+        if isinstance(index, (int, np.integer)):
+            return hash_index(index, self.seed) % len(self.wrapped_data)
+        return (hash_index(index, self.seed) % np.uint64(len(self.wrapped_data))).astype(np.int64)
+
     def __getitem__(self, index):
-        rng = random.Random(index)
-        rng = np.random.RandomState(seed=[rng.randint(0, 2**32-1) for _ in range(16)])
-        index = rng.randint(len(self.wrapped_data))
-        return self.wrapped_data[index]
+        return self.wrapped_data[self.map_index(index)]
+
+    def __getitems__(self, indices):
+        # called by the DataLoader (torch>=2.0) with the indices of a whole batch
+        indices = self.map_index(indices).tolist()
+        if hasattr(self.wrapped_data, '__getitems__'):
+            return self.wrapped_data.__getitems__(indices)
+        return [self.wrapped_data[i] for i in indices]
 
 class RandomDataset(data.Dataset):
     '''
@@ -391,5 +471,12 @@ class BlockedRandomSplitDataset(data.Dataset):
     def __len__(self):
         return self.len
 
+    @property
+    def lengths(self):
+        if getattr(self.wrapped_data, 'lengths', None) is None:
+            return None
+        index = np.arange(self.len)
+        return np.asarray(self.wrapped_data.lengths)[(index // len(self.indices)) * self.block_size + self.indices[index % len(self.indices)]]
+
     def __getitem__(self, index):
         return self.wrapped_data[(index // len(self.indices)) * self.block_size + self.indices[index % len(self.indices)]]
@@ -19,33 +19,104 @@ import pickle
 import torch
 from torch.utils.data import Dataset
 
+def _lmdb_serializer(serialization, dtype=None):
+    '''(dumps, loads) of the rows of an LMDBDataset, serialization in pickle, msgpack, numpy (raw bytes of a 1D array of dtype), raw.'''
+    if serialization == 'pickle':
+        return pickle.dumps, pickle.loads
+    if serialization == 'msgpack':
+        import msgpack
+        return partial(msgpack.packb, use_bin_type=True), partial(msgpack.unpackb, raw=False)
+    if serialization == 'numpy':
+        if dtype is None: # np.frombuffer would silently decode as float64
+            raise ValueError('serialization numpy needs the dtype of the arrays.')
+        return (lambda row: np.ascontiguousarray(row, dtype=dtype).tobytes()), partial(np.frombuffer, dtype=dtype)
+    if serialization == 'raw':
+        return bytes, bytes
+    raise ValueError(f'unknown serialization {serialization}.')
+
+def write_lmdb_dataset(path, rows, serialization='pickle', dtype=None, map_size=1<<40):
+    '''write rows (an iterable) as an LMDBDataset, under keys str(index) and the total under 'length'.'''
+    import lmdb
+    dumps, _ = _lmdb_serializer(serialization, dtype)
+    env = lmdb.open(path, map_size=map_size, subdir=True)
+    length = 0
+    txn = env.begin(write=True)
+    for length, row in enumerate(rows, 1):
+        txn.put(str(length - 1).encode('utf-8'), dumps(row))
+        if length % 10000 == 0:
+            txn.commit()
+            txn = env.begin(write=True)
+    txn.put('length'.encode('utf-8'), str(length).encode('utf-8'))
+    txn.commit()
+    env.close()
+
 class LMDBDataset(Dataset):
-    def __init__(self, path, process_fn):
+    '''rows of an lmdb under keys str(index), deserialized and passed to process_fn.
+        The env is opened lazily in each process (each data loader worker, after fork), with a read transaction
+        kept for its lifetime, and __getitems__ reads a batch by a cursor over the sorted keys.
+        serialization: pickle (default), msgpack, numpy (raw bytes of 1D arrays of dtype), or raw bytes,
+            see write_lmdb_dataset.
+    '''
+    def __init__(self, path, process_fn, serialization='pickle', dtype=None):
+        self.path = path
+        self.process_fn = process_fn
+        self.serialization = serialization
+        self.dtype = dtype
+        self._loads = _lmdb_serializer(serialization, dtype)[1]
+        self._env = self._txn = self._cursor = None
+        self._pid = None
+        # only read the length in the main process, the env must not be shared by the forked workers.
+        env = self._open()
+        with env.begin(write=False) as txn:
+            self.length = int(txn.get('length'.encode('utf-8')).decode('utf-8'))
+        env.close()
+
+    def _open(self):
         import lmdb
-        self.env = lmdb.open(
-            path,
+        env = lmdb.open(
+            self.path,
             max_readers=32,
             readonly=True,
             lock=False,
             readahead=False,
             meminit=False,
         )
-        self.process_fn = process_fn
-        if not self.env:
-            raise IOError('Cannot open lmdb dataset', path)
+        if not env:
+            raise IOError('Cannot open lmdb dataset', self.path)
+        return env
 
-        with self.env.begin(write=False) as txn:
-            self.length = int(txn.get('length'.encode('utf-8')).decode('utf-8'))
+    def _begin(self):
+        if self._pid != os.getpid(): # first access in this process
+            if self._env is not None: # inherited by fork from a process which had read, only usable there
+                self._env.close()
+            self._env = self._open()
+            self._txn = self._env.begin(write=False)
+            self._cursor = self._txn.cursor()
+            self._pid = os.getpid()
+        return self._txn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_env=None, _txn=None, _cursor=None, _pid=None, _loads=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._loads = _lmdb_serializer(self.serialization, self.dtype)[1]
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, idx):
+        row = self._loads(self._begin().get(str(idx).encode('utf-8')))
+        return self.process_fn(row)
 
-        with self.env.begin(write=False) as txn:
-            key = str(idx).encode('utf-8')
-            row = pickle.loads(txn.get(key))
-            return self.process_fn(row)
+    def __getitems__(self, indices):
+        # called by the DataLoader (torch>=2.0) with the indices of a whole batch
+        self._begin()
+        keys = [str(idx).encode('utf-8') for idx in indices]
+        values = dict(self._cursor.getmulti(sorted(set(keys)))) # sorted, the cursor moves forward
+        return [self.process_fn(self._loads(values[key])) for key in keys]
 
 class BinaryDataset(Dataset):
     def __init__(self, path, process_fn, length_per_sample=64+1024+4096, dtype='int32', preload=False, **kwargs): # TODO ARGS
@@ -83,6 +154,97 @@ class TSVDataset(Dataset):
     def __getitem__(self, index):
         return self.process_fn(self.items[index])
 
+def _newline_offsets(path, start, end):
+    '''byte offsets of the line starts in (start, end], i.e. after each b'\n' in [start, end) of the file.'''
+    import mmap
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunk = np.frombuffer(mm, dtype=np.uint8, count=end - start, offset=start)
+        offsets = np.flatnonzero(chunk == ord('\n')) + (start + 1)
+        del chunk # release the buffer before closing the mmap
+    return offsets
+
+def build_line_offsets(path, num_workers=None, chunk_size=1<<26):
+    '''byte offsets of the lines of a file, [num_lines + 1] int64, the last one is the file size.
+        The file is scanned in chunks of chunk_size bytes, by num_workers threads (numpy releases the GIL).
+    '''
+    size = os.path.getsize(path)
+    bounds = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+    if num_workers is None:
+        num_workers = min(len(bounds), os.cpu_count() or 1)
+    if num_workers > 1 and len(bounds) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(num_workers) as pool:
+            chunks = list(pool.map(lambda bound: _newline_offsets(path, *bound), bounds))
+    else:
+        chunks = [_newline_offsets(path, start, end) for start, end in bounds]
+    offsets = np.concatenate([np.zeros(1, dtype=np.int64)] + chunks).astype(np.int64)
+    if offsets[-1] != size: # the last line has no newline
+        offsets = np.append(offsets, size)
+    return offsets
+
+class MMapTSVDataset(Dataset):
+    '''TSVDataset without loading the file: the byte offsets of the lines are built once (in parallel)
+        and cached as `index_path` (default path + '.offsets.npy'), the file is memory-mapped,
+        and a line is only decoded and split on __getitem__. process_fn gets the same fields as TSVDataset,
+        i.e. line.split('\t') of the line with its newline.
+    '''
+    def __init__(self, path, process_fn, with_heads=True, index_path=None, num_workers=None, **kwargs):
+        self.path = path
+        self.process_fn = process_fn
+        self.offsets = self._load_offsets(path, index_path or path + '.offsets.npy', num_workers)
+        self._mmap = None
+        num_lines = len(self.offsets) - 1
+        # an empty file has no head line, the heads are [''] as TSVDataset
+        self.start_line = 1 if with_heads and num_lines > 0 else 0
+        self.heads = None
+        if with_heads:
+            # read without the mmap, which is only opened in the process reading the samples (e.g. the workers)
+            with open(path, 'rb') as f:
+                head = f.read(int(self.offsets[1]) if num_lines > 0 else 0)
+            self.heads = self._decode(head).split('\t')
+
+    @staticmethod
+    def _load_offsets(path, index_path, num_workers):
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+            offsets = np.load(index_path, mmap_mode='r')
+            if len(offsets) > 0 and offsets[-1] == os.path.getsize(path):
+                return offsets
+        offsets = build_line_offsets(path, num_workers)
+        try:
+            np.save(index_path, offsets)
+        except OSError: # e.g. read-only dataset directory, keep the offsets in memory
+            pass
+        return offsets
+
+    @staticmethod
+    def _decode(raw):
+        line = raw.decode('utf-8')
+        if line.endswith('\r\n'): # universal newlines, as the text mode of TSVDataset
+            line = line[:-2] + '\n'
+        return line
+
+    def _line(self, i):
+        if self._mmap is None: # opened lazily, in each data loader worker
+            import mmap
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._decode(self._mmap[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1 - self.start_line
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'index {index} out of range of {len(self)} lines.')
+        return self.process_fn(self._line(index + self.start_line).split('\t'))
+
 try:
     import webdataset as wds
     from webdataset import ResampledShards, DataPipeline, tarfile_to_samples
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   indexed_dataset.py
+'''
+
+# here put the import lib
+import os
+import struct
+import numpy as np
+from torch.utils.data import Dataset
+
+# <prefix>.bin: the tokens of all the documents, concatenated.
+# <prefix>.idx: _INDEX_MAGIC, version (uint64), dtype code (uint8), number of documents n (uint64),
+#               lengths (int32 [n]), offsets in tokens (int64 [n + 1]).
+_INDEX_MAGIC = b'SATIDX\x00\x00'
+_INDEX_VERSION = 1
+_DTYPES = {1: np.uint8, 2: np.int8, 3: np.int16, 4: np.int32, 5: np.int64, 6: np.uint16, 7: np.uint32}
+_DTYPE_CODES = {np.dtype(v): k for k, v in _DTYPES.items()}
+
+def best_dtype(vocab_size):
+    return np.uint16 if vocab_size is not None and vocab_size < 65536 else np.int32
+
+
+class IndexedDatasetBuilder:
+    '''write documents of tokens into <prefix>.bin / <prefix>.idx.
+        Usage:
+            builder = IndexedDatasetBuilder(prefix, dtype=np.uint16)
+            builder.add_document(tokens)
+            builder.finalize()
+    '''
+    def __init__(self, prefix, dtype=np.int32):
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in _DTYPE_CODES, f'unsupported dtype {self.dtype}.'
+        self.bin = open(prefix + '.bin', 'wb')
+        self.lengths = []
+
+    def add_document(self, tokens):
+        tokens = np.asarray(tokens, dtype=self.dtype)
+        self.bin.write(tokens.tobytes(order='C'))
+        self.lengths.append(len(tokens))
+
+    def finalize(self):
+        self.bin.close()
+        lengths = np.array(self.lengths, dtype=np.int32)
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        with open(self.prefix + '.idx', 'wb') as f:
+            f.write(_INDEX_MAGIC)
+            f.write(struct.pack('<QBQ', _INDEX_VERSION, _DTYPE_CODES[self.dtype], len(lengths)))
+            f.write(lengths.tobytes(order='C'))
+            f.write(offsets.tobytes(order='C'))
+
+
+class IndexedDataset(Dataset):
+    '''documents of a <prefix>.bin / <prefix>.idx written by IndexedDatasetBuilder (or preprocess_indexed).
+        Both files are memory-mapped, a document is a zero-copy slice of the tokens, passed to process_fn.
+        lengths: the number of tokens of each document, e.g. the length index for --max-tokens.
+    '''
+    def __init__(self, prefix, process_fn=None, **kwargs):
+        self.prefix = prefix
+        self.process_fn = process_fn
+        with open(prefix + '.idx', 'rb') as f:
+            magic = f.read(len(_INDEX_MAGIC))
+            if magic != _INDEX_MAGIC:
+                raise ValueError(f'{prefix}.idx is not an index of IndexedDataset.')
+            version, dtype_code, num_docs = struct.unpack('<QBQ', f.read(struct.calcsize('<QBQ')))
+            assert version == _INDEX_VERSION, f'unsupported index version {version}.'
+            header_size = f.tell()
+        self.dtype = np.dtype(_DTYPES[dtype_code])
+        self.lengths = np.memmap(prefix + '.idx', dtype=np.int32, mode='r', offset=header_size, shape=(num_docs,))
+        self.offsets = np.memmap(prefix + '.idx', dtype=np.int64, mode='r', offset=header_size + 4 * num_docs, shape=(num_docs + 1,))
+        num_tokens = int(self.offsets[-1])
+        # np.memmap cannot map an empty file
+        self.tokens = np.memmap(prefix + '.bin', dtype=self.dtype, mode='r') if num_tokens > 0 else np.zeros(0, dtype=self.dtype)
+        assert len(self.tokens) == num_tokens, f'{prefix}.bin has {len(self.tokens)} tokens, the index expects {num_tokens}.'
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def get(self, index, offset=0, length=None):
+        '''tokens [offset, offset + length) of a document.'''
+        start = self.offsets[index] + offset
+        end = self.offsets[index + 1] if length is None else min(start + length, self.offsets[index + 1])
+        return self.tokens[start:end]
+
+    def __getitem__(self, index):
+        tokens = self.get(index)
+        return tokens if self.process_fn is None else self.process_fn(tokens)
+
+
+class FixedWindowDataset(Dataset):
+    '''fixed-length training windows over the concatenated documents of an IndexedDataset, across their boundaries.
+        Window i is the tokens [i * seq_length, i * seq_length + seq_length + 1) (one more for the shifted labels),
+        a zero-copy slice of the .bin, so no sample index is built. The last incomplete window is dropped.
+        process_fn gets the window, and if with_boundaries, also the positions in the window where documents start.
+    '''
+    def __init__(self, indexed_dataset, seq_length, process_fn=None, with_boundaries=False, **kwargs):
+        self.indexed_dataset = indexed_dataset
+        self.seq_length = seq_length
+        self.process_fn = process_fn
+        self.with_boundaries = with_boundaries
+
+    def __len__(self):
+        return max(0, (len(self.indexed_dataset.tokens) - 1) // self.seq_length)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'window {index} out of range.')
+        start = index * self.seq_length
+        window = self.indexed_dataset.tokens[start:start + self.seq_length + 1]
+        if self.process_fn is None:
+            return window
+        if self.with_boundaries:
+            offsets = self.indexed_dataset.offsets
+            first, last = np.searchsorted(offsets, [start, start + len(window)])
+            return self.process_fn(window, offsets[first:last] - start)
+        return self.process_fn(window)
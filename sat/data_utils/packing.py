@@ -0,0 +1,99 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   packing.py
+'''
+
+# here put the import lib
+import torch
+
+
+class PackingCollator:
+    '''collate_fn concatenating variable-length samples into rows of max_length, instead of padding each of them.
+        samples: dicts with 'input_ids' and optionally 'labels' (same length, -100 is ignored, default input_ids),
+            longer samples are truncated. They are packed first-fit by decreasing length, so the number of rows varies.
+        Return a dict of [rows, max_length] tensors:
+            input_ids, position_ids (restarting at 0 in each document), labels (-100 on padding), loss_mask,
+            document_ids (index of the document in the batch, -1 on padding), and either
+            attention_mask: [rows, 1, max_length, max_length] block-diagonal (causal if causal) float mask, or
+            cu_seqlens: [num_segments + 1] int32 boundaries of the documents (and paddings) in the flattened rows,
+                with a dummy full attention_mask, for PackedAttentionMixin.
+        shift_labels: labels[t] is the target of token t, i.e. the next token of the same document,
+            so that the loss needs no shift, and never predicts across documents.
+        efficiency: ratio of the non-padding tokens of the batches collated by this instance
+            (in the main process only with num_workers > 0, use packing_efficiency(batch) instead).
+    '''
+    def __init__(self, max_length, pad_token_id=0, causal=True, use_cu_seqlens=False, shift_labels=True):
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.causal = causal
+        self.use_cu_seqlens = use_cu_seqlens
+        self.shift_labels = shift_labels
+        self.num_tokens = self.num_slots = 0
+
+    @property
+    def efficiency(self):
+        return self.num_tokens / self.num_slots if self.num_slots > 0 else 0.
+
+    def pack(self, lengths):
+        '''first-fit decreasing, return a list of rows of sample indices.'''
+        rows, free = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for r in range(len(rows)):
+                if free[r] >= lengths[i]:
+                    rows[r].append(i)
+                    free[r] -= lengths[i]
+                    break
+            else:
+                rows.append([i])
+                free.append(self.max_length - lengths[i])
+        return rows
+
+    def __call__(self, samples):
+        input_ids = [torch.as_tensor(s['input_ids'], dtype=torch.long)[:self.max_length] for s in samples]
+        labels = [torch.as_tensor(s['labels'], dtype=torch.long)[:self.max_length] if 'labels' in s else ids
+                  for s, ids in zip(samples, input_ids)]
+        if self.shift_labels:
+            labels = [torch.cat((l[1:], l.new_full((1,), -100))) for l in labels]
+        rows = self.pack([len(x) for x in input_ids])
+
+        shape = (len(rows), self.max_length)
+        batch = {
+            'input_ids': torch.full(shape, self.pad_token_id, dtype=torch.long),
+            'position_ids': torch.zeros(shape, dtype=torch.long),
+            'labels': torch.full(shape, -100, dtype=torch.long),
+            'document_ids': torch.full(shape, -1, dtype=torch.long),
+        }
+        cu_seqlens = [0]
+        for r, row in enumerate(rows):
+            offset = 0
+            for i in row:
+                n = len(input_ids[i])
+                batch['input_ids'][r, offset:offset+n] = input_ids[i]
+                batch['position_ids'][r, offset:offset+n] = torch.arange(n)
+                batch['labels'][r, offset:offset+n] = labels[i]
+                batch['document_ids'][r, offset:offset+n] = i
+                offset += n
+                cu_seqlens.append(r * self.max_length + offset)
+            if offset < self.max_length: # the padding is a segment of its own
+                cu_seqlens.append((r + 1) * self.max_length)
+        batch['loss_mask'] = (batch['labels'] != -100).float()
+
+        if self.use_cu_seqlens:
+            batch['cu_seqlens'] = torch.tensor(cu_seqlens, dtype=torch.int32)
+            batch['attention_mask'] = torch.ones(1, 1, 1, 1)
+        else:
+            document_ids = batch['document_ids']
+            mask = document_ids[:, :, None] == document_ids[:, None, :]
+            if self.causal:
+                mask.tril_()
+            batch['attention_mask'] = mask.unsqueeze(1).float()
+
+        num_tokens = sum(len(x) for x in input_ids)
+        self.num_tokens += num_tokens
+        self.num_slots += len(rows) * self.max_length
+        return batch
+
+
+def packing_efficiency(batch):
+    '''ratio of the non-padding tokens of a batch from PackingCollator.'''
+    return (batch['document_ids'] >= 0).float().mean().item()
@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   prefetcher.py
+'''
+
+# here put the import lib
+import time
+from collections import deque
+from collections.abc import Mapping
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    '''copy the tensors of a nested dict/list/tuple (namedtuple) batch to device, other leaves are kept.'''
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, Mapping): # e.g. dict, BatchEncoding of huggingface, returned as dict
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    if isinstance(batch, tuple) and hasattr(batch, '_fields'): # namedtuple
+        return type(batch)(*(to_device(v, device, non_blocking) for v in batch))
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(v, device, non_blocking) for v in batch)
+    return batch
+
+def _record_stream(batch, stream):
+    '''the tensors are allocated on the copy stream, but used on the compute stream.'''
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, Mapping):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    '''wrap a DataLoader to copy the next num_batches batches to device ahead of their use,
+        by non_blocking copies (from the pinned memory) on a side cuda stream, overlapped with the compute.
+        On cpu, the batches are passed through. Otherwise it behaves as the DataLoader (len, batch_sampler, ...).
+        The time waiting for the data in next() is added to timers('data loader'), if timers is set
+        and the caller is not already timing it.
+    '''
+    def __init__(self, loader, num_batches=2, device=None, timers=None):
+        self.loader = loader
+        self.num_batches = num_batches
+        if device is None:
+            device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+        self.device = torch.device(device)
+        self.timers = timers
+        self.wait_time = 0. # total seconds waiting in next()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name): # batch_sampler, dataset, ...
+        if name == 'loader': # not set yet, e.g. in unpickling
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        return _PrefetchIterator(self)
+
+
+class _PrefetchIterator:
+    def __init__(self, prefetcher):
+        self.prefetcher = prefetcher
+        self.iterator = iter(prefetcher.loader)
+        self.device = prefetcher.device
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.queue = deque() # (batch, copy done event)
+        self.exhausted = False
+        for _ in range(max(1, prefetcher.num_batches)):
+            self._preload()
+
+    def _preload(self):
+        if self.exhausted:
+            return
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.exhausted = True
+            return
+        event = None
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                batch = to_device(batch, self.device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+        self.queue.append((batch, event))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        if not self.queue:
+            self._preload()
+        if not self.queue:
+            raise StopIteration
+        batch, event = self.queue.popleft()
+        if event is not None: # wait on the device, not on the host
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            _record_stream(batch, current_stream)
+        self._preload()
+        self._account(time.time() - start)
+        return batch
+
+    def _account(self, wait):
+        prefetcher = self.prefetcher
+        prefetcher.wait_time += wait
+        if prefetcher.timers is not None:
+            prefetcher.timers('data loader').add(wait) # skipped if the caller times next() itself
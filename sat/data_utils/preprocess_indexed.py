@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   preprocess_indexed.py
+'''
+
+# Tokenize raw text (one document per line) or jsonl files into shards of IndexedDataset (.bin/.idx).
+# Usage: python -m sat.data_utils.preprocess_indexed --input a.jsonl b.jsonl --output-prefix data/corpus
+#            --tokenizer-type THUDM/chatglm-6b --workers 16 [--json-key text] [--append-eos] [--shard-size 1000000]
+
+# here put the import lib
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from sat.tokenization import get_tokenizer
+from sat.data_utils.indexed_dataset import IndexedDatasetBuilder, best_dtype
+
+
+def encode(tokenizer, text):
+    if hasattr(tokenizer, 'encode'): # huggingface, icetk, ...
+        return tokenizer.encode(text)
+    return tokenizer.EncodeAsIds(text).tokenization # glm tokenizers
+
+
+class Encoder:
+    '''tokenizes lines in the workers, the tokenizer is created once per process.'''
+    def __init__(self, args):
+        self.args = args
+
+    def initializer(self):
+        Encoder.tokenizer = get_tokenizer(self.args)
+
+    def __call__(self, line):
+        text = json.loads(line)[self.args.json_key] if self.args.jsonl else line.rstrip('\n')
+        tokens = encode(Encoder.tokenizer, text)
+        if self.args.append_eos:
+            tokens = list(tokens) + [self.args.eos_id]
+        return tokens, len(line.encode('utf-8'))
+
+
+def get_eos_id(tokenizer):
+    for name in ('eos_token_id', 'eos_id', 'eod'):
+        if getattr(tokenizer, name, None) is not None:
+            return getattr(tokenizer, name)
+    if hasattr(tokenizer, 'get_command'): # glm tokenizers
+        return tokenizer.get_command('eos').Id
+    raise ValueError('cannot find the eos token of the tokenizer, disable --append-eos.')
+
+
+def preprocess(args):
+    '''tokenize args.input into shards <output_prefix>_<shard>.bin/.idx of at most args.shard_size documents.'''
+    encoder = Encoder(args)
+    encoder.initializer()
+    tokenizer = Encoder.tokenizer
+    if args.append_eos:
+        args.eos_id = get_eos_id(tokenizer)
+    vocab_size = args.vocab_size or getattr(tokenizer, 'num_tokens', None) or (len(tokenizer) if hasattr(tokenizer, '__len__') else None)
+    dtype = best_dtype(vocab_size)
+
+    def lines():
+        for path in args.input:
+            with open(path, 'r', encoding='utf-8') as fin:
+                yield from (line for line in fin if line.strip())
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
+        encoded = pool.imap(encoder, lines(), chunksize=args.chunk_size)
+    else:
+        pool, encoded = None, map(encoder, lines())
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_prefix)), exist_ok=True)
+    start, num_bytes, num_tokens, prefixes = time.time(), 0, 0, []
+    builder = None
+    for i, (tokens, size) in enumerate(encoded):
+        if i % args.shard_size == 0:
+            if builder is not None:
+                builder.finalize()
+            prefixes.append(f'{args.output_prefix}_{len(prefixes):05d}')
+            builder = IndexedDatasetBuilder(prefixes[-1], dtype=dtype)
+        builder.add_document(tokens)
+        num_bytes += size
+        num_tokens += len(tokens)
+        if (i + 1) % args.log_interval == 0:
+            elapsed = time.time() - start
+            print(f'{i + 1} documents, {num_tokens} tokens, {num_bytes / elapsed / 1024 ** 2:.2f} MB/s', file=sys.stderr)
+    if builder is not None:
+        builder.finalize()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return prefixes
+
+
+def get_args(args_list=None):
+    parser = argparse.ArgumentParser(description='tokenize text or jsonl into IndexedDataset shards.')
+    parser.add_argument('--input', nargs='+', required=True, help='text files (one document per line) or .jsonl/.json files.')
+    parser.add_argument('--output-prefix', required=True)
+    parser.add_argument('--json-key', default='text')
+    parser.add_argument('--append-eos', action='store_true', help='append the eos token to each document.')
+    parser.add_argument('--shard-size', type=int, default=1000000, help='number of documents per shard.')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=64, help='number of lines sent to a worker at a time.')
+    parser.add_argument('--log-interval', type=int, default=100000)
+    # for get_tokenizer
+    parser.add_argument('--tokenizer-type', type=str, required=True,
+                        help='as in get_tokenizer, "outer_tokenizer" for the one already set by get_tokenizer(outer_tokenizer=...).')
+    parser.add_argument('--vocab-size', type=int, default=0, help='to choose the dtype, default len(tokenizer).')
+    parser.add_argument('--tokenizer-model-type', type=str, default=None)
+    parser.add_argument('--img-tokenizer-path', type=str, default=None)
+    parser.add_argument('--task-mask', action='store_true')
+    parser.add_argument('--block-mask-prob', type=float, default=0.0)
+    args = parser.parse_args(args_list)
+    args.jsonl = all(path.endswith(('.jsonl', '.json')) for path in args.input)
+    return args
+
+
+if __name__ == '__main__':
+    print('\n'.join(preprocess(get_args())))
@@ -169,3 +169,98 @@ class DistributedBatchSampler(data.sampler.BatchSampler):
             return batch[0:1]
         else:
             return batch[start:end]
+
+
+class TokenBudgetBatchSampler(data.sampler.Sampler):
+    """
+    batch sampler forming batches of similar lengths under a token budget, instead of a fixed number of samples.
+    Each step yields the batch of this rank among world_size batches. The samples are shuffled by (seed, epoch),
+    sorted by length within buckets of bucket_size samples, greedily batched while
+    len(batch) * (longest length in batch) <= max_tokens, then the batches are shuffled.
+    The plan is a pure function of (lengths, seed, epoch), so all the ranks agree without communication,
+    and resuming by start_iter (in iterations of gradient_accumulation_steps steps) replays the same batches.
+    The shuffled epochs differ by a few batches, and counting them would need all their plans, so every epoch
+    runs num_steps(0) steps: a shorter plan wraps around to its first batches, a longer one drops its last.
+    Only the epochs reached are planned, at most one plan is kept.
+    Arguments:
+        lengths (1D array-like): number of tokens of each sample of the dataset, i.e. the length index.
+        max_tokens (int): token budget of a batch on one rank, padding included. Longer samples are batched alone.
+        num_epochs (int): the plans of the epochs are concatenated.
+    """
+    def __init__(self, lengths, max_tokens, rank=0, world_size=1, shuffle=True, seed=0, num_epochs=1,
+                 bucket_size=None, max_batch_size=None, drop_last=False, gradient_accumulation_steps=1):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_epochs = num_epochs
+        if bucket_size is None: # about 100 batches per bucket
+            bucket_size = 100 * max(1, int(max_tokens // max(1., self.lengths.mean()))) if len(self.lengths) > 0 else 1
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.drop_last = drop_last
+        self.gradient_accumulation_steps = gradient_accumulation_steps or 1
+        self.start_iter = 0
+        self._num_steps = {} # epoch -> number of steps
+        self._plan = (None, None) # (epoch, steps), only the current epoch is kept
+
+    def steps(self, epoch):
+        """the plan of an epoch, list of steps, each a list of (at most world_size) batches of indices."""
+        if self._plan[0] == epoch:
+            return self._plan[1]
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batch, longest = [], 0
+            for idx, length in zip(bucket.tolist(), self.lengths[bucket].tolist()):
+                if batch and ((len(batch) + 1) * max(longest, length) > self.max_tokens or len(batch) == self.max_batch_size):
+                    batches.append(batch)
+                    batch, longest = [], 0
+                batch.append(idx)
+                longest = max(longest, length)
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        steps = [batches[i:i + self.world_size] for i in range(0, len(batches), self.world_size)]
+        if self.drop_last and steps and len(steps[-1]) < self.world_size:
+            steps.pop()
+        self._num_steps[epoch] = len(steps)
+        self._plan = (epoch, steps)
+        return steps
+
+    def num_steps(self, epoch):
+        if epoch not in self._num_steps:
+            self.steps(epoch)
+        return self._num_steps[epoch]
+
+    def __len__(self):
+        return self.num_steps(0) * self.num_epochs
+
+    def _step(self, epoch, i):
+        steps = self.steps(epoch)
+        return steps[i % len(steps)]
+
+    def __iter__(self):
+        epoch_steps = self.num_steps(0)
+        skip = self.start_iter * self.gradient_accumulation_steps
+        self.start_iter = 0
+        for position in range(skip, epoch_steps * self.num_epochs):
+            yield self._batch(self._step(position // epoch_steps, position % epoch_steps))
+
+    def _batch(self, step):
+        """extracts the batch of this worker, a dummy one (dropped by evaluate) if the last step is short"""
+        if self.rank >= len(step):
+            return step[0][0:1]
+        return step[self.rank]
+
+    def last_shape(self):
+        """(last_shape, drop_number) of the last step, as in make_data_loader for evaluate."""
+        last_step = self._step(self.num_epochs - 1, self.num_steps(0) - 1)
+        drop_number = self.world_size - len(last_step)
+        return [len(batch) for batch in last_step] + [1] * drop_number, drop_number
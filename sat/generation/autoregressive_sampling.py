@@ -12,7 +12,11 @@ import sys
 import math
 import random
 import torch
+import torch.nn.functional as F
 from .sampling_strategies import BaseStrategy
+from .sampling_strategies.base_strategy import top_k_logits
+from sat.model.cached_autoregressive_model import StaticKVCache, PagedKVCache
+from sat.transformer_defaults import MaskInfo
 
 def get_masks_and_position_ids_default(seq):
     tokens = seq.unsqueeze(0)
@@ -28,8 +32,13 @@ def get_masks_and_position_ids_default(seq):
 def update_mems(hiddens, mems, max_memory_length):
     '''
         hiddens: list (num_layers) of [batch, query_length, 2d]
-        mems: None or [num_layers, batch, memory_length, 2d]
+        mems: None or [num_layers, batch, memory_length, 2d] or StaticKVCache/PagedKVCache
     '''
+    if isinstance(mems, (StaticKVCache, PagedKVCache)):
+        # already written in place by CachedAutoregressiveMixin
+        mems.commit()
+        assert mems.length <= max_memory_length, 'kv caches do not support memory truncation.'
+        return mems
     if hiddens is None:
         return None
     hiddens = torch.stack(hiddens)
@@ -48,6 +57,20 @@ def update_mems(hiddens, mems, max_memory_length):
             )
 
 
+def static_decode_step(model, cache):
+    '''A forward of `model` (with CachedAutoregressiveMixin) on `cache` (StaticKVCache) with static shapes,
+        the keys/values are always the whole [batch, nh, max_length, hn] buffers, and nothing python-side changes
+        with the step, so that it can be wrapped by torch.compile(mode="reduce-overhead") or graph captured.
+        returns step(tokens [b, seq_len], position_ids, attention_mask [1 or b, 1, seq_len, max_length], cache_positions [seq_len], **kw_args)
+            -> logits [b, seq_len, vocab]. The new keys/values are written at cache_positions (a tensor, not a python int),
+            attention_mask must be binary and mask the positions not written yet. kw_args are passed to the model.
+    '''
+    def step(tokens, position_ids, attention_mask, cache_positions, **kw_args):
+        logits, *_ = model(tokens, position_ids, attention_mask, mems=cache, cache_positions=cache_positions,
+                           mask_info=MaskInfo.known(attention_mask, 'arbitrary'), **kw_args)
+        return logits
+    return step
+
 def filling_sequence(
         model, 
         seq, 
@@ -57,6 +80,9 @@ def filling_sequence(
         log_attention_weights=None,
         get_masks_and_position_ids=get_masks_and_position_ids_default,
         mems=None,
+        prefix_cache=None,
+        static_decode=False,
+        compile_kwargs=None,
         **kw_args
         ):
     '''
@@ -65,6 +91,14 @@ def filling_sequence(
             cache, should be first mems.shape[1] parts of context_tokens.
             mems are the first-level citizens here, but we don't assume what is memorized.
             input mems are used when multi-phase generation.
+            can also be a StaticKVCache or PagedKVCache (see CachedAutoregressiveMixin), which is updated in place.
+        prefix_cache: a PrefixCache, if mems is None, the longest cached prefix of the context is reused as mems,
+            and the caches of the context and the final tokens are stored into it.
+        static_decode: run every forward with static shapes (see static_decode_step) on a StaticKVCache
+            of batch_size rows (mems, or a new one of len(seq) positions).
+        compile_kwargs: with static_decode, the 1-token decode steps run through torch.compile(**compile_kwargs),
+            e.g. {'mode': 'reduce-overhead'}. The compiled step is kept on the StaticKVCache,
+            pass the same cache as `mems` to reuse it (and its compiled graphs) across calls.
     '''
     assert len(seq.shape) == 1
 
@@ -75,11 +109,34 @@ def filling_sequence(
     assert context_length > 0
     tokens, attention_mask, position_ids = get_masks_and_position_ids(seq)
     tokens = tokens[..., :context_length]
+    use_prefix_cache = prefix_cache is not None and mems is None
+    if use_prefix_cache:
+        # at least the last context token needs forwarding to get the logits
+        _, mems = prefix_cache.get(seq[:context_length], max_length=context_length - 1)
     if attention_mask.dtype != torch.bool:
         attention_mask = attention_mask.type_as(next(model.parameters())) # if fp16
+    if static_decode:
+        if mems is None:
+            mems = StaticKVCache.from_model(model, batch_size, len(seq))
+        assert isinstance(mems, StaticKVCache) and mems.batch_size == batch_size and mems.max_length >= len(seq), \
+            'static_decode needs a StaticKVCache of batch_size rows and at least len(seq) positions.'
+        assert log_attention_weights is None and not use_prefix_cache, 'not supported by static_decode.'
+        prefill_step = decode_step = static_decode_step(model, mems)
+        if compile_kwargs is not None:
+            key = (id(model), repr(sorted(compile_kwargs.items()))) # the step holds the model, the id is not reused
+            if key not in mems.compiled_steps:
+                mems.compiled_steps[key] = torch.compile(prefill_step, **compile_kwargs)
+            decode_step = mems.compiled_steps[key]
     # initialize generation
     counter = context_length - 1 # Last fixed index is ``counter'' 
-    index = 0 if mems is None else mems.shape[2] # Next forward starting index, also the length of cache.
+    if mems is None:
+        index = 0 # Next forward starting index, also the length of cache.
+    elif isinstance(mems, (StaticKVCache, PagedKVCache)):
+        if isinstance(mems, PagedKVCache) and mems.batch_size == 0:
+            mems.set_batch([mems.add_sequence()])
+        index = mems.length
+    else:
+        index = mems.shape[2]
     # step-by-step generation
     while counter < len(seq) - 1:
         # Now, we want to generate seq[counter + 1],
@@ -101,28 +158,148 @@ def filling_sequence(
         else:
             log_attention_weights_part = None
 
-        logits, *output_per_layers = model(
-            tokens[:, index:], 
-            position_ids[..., index: counter+1],
-            attention_mask[..., index: counter+1, :counter+1], # TODO memlen
-            mems=mems,
-            log_attention_weights=log_attention_weights_part,
-            **kw_args
-        )
-        mem_kv = [o['mem_kv'] for o in output_per_layers]
-        mems = update_mems(mem_kv, mems, max_memory_length=max_memory_length)
+        if static_decode:
+            # the same shapes for all the decode steps, the positions not written yet are masked.
+            step_mask = attention_mask[..., index: counter+1, :]
+            if step_mask.shape[-1] < mems.max_length:
+                step_mask = F.pad(step_mask, (0, mems.max_length - step_mask.shape[-1]))
+            step = decode_step if counter + 1 - index == 1 else prefill_step
+            # contiguous copies, the strides of the slices would change with the length (recompilation).
+            logits = step(tokens[:, index:].contiguous(), position_ids[..., index: counter+1].contiguous(),
+                          step_mask.contiguous(), torch.arange(index, counter + 1, device=tokens.device), **kw_args)
+            mems.length = counter + 1
+        else:
+            logits, *output_per_layers = model(
+                tokens[:, index:], 
+                position_ids[..., index: counter+1],
+                attention_mask[..., index: counter+1, :counter+1], # TODO memlen
+                mems=mems,
+                log_attention_weights=log_attention_weights_part,
+                **kw_args
+            )
+            mem_kv = [o['mem_kv'] for o in output_per_layers if 'mem_kv' in o]
+            mems = update_mems(mem_kv, mems, max_memory_length=max_memory_length)
+        if use_prefix_cache and index < context_length and mems.shape[2] == counter + 1:
+            prefix_cache.put(tokens[0], mems)
         counter += 1
         index = counter
         # sampling
         logits = logits[:, -1].expand(batch_size, -1) # [batch size, vocab size]
         tokens = tokens.expand(batch_size, -1)
+        if isinstance(mems, PagedKVCache) and mems.batch_size < batch_size:
+            # share the prompt blocks among the batch
+            mems.reorder_(torch.zeros(batch_size, dtype=torch.long))
         tokens, mems = strategy.forward(logits, tokens, mems)
         if strategy.is_done:
             break
+    if use_prefix_cache and isinstance(mems, torch.Tensor) and mems.shape[2] == tokens.shape[1] - 1:
+        prefix_cache.put(tokens[0], mems)
     return strategy.finalize(tokens, mems)
 
 
 
+def _speculative_probs(logits, temperature, top_k, top_p):
+    # logits: [n, vocab] -> probs [n, vocab]; temperature 0 means greedy (one-hot)
+    logits = logits.float()
+    if temperature <= 0:
+        return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+    logits = top_k_logits(logits / temperature, top_k, top_p)
+    return F.softmax(logits, dim=-1)
+
+def speculative_filling_sequence(
+        target_model,
+        draft_model,
+        seq,
+        k=4,
+        temperature=1.,
+        top_k=0,
+        top_p=0.0,
+        end_tokens=None,
+        get_masks_and_position_ids=get_masks_and_position_ids_default,
+        vocab_size=None,
+        **kw_args
+        ):
+    '''Speculative decoding: the draft model proposes k tokens one by one, the target model scores all of them in one forward,
+        and they are accepted or rejected with the standard rejection sampling rule, so the output follows the target distribution.
+        Both models need CachedAutoregressiveMixin and the same tokenizer, their caches are truncated to the accepted tokens.
+        vocab_size: the vocabulary of the target, default its word embeddings. The draft only proposes tokens in it,
+            a larger (e.g. padded) draft vocabulary is masked before sampling.
+        seq: [2, 3, 5, ..., -1(to be generated), -1, ...]
+        return: tokens [1, len], stats (acceptance_rate, drafted, accepted, target_forwards)
+    '''
+    assert len(seq.shape) == 1
+    context_length = 0
+    while seq[context_length] >= 0:
+        context_length += 1
+    assert context_length > 0
+    _, attention_mask, position_ids = get_masks_and_position_ids(seq)
+    attention_mask = attention_mask.type_as(next(target_model.parameters()))
+    draft_attention_mask = attention_mask.type_as(next(draft_model.parameters()))
+    tokens = seq[:context_length].unsqueeze(0)
+    end_tokens = set(end_tokens or [])
+    if vocab_size is None:
+        vocab_size = target_model.transformer.word_embeddings.num_embeddings
+
+    def forward(model, mask, mems, start, end, tokens):
+        # forward tokens[:, start:end] over the cache of tokens[:, :start], return logits and the cache of tokens[:, :end]
+        logits, *output_per_layers = model(tokens[:, start:end], position_ids[..., start:end],
+            mask[..., start:end, :end], mems=mems, **kw_args)
+        mems = update_mems([o['mem_kv'] for o in output_per_layers], mems, max_memory_length=end)
+        return logits, mems
+
+    target_mems = draft_mems = None
+    target_len = draft_len = 0 # cached lengths
+    stats = {'drafted': 0, 'accepted': 0, 'target_forwards': 0}
+    while tokens.shape[1] < len(seq):
+        n = tokens.shape[1]
+        num_draft = min(k, len(seq) - n)
+        # draft k tokens
+        draft_tokens, draft_probs = tokens, []
+        for _ in range(num_draft):
+            logits, draft_mems = forward(draft_model, draft_attention_mask, draft_mems, draft_len, draft_tokens.shape[1], draft_tokens)
+            draft_len = draft_tokens.shape[1]
+            q = _speculative_probs(logits[:, -1, :vocab_size], temperature, top_k, top_p)
+            if q.shape[-1] < vocab_size: # a smaller draft vocabulary never proposes the rest
+                q = F.pad(q, (0, vocab_size - q.shape[-1]))
+            draft_probs.append(q[0])
+            draft_tokens = torch.cat((draft_tokens, torch.multinomial(q, num_samples=1)), dim=1)
+        # verify them in one target forward
+        logits, target_mems = forward(target_model, attention_mask, target_mems, target_len, draft_tokens.shape[1], draft_tokens)
+        stats['target_forwards'] += 1
+        assert logits.shape[-1] >= vocab_size, f'the target logits have fewer than vocab_size {vocab_size} entries.'
+        p = _speculative_probs(logits[0, -num_draft-1:, :vocab_size], temperature, top_k, top_p) # [num_draft+1, vocab]
+        q = torch.stack(draft_probs)
+        proposed = draft_tokens[0, n:]
+        ratio = p[:-1].gather(1, proposed[:, None]).squeeze(1) / q.gather(1, proposed[:, None]).squeeze(1)
+        rejected = (torch.rand_like(ratio) >= ratio).nonzero()
+        num_accepted = int(rejected[0]) if len(rejected) > 0 else num_draft
+        if num_accepted < num_draft:
+            residual = torch.clamp(p[num_accepted] - q[num_accepted], min=0)
+            if residual.sum() <= 0: # p == q
+                residual = p[num_accepted]
+            next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+        else:
+            next_token = torch.multinomial(p[-1], num_samples=1)
+        stats['drafted'] += num_draft
+        stats['accepted'] += num_accepted
+        tokens = torch.cat((draft_tokens[:, :n + num_accepted], next_token.view(1, 1)), dim=1)[:, :len(seq)]
+
+        # keep only the cache of accepted tokens, tokens[:, -1] is not forwarded yet
+        target_len = min(draft_tokens.shape[1], tokens.shape[1] - 1)
+        target_mems = target_mems[:, :, :target_len]
+        draft_len = min(draft_len, tokens.shape[1] - 1)
+        draft_mems = draft_mems[:, :, :draft_len]
+
+        generated = tokens[0, n:].tolist()
+        for i, token in enumerate(generated):
+            if token in end_tokens:
+                tokens = tokens[:, :n + i + 1]
+                stats['acceptance_rate'] = stats['accepted'] / max(stats['drafted'], 1)
+                return tokens, stats
+    stats['acceptance_rate'] = stats['accepted'] / max(stats['drafted'], 1)
+    return tokens, stats
+
+
 def evaluate_perplexity(model, tokens, attention_mask, position_ids, loss_mask, invalid_slices=[], reduction='mean'):
     # sanity check
     assert len(tokens.shape) <= 2 and len(loss_mask.shape)
@@ -0,0 +1,242 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   engine.py
+'''
+
+# here put the import lib
+import time
+from collections import deque
+import torch
+
+from .sampling_strategies import BaseStrategy
+
+
+class GenerationRequest:
+    def __init__(self, request_id, prompt, max_new_tokens):
+        self.request_id = request_id
+        self.prompt = prompt # list of token ids
+        self.max_new_tokens = max_new_tokens
+        self.output = [] # generated token ids
+        self.slot = None
+        self.seq_id = None # sequence in the paged cache
+        self.reserved_blocks = 0
+        self.submit_time = time.time()
+        self.admit_time = None
+        self.finish_time = None
+
+    @property
+    def length(self):
+        return len(self.prompt) + len(self.output)
+
+    @property
+    def queue_latency(self):
+        return self.admit_time - self.submit_time
+
+
+class GenerationEngine:
+    '''Continuous batching on top of a model with CachedAutoregressiveMixin.
+        Requests wait in a queue, are admitted into free slots between decode steps (one batched prefill),
+        and all in-flight requests advance one token per step in one batched forward
+        with per-row position ids and attention masks over a shared [num_layers, max_batch_size, max_length, 2d] cache.
+        Position ids are the plain token indices, as in `get_masks_and_position_ids_default`.
+        With `paged_cache` (a PagedKVCache), the kv cache is allocated in blocks on demand instead,
+        and requests are admitted only while the pool can hold their prompt + max_new_tokens.
+
+        Usage:
+            engine = GenerationEngine(model, max_batch_size=8, max_length=512, end_tokens=[eos_id])
+            engine.add_request([5, 6, 7], max_new_tokens=32)
+            finished = engine.run() # {request_id: GenerationRequest}
+    '''
+    def __init__(self, model, max_batch_size=8, max_length=None, strategy=None, end_tokens=None, paged_cache=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        if max_length is None:
+            max_length = model.transformer.max_sequence_length
+        self.max_length = max_length
+        self.strategy = BaseStrategy(top_k=1) if strategy is None else strategy
+        if end_tokens is None:
+            end_tokens = self.strategy.end_tokens
+        self.end_tokens = set(end_tokens)
+
+        param = next(model.parameters())
+        self.device, self.dtype = param.device, param.dtype
+        self.queue = deque()
+        self.slots = [None] * max_batch_size
+        self.lengths = torch.zeros(max_batch_size, dtype=torch.long, device=self.device) # cached positions per slot
+        self.mems = None # lazily allocated at the first prefill
+        self.paged_cache = paged_cache
+        if paged_cache is not None and paged_cache.num_blocks * paged_cache.block_size < max_length:
+            raise ValueError(f'paged_cache holds {paged_cache.num_blocks * paged_cache.block_size} positions, '
+                             f'fewer than max_length {max_length}.')
+        self.reserved_blocks = 0
+        self._next_id = 0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.num_generated_tokens = 0
+        self.num_steps = 0
+        self.busy_time = 0.
+        self.queue_latencies = []
+
+    def add_request(self, prompt, max_new_tokens):
+        if isinstance(prompt, torch.Tensor):
+            prompt = prompt.tolist()
+        assert len(prompt) > 0 and max_new_tokens > 0
+        if len(prompt) + max_new_tokens > self.max_length:
+            raise ValueError(f'prompt length {len(prompt)} + max_new_tokens {max_new_tokens} exceeds max_length {self.max_length}.')
+        if self.paged_cache is not None and \
+                self.paged_cache.blocks_needed(len(prompt) + max_new_tokens) > self.paged_cache.num_blocks:
+            # it would wait at the head of the queue forever, blocking the requests behind it
+            raise ValueError(f'prompt length {len(prompt)} + max_new_tokens {max_new_tokens} exceeds the paged_cache '
+                             f'of {self.paged_cache.num_blocks} blocks of size {self.paged_cache.block_size}.')
+        request = GenerationRequest(self._next_id, list(prompt), max_new_tokens)
+        self._next_id += 1
+        self.queue.append(request)
+        return request.request_id
+
+    @property
+    def num_active(self):
+        return sum(r is not None for r in self.slots)
+
+    def has_unfinished(self):
+        return len(self.queue) > 0 or self.num_active > 0
+
+    def _sample(self, logits):
+        # logits: [batch, vocab], reuse the strategy on an empty context to get the next tokens
+        tokens = torch.empty(logits.shape[0], 0, dtype=torch.long, device=logits.device)
+        tokens, _ = self.strategy.forward(logits, tokens, None)
+        self.strategy.finalize(tokens, None) # rows change between steps, drop the per-row states
+        return tokens[:, -1].tolist()
+
+    def _append(self, request, token):
+        request.output.append(token)
+        self.num_generated_tokens += 1
+        if token in self.end_tokens or len(request.output) >= request.max_new_tokens:
+            request.finish_time = time.time()
+            self.slots[request.slot] = None
+            if self.paged_cache is not None:
+                self.paged_cache.free_sequence(request.seq_id)
+                self.reserved_blocks -= request.reserved_blocks
+            return True
+        return False
+
+    def _admit(self):
+        '''move waiting requests into free slots, and prefill them in one batched forward.'''
+        free_slots = [i for i, r in enumerate(self.slots) if r is None]
+        admitted = []
+        while self.queue and free_slots:
+            request = self.queue[0]
+            if self.paged_cache is not None:
+                # the prefill right-pads every admitted row to the longest prompt, and allocates blocks for the padding too.
+                padded_length = max(len(r.prompt) for r in admitted + [request])
+                reserved = [self.paged_cache.blocks_needed(max(padded_length, len(r.prompt) + r.max_new_tokens))
+                            for r in admitted + [request]]
+                if self.reserved_blocks + sum(reserved) > self.paged_cache.num_blocks:
+                    break
+                for r, n in zip(admitted + [request], reserved):
+                    r.reserved_blocks = n
+            self.queue.popleft()
+            request.slot = free_slots.pop(0)
+            request.admit_time = time.time()
+            self.queue_latencies.append(request.queue_latency)
+            self.slots[request.slot] = request
+            admitted.append(request)
+        if not admitted:
+            return []
+        if self.paged_cache is not None:
+            for r in admitted:
+                self.reserved_blocks += r.reserved_blocks
+                r.seq_id = self.paged_cache.add_sequence()
+
+        # right padding is safe with a causal mask, padded positions are never attended by real tokens.
+        prefill_length = max(len(r.prompt) for r in admitted)
+        tokens = torch.zeros(len(admitted), prefill_length, dtype=torch.long, device=self.device)
+        for i, r in enumerate(admitted):
+            tokens[i, :len(r.prompt)] = torch.tensor(r.prompt, dtype=torch.long, device=self.device)
+        position_ids = torch.arange(prefill_length, dtype=torch.long, device=self.device).unsqueeze(0).expand_as(tokens)
+        attention_mask = torch.ones(1, 1, prefill_length, prefill_length, device=self.device, dtype=self.dtype).tril_()
+
+        prompt_lengths = torch.tensor([len(r.prompt) for r in admitted], dtype=torch.long, device=self.device)
+        if self.paged_cache is not None:
+            self.paged_cache.set_batch([r.seq_id for r in admitted])
+            logits, *_ = self.model(tokens, position_ids, attention_mask, mems=self.paged_cache)
+            self.paged_cache.commit(prompt_lengths.tolist())
+        else:
+            logits, *output_per_layers = self.model(tokens, position_ids, attention_mask)
+            mem_kv = torch.stack([o['mem_kv'] for o in output_per_layers]) # [num_layers, n, prefill_length, 2d]
+            if self.mems is None:
+                self.mems = torch.zeros(mem_kv.shape[0], self.max_batch_size, self.max_length, mem_kv.shape[-1],
+                                        dtype=mem_kv.dtype, device=self.device)
+            slots = torch.tensor([r.slot for r in admitted], dtype=torch.long, device=self.device)
+            self.mems[:, slots, :prefill_length] = mem_kv
+            self.lengths[slots] = prompt_lengths
+
+        last_logits = logits[torch.arange(len(admitted), device=self.device), prompt_lengths - 1]
+        finished = []
+        for r, token in zip(admitted, self._sample(last_logits)):
+            if self._append(r, token):
+                finished.append(r)
+        return finished
+
+    def _decode(self):
+        '''advance all the in-flight requests by one token in one batched forward.'''
+        active = [r for r in self.slots if r is not None]
+        if not active:
+            return []
+        tokens = torch.tensor([[r.output[-1]] for r in active], dtype=torch.long, device=self.device)
+        if self.paged_cache is not None:
+            self.paged_cache.set_batch([r.seq_id for r in active])
+            lengths = torch.tensor([r.length - 1 for r in active], dtype=torch.long, device=self.device)
+            memory_length = int(lengths.max())
+            # the new token of each row is written at its own length, [batch, 1, 1, memory_length + 1]
+            attention_mask = (torch.arange(memory_length + 1, device=self.device) <= lengths[:, None])
+            attention_mask = attention_mask.view(len(active), 1, 1, -1).to(self.dtype)
+            logits, *_ = self.model(tokens, lengths.unsqueeze(1), attention_mask, mems=self.paged_cache)
+            self.paged_cache.commit()
+        else:
+            slots = torch.tensor([r.slot for r in active], dtype=torch.long, device=self.device)
+            lengths = self.lengths[slots]
+            memory_length = int(lengths.max())
+            # [batch, 1, 1, memory_length + 1], cached positions beyond each row's length are padding.
+            attention_mask = torch.ones(len(active), 1, 1, memory_length + 1, device=self.device, dtype=self.dtype)
+            attention_mask[..., :memory_length] = (torch.arange(memory_length, device=self.device) < lengths[:, None]).view(len(active), 1, 1, -1)
+
+            logits, *output_per_layers = self.model(tokens, lengths.unsqueeze(1), attention_mask, mems=self.mems[:, slots, :memory_length])
+            mem_kv = torch.stack([o['mem_kv'] for o in output_per_layers]) # [num_layers, batch, 1, 2d]
+            self.mems[:, slots, lengths] = mem_kv[:, :, 0]
+            self.lengths[slots] = lengths + 1
+
+        finished = []
+        for r, token in zip(active, self._sample(logits[:, -1])):
+            if self._append(r, token):
+                finished.append(r)
+        return finished
+
+    @torch.no_grad()
+    def step(self):
+        '''admit new requests, then run one decode step. Return the requests finished in this step.'''
+        start = time.time()
+        finished = self._admit()
+        finished.extend(self._decode())
+        self.num_steps += 1
+        self.busy_time += time.time() - start
+        return finished
+
+    def run(self):
+        '''step until all the requests are finished. Return {request_id: GenerationRequest}.'''
+        results = {}
+        while self.has_unfinished():
+            for r in self.step():
+                results[r.request_id] = r
+        return results
+
+    def stats(self):
+        return {
+            'steps': self.num_steps,
+            'generated_tokens': self.num_generated_tokens,
+            'tokens_per_sec': self.num_generated_tokens / self.busy_time if self.busy_time > 0 else 0.,
+            'mean_queue_latency': sum(self.queue_latencies) / len(self.queue_latencies) if self.queue_latencies else 0.,
+            'max_queue_latency': max(self.queue_latencies, default=0.),
+            'waiting': len(self.queue),
+            'active': self.num_active,
+        }
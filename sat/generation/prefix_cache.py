@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   prefix_cache.py
+'''
+
+# here put the import lib
+from collections import OrderedDict
+import torch
+
+
+class PrefixCache:
+    '''LRU cache of `mems` (the stacked `mem_kv` of CachedAutoregressiveMixin) keyed by token-id prefixes.
+        Prefixes are hashed block by block (chained), so a lookup finds the longest cached block-aligned prefix
+        of the query, and only the suffix needs forwarding, e.g. `filling_sequence(..., prefix_cache=cache)`.
+        The tokens of each entry are kept and compared on lookup, a hash collision is a miss.
+        Only valid for causal attention, where the cache of a prefix does not depend on the following tokens.
+        max_bytes: budget of the stored mems, least recently used entries are evicted beyond it.
+    '''
+    def __init__(self, max_bytes, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict() # entry_id -> mems [num_layers, 1, length, 2d], in LRU order
+        self.index = {} # chained block hash -> {entry_id: prefix length}
+        self.entry_keys = {} # entry_id -> list of block hashes
+        self.entry_tokens = {} # entry_id -> tuple of the cached prefix tokens
+        self.num_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.hit_tokens = 0
+        self._next_id = 0
+
+    def _block_hashes(self, tokens, max_length=None):
+        '''return (tokens as a tuple, chained hashes of the full blocks within max_length)'''
+        tokens = tuple(tokens.tolist() if isinstance(tokens, torch.Tensor) else tokens)
+        length = len(tokens) if max_length is None else min(len(tokens), max_length)
+        hashes, h = [], None
+        for start in range(0, length - self.block_size + 1, self.block_size):
+            h = hash((h, tokens[start:start + self.block_size]))
+            hashes.append(h)
+        return tokens, hashes
+
+    def _lookup(self, tokens, key, length):
+        '''the most recent entry under `key` whose first `length` tokens are tokens[:length], or None.'''
+        for entry_id in reversed(self.index.get(key, {})):
+            if self.entry_tokens[entry_id][:length] == tokens[:length]:
+                return entry_id
+        return None
+
+    def get(self, tokens, max_length=None):
+        '''longest cached prefix of tokens (at most max_length).
+            return: (length, mems [num_layers, 1, length, 2d]), or (0, None) if missed.
+        '''
+        tokens, keys = self._block_hashes(tokens, max_length)
+        for i in range(len(keys) - 1, -1, -1):
+            length = (i + 1) * self.block_size
+            entry_id = self._lookup(tokens, keys[i], length)
+            if entry_id is not None:
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                self.hit_tokens += length
+                return length, self.entries[entry_id][:, :, :length]
+        self.misses += 1
+        return 0, None
+
+    def put(self, tokens, mems):
+        '''tokens: [length] token ids, mems: [num_layers, batch, >=length', 2d] cache of tokens[:length'], row 0 is stored.'''
+        tokens, keys = self._block_hashes(tokens, max_length=mems.shape[2])
+        if not keys:
+            return
+        length = len(keys) * self.block_size
+        covered = self._lookup(tokens, keys[-1], length)
+        if covered is not None:
+            self.entries.move_to_end(covered)
+            return
+        mems = mems[:, :1, :length].detach().clone()
+        entry_bytes = mems.numel() * mems.element_size()
+        if entry_bytes > self.max_bytes:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self.entries[entry_id] = mems
+        self.entry_keys[entry_id] = keys
+        self.entry_tokens[entry_id] = tokens[:length]
+        for i, key in enumerate(keys):
+            self.index.setdefault(key, {})[entry_id] = (i + 1) * self.block_size
+        self.num_bytes += entry_bytes
+        while self.num_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        entry_id, mems = self.entries.popitem(last=False)
+        del self.entry_tokens[entry_id]
+        for key in self.entry_keys.pop(entry_id):
+            del self.index[key][entry_id]
+            if not self.index[key]:
+                del self.index[key]
+        self.num_bytes -= mems.numel() * mems.element_size()
+        self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.index.clear()
+        self.entry_keys.clear()
+        self.entry_tokens.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_tokens': self.hit_tokens,
+            'entries': len(self.entries),
+            'bytes': self.num_bytes,
+        }
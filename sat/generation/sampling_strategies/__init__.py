@@ -1,3 +1,4 @@
 from .base_strategy import BaseStrategy
 from .iterative_entfilter_strategy import IterativeEntfilterStrategy
-from .beam_search_strategy import BeamSearchStrategy
\ No newline at end of file
+from .beam_search_strategy import BeamSearchStrategy
+from .batched_sampling_strategy import BatchedSamplingStrategy
@@ -15,36 +15,92 @@ import torch
 import torch.nn.functional as F
 
 
-def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-65504):
+def _per_row(value, logits):
+    '''a python scalar or a [batch] tensor of per-row values -> [batch, 1] tensor'''
+    if isinstance(value, torch.Tensor):
+        return value.to(logits.device).view(-1, 1)
+    return torch.full((logits.shape[0], 1), value, device=logits.device)
+
+def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-65504, min_p=0.0):
+    '''Filter logits [batch, vocab] in place.
+        top_k, top_p, min_p: python scalars, or per-row [batch] tensors (0 means disabled for that row).
+    '''
     # This function has been mostly taken from huggingface conversational ai code at
     # https://medium.com/huggingface/how-to-build-a-state-of-the-art-conversational-ai-with-transfer-learning-2d818ac26313
 
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        # convert to 1D
-        logits = logits.view(logits.size()[1]).contiguous()
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
-        # going back to 2D
-        logits = logits.view(1, -1).contiguous()
+    per_row = any(isinstance(x, torch.Tensor) for x in (top_k, top_p, min_p))
+    if not per_row and top_p <= 0.0 and min_p <= 0.0:
+        if top_k > 0:
+            # Remove all tokens with a probability less than the last token of the top-k
+            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+            logits[indices_to_remove] = filter_value
+        return logits
+
+    # sort once, filter in the sorted space, then scatter back
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    sorted_indices_to_remove = torch.zeros_like(sorted_logits, dtype=torch.bool)
+    if per_row or top_k > 0:
+        k = _per_row(top_k, logits).long()
+        ranks = torch.arange(logits.shape[-1], device=logits.device)
+        sorted_indices_to_remove |= (ranks >= k) & (k > 0)
+        sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+    sorted_probs = F.softmax(sorted_logits.float(), dim=-1)
+    if per_row or top_p > 0.0:
+        p = _per_row(top_p, logits)
+        cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+        # Remove tokens with cumulative probability above the threshold,
+        # shifted to the right to keep also the first token above the threshold
+        sorted_indices_to_remove |= (cumulative_probs - sorted_probs > p) & (p > 0)
+    if per_row or min_p > 0.0:
+        # Remove tokens less probable than min_p * the most probable one
+        sorted_indices_to_remove |= sorted_probs < _per_row(min_p, logits) * sorted_probs[:, :1]
+    sorted_indices_to_remove[..., 0] = False
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+    logits.scatter_(-1, sorted_indices, sorted_logits)
+    return logits
+
 
+def apply_repetition_penalty(logits, tokens, penalty):
+    '''CTRL-style repetition penalty for the tokens already in each row, in place.
+        logits: [batch, vocab], tokens: [batch, seq_len], penalty: python scalar or [batch] tensor.
+    '''
+    if tokens.shape[1] == 0:
+        return logits
+    penalty = _per_row(penalty, logits).to(logits.dtype)
+    scores = logits.gather(1, tokens)
+    scores = torch.where(scores > 0, scores / penalty, scores * penalty)
+    logits.scatter_(1, tokens, scores)
     return logits
 
 
+NGRAM_HASH_BASE = 1000003
+
+def ngram_banned_mask(tokens, ngram_size, vocab_size, start=0):
+    '''Banned next tokens for no-repeat-ngram blocking, computed with batched tensor ops on the tokens' device.
+        The n-grams are matched by polynomial rolling hashes (int64, wrapping) of their first n-1 tokens.
+        tokens: [batch, seq_len]
+        start: only n-grams ending at positions >= start (e.g. the generated part) are banned.
+        return: BoolTensor [batch, vocab_size]
+    '''
+    batch_size, seq_len = tokens.shape
+    mask = torch.zeros(batch_size, vocab_size, dtype=torch.bool, device=tokens.device)
+    if ngram_size <= 0 or seq_len < ngram_size:
+        return mask
+    next_tokens = tokens[:, ngram_size-1:] # the last token of each existing n-gram
+    valid = torch.arange(ngram_size-1, seq_len, device=tokens.device) >= start
+    if ngram_size == 1:
+        matched = valid.expand_as(next_tokens)
+    else:
+        powers = NGRAM_HASH_BASE ** torch.arange(ngram_size-1, device=tokens.device, dtype=torch.long)
+        hashes = (tokens.unfold(1, ngram_size-1, 1) * powers).sum(dim=-1) # [batch, seq_len-n+2]
+        matched = (hashes[:, :-1] == hashes[:, -1:]) & valid
+    counts = torch.zeros(batch_size, vocab_size, dtype=torch.int, device=tokens.device)
+    counts.scatter_add_(1, next_tokens, matched.int())
+    return counts > 0
+
+
 class BaseStrategy:
-    def __init__(self, invalid_slices=[], temperature=1., top_k=200, eps=1e-4, top_p=0.0, end_tokens=None):
+    def __init__(self, invalid_slices=[], temperature=1., top_k=200, eps=1e-4, top_p=0.0, end_tokens=None, no_repeat_ngram_size=0):
         self.invalid_slices = invalid_slices
         self.temperature = temperature
         self.topk = top_k
@@ -53,7 +109,10 @@ class BaseStrategy:
         if end_tokens is None:
             end_tokens = []
         self.end_tokens = end_tokens
+        self.ngram = no_repeat_ngram_size
         self._is_done = False
+        self._done = None # [batch], rows that have produced an end token
+        self._context_length = None
 
     @property
     def is_done(self) -> bool:
@@ -65,15 +124,24 @@ class BaseStrategy:
         logits = logits / temperature
         for invalid_slice in self.invalid_slices:
             logits[..., invalid_slice] = -65504
+        if self._context_length is None:
+            self._context_length = tokens.shape[1]
+        if self.ngram > 0:
+            logits = logits.masked_fill(ngram_banned_mask(tokens, self.ngram, logits.shape[-1], start=self._context_length), -65504)
 
         logits = top_k_logits(logits, self.topk, self.top_p)
         probs = F.softmax(logits.float(), dim=-1)  # float is essetial, due to a bug in Pytorch
         pred = torch.multinomial(probs, num_samples=1)
-        if pred.numel() == 1 and pred.item() in self.end_tokens:
-            self._is_done = True
+        if self.end_tokens:
+            is_end = torch.isin(pred.view(-1), torch.tensor(self.end_tokens, device=pred.device))
+            self._done = is_end if self._done is None or self._done.shape != is_end.shape else self._done | is_end
+            if self._done.all():
+                self._is_done = True
         tokens = torch.cat((tokens, pred.view(tokens.shape[0], 1)), dim=1)
         return tokens, mems
 
     def finalize(self, tokens, mems):
         self._is_done = False
+        self._done = None
+        self._context_length = None
         return tokens, mems
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   batched_sampling_strategy.py
+'''
+
+# here put the import lib
+import torch
+import torch.nn.functional as F
+
+from .base_strategy import top_k_logits, apply_repetition_penalty, ngram_banned_mask, _per_row
+
+class BatchedSamplingStrategy:
+    '''Sampling for a batch of independent continuations, e.g. `filling_sequence(..., batch_size=64)`.
+        temperature, top_k, top_p, min_p, repetition_penalty: python scalars or per-row [batch] tensors.
+        temperature <= 0 means greedy decoding for that row.
+        `done` is the [batch] mask of rows that have produced an end token, they are padded with end_tokens[0] afterwards.
+    '''
+    def __init__(self, temperature=1., top_k=0, top_p=0., min_p=0., repetition_penalty=1.,
+                 end_tokens=None, invalid_slices=[], no_repeat_ngram_size=0):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.end_tokens = [] if end_tokens is None else end_tokens
+        self.invalid_slices = invalid_slices
+        self.ngram = no_repeat_ngram_size
+        self._init_cache()
+
+    def _init_cache(self):
+        self.done = None
+        self._is_done = False
+        self._context_length = None
+
+    @property
+    def is_done(self) -> bool:
+        return self._is_done
+
+    def forward(self, logits, tokens, mems):
+        # a copy, the rows may be a broadcast view (the first step of filling_sequence) and are modified in place below.
+        logits = logits.float().clone()
+        for invalid_slice in self.invalid_slices:
+            logits[..., invalid_slice] = -65504
+        if self._context_length is None:
+            self._context_length = tokens.shape[1]
+        if isinstance(self.repetition_penalty, torch.Tensor) or self.repetition_penalty != 1.:
+            logits = apply_repetition_penalty(logits, tokens, self.repetition_penalty)
+        if self.ngram > 0:
+            logits.masked_fill_(ngram_banned_mask(tokens, self.ngram, logits.shape[-1], start=self._context_length), -65504)
+
+        temperature = _per_row(self.temperature, logits)
+        greedy = (temperature <= 0).view(-1)
+        logits = logits / torch.where(temperature > 0, temperature, torch.ones_like(temperature))
+        logits = top_k_logits(logits, self.top_k, self.top_p, min_p=self.min_p)
+        probs = F.softmax(logits, dim=-1)
+        pred = torch.multinomial(probs, num_samples=1).view(-1)
+        pred = torch.where(greedy, logits.argmax(dim=-1), pred)
+
+        if self.end_tokens:
+            if self.done is not None:
+                pred = pred.masked_fill(self.done, self.end_tokens[0])
+            is_end = torch.isin(pred, torch.tensor(self.end_tokens, device=pred.device))
+            self.done = is_end if self.done is None else self.done | is_end
+            self._is_done = bool(self.done.all())
+        tokens = torch.cat((tokens, pred.view(tokens.shape[0], 1)), dim=1)
+        return tokens, mems
+
+    def finalize(self, tokens, mems):
+        self._init_cache()
+        return tokens, mems
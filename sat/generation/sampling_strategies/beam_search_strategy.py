@@ -9,10 +9,17 @@
 # here put the import lib
 import torch
 import torch.nn.functional as F
+from sat.model.cached_autoregressive_model import StaticKVCache, PagedKVCache
+from .base_strategy import ngram_banned_mask
 
 class BeamSearchStrategy:
+    '''Batched beam search.
+        The rows of logits/tokens/mems are [num_prompts * num_beams], grouped by prompt.
+        At the first step, the beams of a prompt are expected to be copies of it, only the first one is expanded.
+        sample_candidates: draw the candidates by multinomial over the beam scores instead of topk (the legacy behavior).
+    '''
     def __init__(self, num_beams, length_penalty=1., consider_end=False,
-                end_tokens=[], invalid_slices=[], no_repeat_ngram_size=0, min_tgt_length=0):
+                end_tokens=[], invalid_slices=[], no_repeat_ngram_size=0, min_tgt_length=0, sample_candidates=False):
         self.num_beams = num_beams
         self.length_penalty = length_penalty
         self.end_tokens = end_tokens
@@ -20,96 +27,122 @@ class BeamSearchStrategy:
         self.min_tgt_length = min_tgt_length
         self.invalid_slices = invalid_slices
         self.consider_end = consider_end
+        self.sample_candidates = sample_candidates
         self._init_cache()
 
     def _init_cache(self):
-        self.end_beams = [] # list of LongTensors
-        self.end_beams_penalized_scores = [] # list of LongTensors
-        self.cached_beam_scores = 0 # [batch_size]
-        self.cached_beam_ngram_bans = [{} for i in range(self.num_beams)]
+        self.end_beams = [] # list (num_prompts) of list of LongTensors
+        self.end_beams_penalized_scores = [] # list (num_prompts) of list of floats
+        self.cached_beam_scores = 0 # [num_prompts * num_beams]
+        self.context_length = None # n-grams are banned only in the generated part
         self.is_done = False
-    
-    def _add_end_beams(self, score, beam):
-        score = score / ((5. + len(beam)) / 6) ** self.length_penalty # Magic number for OpenNMT 
-        for i in range(len(self.end_beams), -1, -1):
-            if i == 0 or score < self.end_beams_penalized_scores[i-1]:
-                break
-        self.end_beams.insert(i, beam)
-        self.end_beams_penalized_scores.insert(i, score)
 
-        self.end_beams = self.end_beams[:self.num_beams]
-        self.end_beams_penalized_scores = self.end_beams_penalized_scores[:self.num_beams]
+    def _penalize(self, score, length):
+        return score / ((5. + length) / 6) ** self.length_penalty # Magic number for OpenNMT
+
+    def _add_end_beams(self, penalized_score, beam, prompt_id=0):
+        end_beams, end_scores = self.end_beams[prompt_id], self.end_beams_penalized_scores[prompt_id]
+        for i in range(len(end_beams), -1, -1):
+            if i == 0 or penalized_score < end_scores[i-1]:
+                break
+        end_beams.insert(i, beam)
+        end_scores.insert(i, penalized_score)
+        del end_beams[self.num_beams:], end_scores[self.num_beams:]
 
     def forward(self, logits, tokens, mems):
         batch_size, vocab_size = logits.shape
+        num_beams = self.num_beams
+        assert batch_size % num_beams == 0, 'the batch should be num_prompts * num_beams.'
+        num_prompts = batch_size // num_beams
         seq_len = tokens.shape[-1]
+        device = logits.device
         logits = logits.float()
+        first_step = not isinstance(self.cached_beam_scores, torch.Tensor)
+        if first_step:
+            self.end_beams = [[] for _ in range(num_prompts)]
+            self.end_beams_penalized_scores = [[] for _ in range(num_prompts)]
+            self.context_length = seq_len
         for invalid_slice in self.invalid_slices:
             logits[..., invalid_slice] = -65504
         if self.min_tgt_length > seq_len:
             for end_token in self.end_tokens:
                 logits[..., end_token] = -65504
-        if self.ngram > 0 and seq_len > self.ngram:
-            for i in range(batch_size):
-                ngram_prefix = tokens[i, -(self.ngram-1):].tolist() # TODO ngram=1
-                for banned_index in self.cached_beam_ngram_bans[i].get(tuple(ngram_prefix), []):
-                    logits[i, banned_index] = -65504
-        
+        if self.ngram > 0:
+            logits.masked_fill_(ngram_banned_mask(tokens, self.ngram, vocab_size, start=self.context_length), -65504)
+
         next_token_scores = F.log_softmax(logits, dim=-1) # [batch_size, vocab_size]
-        prev_scores = self.cached_beam_scores
-        if isinstance(self.cached_beam_scores, torch.Tensor):
-            prev_scores = prev_scores[:, None].expand_as(next_token_scores)
-        next_token_scores = next_token_scores + prev_scores
-        
-        next_token_scores = next_token_scores.view(batch_size * vocab_size)
+        if first_step:
+            # the beams of a prompt are identical at first, only expand the first one.
+            prev_scores = torch.full((num_prompts, num_beams), -float('inf'), device=device)
+            prev_scores[:, 0] = 0
+            prev_scores = prev_scores.view(batch_size)
+        else:
+            prev_scores = self.cached_beam_scores
+        next_token_scores = (next_token_scores + prev_scores[:, None]).view(num_prompts, num_beams * vocab_size)
 
-        probs = F.softmax(next_token_scores, dim=0)
-        next_tokens = torch.multinomial(probs, 
-            num_samples=(max(1,len(self.end_tokens))+1) * self.num_beams) # [2*nb]
-        next_token_scores = next_token_scores[next_tokens]
-        next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=0)
-        next_tokens = next_tokens[_indices]
+        num_candidates = (max(1, len(self.end_tokens)) + 1) * num_beams
+        # at the first step only vocab_size candidates are finite, never draw the -inf ones (of the copies)
+        num_candidates = min(num_candidates, vocab_size if first_step else num_beams * vocab_size)
+        if self.sample_candidates:
+            probs = F.softmax(next_token_scores, dim=-1)
+            candidates = torch.multinomial(probs, num_samples=num_candidates) # [num_prompts, num_candidates]
+            candidate_scores = next_token_scores.gather(1, candidates)
+            candidate_scores, _indices = torch.sort(candidate_scores, descending=True, dim=-1)
+            candidates = candidates.gather(1, _indices)
+        else:
+            candidate_scores, candidates = torch.topk(next_token_scores, num_candidates, dim=-1) # sorted
+        candidate_beams = torch.div(candidates, vocab_size, rounding_mode='trunc')
+        candidate_tokens = candidates % vocab_size
 
-        next_indices = torch.div(next_tokens, vocab_size, rounding_mode='trunc')
-        next_tokens = next_tokens % vocab_size
+        # the first num_beams non-end candidates continue,
+        # end candidates ranked before the (num_beams+1)-th non-end one are finished beams.
+        is_end = torch.zeros_like(candidate_tokens, dtype=torch.bool)
+        for end_token in self.end_tokens:
+            is_end |= candidate_tokens == end_token
+        continue_rank = torch.cumsum(~is_end, dim=-1)
+        _, continue_idx = torch.topk(candidate_scores.masked_fill(is_end, -float('inf')), num_beams, dim=-1)
+        continue_idx, _ = continue_idx.sort(dim=-1) # keep the score order, ties are broken as the candidates
+        continue_scores = candidate_scores.gather(1, continue_idx)
 
-        # select out end beams or continue beams
-        if mems.shape[1] < batch_size:
-            mems = mems.expand(-1, batch_size, -1, -1)
-        beam_continue = []
-        scores_continue = []
-        bans_continue = []
-        mems_contiue = []
-        for i in range(len(next_tokens)):
-            beam = torch.cat((tokens[next_indices[i]], next_tokens[i:i+1]))
-            if int(next_tokens[i]) in self.end_tokens:
-                self._add_end_beams(next_token_scores[i], beam)
-            elif len(beam_continue) < self.num_beams:
-                beam_continue.append(beam)
-                mems_contiue.append(mems[:, next_indices[i]])
-                # update caches
-                scores_continue.append(next_token_scores[i])
-                if self.ngram > 0:
-                    bans = self.cached_beam_ngram_bans[next_indices[i]].copy()
-                    ngram_prefix = tuple(tokens[next_indices[i], -(self.ngram-1):].tolist()) # TODO ngram=1
-                    bans[ngram_prefix] = bans.get(ngram_prefix, tuple()) + (next_tokens[i],)
-                    bans_continue.append(bans)
-            else:
-                break
-        tokens = torch.stack(beam_continue)
-        mems = torch.stack(mems_contiue, dim=1)
-        self.cached_beam_scores = torch.tensor(scores_continue, device=logits.device)
-        self.cached_beam_ngram_bans = bans_continue
+        prompt_offsets = torch.arange(num_prompts, device=device)[:, None] * num_beams
+        src_rows = (candidate_beams.gather(1, continue_idx) + prompt_offsets).view(batch_size)
+        new_tokens = candidate_tokens.gather(1, continue_idx).view(batch_size, 1)
+
+        end_mask = is_end & (continue_rank <= num_beams)
+        if end_mask.any():
+            end_rows = candidate_beams + prompt_offsets
+            penalized = self._penalize(candidate_scores, seq_len + 1).tolist()
+            for p, c in end_mask.nonzero().tolist():
+                beam = torch.cat((tokens[end_rows[p, c]], candidate_tokens[p, c:c+1]))
+                self._add_end_beams(penalized[p][c], beam, prompt_id=p)
+
+        # reorder in batch
+        if tokens.shape[0] < batch_size:
+            tokens = tokens.expand(batch_size, -1)
+        tokens = torch.cat((tokens.index_select(0, src_rows), new_tokens), dim=1)
+        if isinstance(mems, (StaticKVCache, PagedKVCache)):
+            mems = mems.reorder_(src_rows)
+        elif mems is not None:
+            if mems.shape[1] < batch_size:
+                mems = mems.expand(-1, batch_size, -1, -1)
+            mems = mems.index_select(1, src_rows)
+        self.cached_beam_scores = continue_scores.view(batch_size)
 
         # TODO is_done
         return tokens, mems
 
     def finalize(self, tokens, mems):
         if self.consider_end:
-            for i in range(tokens.shape[0]):
-                self._add_end_beams(self.cached_beam_scores[i], tokens[i])
+            num_prompts = tokens.shape[0] // self.num_beams
+            if not self.end_beams:
+                self.end_beams = [[] for _ in range(num_prompts)]
+                self.end_beams_penalized_scores = [[] for _ in range(num_prompts)]
+            if isinstance(self.cached_beam_scores, torch.Tensor):
+                penalized = self._penalize(self.cached_beam_scores, tokens.shape[-1]).tolist()
+                for i in range(tokens.shape[0]):
+                    self._add_end_beams(penalized[i], tokens[i], prompt_id=i // self.num_beams)
             mems = None
-            ret = self.end_beams
+            ret = self.end_beams[0] if num_prompts == 1 else self.end_beams
         else:
             ret = tokens
         self._init_cache()
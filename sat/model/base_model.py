@@ -23,7 +23,7 @@ from sat.model.transformer import BaseTransformer, standard_attention
 from sat import update_args_with_file
 from sat.training.deepspeed_training import load_checkpoint, get_model
 
-from sat.transformer_defaults import HOOKS_DEFAULT
+from sat.transformer_defaults import HOOKS_DEFAULT, HookPlan, sdpa_attention
 from sat.resources import auto_create
 
 def non_conflict(func):
@@ -42,9 +42,19 @@ def replacable(func):
     func.replacable = True
     return func
 
+def sdpa_compatible(func):
+    '''mark a non_conflict attention_fn as compatible with sdpa_attention,
+    i.e. it only passes binary masks, and scores are not needed, to its old_impl.
+    If all the attention_fn hooks are marked, the default is replaced by sdpa_attention.
+    e.g. CachedAutoregressiveMixin.attention_fn
+    '''
+    func.sdpa_compatible = True
+    return func
+
 class BaseMixin(torch.nn.Module):
     non_conflict = non_conflict
     replacable = replacable
+    sdpa_compatible = sdpa_compatible
     def __init__(self):
         super(BaseMixin, self).__init__()
         # define new params
@@ -74,6 +84,10 @@ class BaseMixin(torch.nn.Module):
 
 
 class BaseModel(torch.nn.Module):
+    # opt-in, e.g. `model.use_sdpa = True; model.collect_hooks_()`: dispatch to F.scaled_dot_product_attention
+    # when the attention_fn hooks allow, see collect_hooks_. Off by default, the numerics and the dropout rng differ.
+    use_sdpa = False
+
     def __init__(self, args, transformer=None, params_dtype=torch.float, **kwargs):
         super(BaseModel, self).__init__()
         self.mixins = torch.nn.ModuleDict()
@@ -133,15 +147,18 @@ class BaseModel(torch.nn.Module):
 
     def forward(self, *args, **kwargs):
         # update hooks as the current model (overrided forwards)
-        # Attention! the transformer might be shared by multiple models
-        self.transformer.hooks.clear()
-        self.transformer.hooks.update(self.hooks)
+        # Attention! the transformer might be shared by multiple models, refill only if it runs another plan.
+        if self.transformer.hook_plan is not self.hook_plan:
+            self.transformer.hooks.clear()
+            self.transformer.hooks.update(self.hooks)
+            self.transformer.hook_plan = self.hook_plan
         return self.transformer(*args, **kwargs)
 
     def collect_hooks_(self):
         names = list(HOOKS_DEFAULT.keys())
         hooks = {}
         hook_origins = {}
+        attention_wrappers = [] # non_conflict attention_fn hooks, from the innermost
         for name in names:
             if hasattr(self, name):
                 hooks[name] = getattr(self, name)
@@ -164,6 +181,8 @@ class BaseModel(torch.nn.Module):
                         old_origin = hook_origins.get(name, 'default')
                         hooks[name] = partial(getattr(m, name), old_impl=old_impl)
                         hook_origins[name] = mixin_name + ' -> ' + old_origin
+                        if name == 'attention_fn':
+                            attention_wrappers.append(getattr(m, name))
                     elif name in hooks and not hasattr(hooks[name], 'replacable'): # if this hook name is already registered
                         raise ValueError(f'Hook {name} conflicts at {mixin_name} and {hook_origins[name]}.')
                     else: # new hook
@@ -172,8 +191,18 @@ class BaseModel(torch.nn.Module):
                         hooks[name] = getattr(m, name)
                         hook_origins[name] = mixin_name
 
+        # the default attention_fn, possibly wrapped by compatible non_conflict hooks -> rebuild the chain on sdpa.
+        if self.use_sdpa and hook_origins.get('attention_fn', 'default').endswith('default') \
+                and all(getattr(f, 'sdpa_compatible', False) for f in attention_wrappers):
+            impl = sdpa_attention
+            for f in attention_wrappers:
+                impl = partial(f, old_impl=impl)
+            hooks['attention_fn'] = impl
+            hook_origins['attention_fn'] = hook_origins.get('attention_fn', 'default')[:-len('default')] + 'sdpa'
+
         self.hooks = hooks
         self.hook_origins = hook_origins
+        self.hook_plan = HookPlan.build(hooks, self)
         return hooks
 
     def disable_untrainable_params(self):
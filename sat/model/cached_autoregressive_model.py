@@ -13,17 +13,274 @@ import math
 import random
 import torch
 
-from .base_model import BaseModel, BaseMixin, non_conflict
+from .base_model import BaseModel, BaseMixin, non_conflict, sdpa_compatible
 from sat.model.transformer import standard_attention, split_tensor_along_last_dim
 
+class StaticKVCache:
+    '''Preallocated kv cache, can be passed to `filling_sequence` in place of `mems`.
+        k, v: [num_layers, batch_size, num_heads, max_length, head_dim]
+        Each forward writes its new keys/values at `length` in place,
+        and `update_mems` commits them after all the layers are done.
+        Inference only, the cached keys/values are detached.
+    '''
+    def __init__(self, num_layers, batch_size, max_length, num_heads, head_dim, dtype=torch.float, device=torch.device('cpu')):
+        shape = (num_layers, batch_size, num_heads, max_length, head_dim)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.max_length = max_length
+        self.length = 0 # number of committed positions
+        self.pending_length = 0 # number of positions written by the current forward
+        self.compiled_steps = {} # compiled static decode steps on this cache, reused by filling_sequence
+
+    @classmethod
+    def from_model(cls, model, batch_size, max_length):
+        attention = model.transformer.layers[0].attention
+        param = next(model.parameters())
+        return cls(len(model.transformer.layers), batch_size, max_length,
+            attention.num_attention_heads_per_partition, attention.hidden_size_per_attention_head,
+            dtype=param.dtype, device=param.device)
+
+    @property
+    def batch_size(self):
+        return self.k.shape[1]
+
+    def write(self, layer_id, k, v):
+        '''write k, v [b, nh, seq_len, hn] of `layer_id` after the committed positions,
+            return the views of the whole cached k, v including them.
+        '''
+        b, seq_len = k.shape[0], k.shape[2]
+        end = self.length + seq_len
+        if end > self.max_length:
+            raise ValueError(f'StaticKVCache overflow: {end} positions > max_length {self.max_length}.')
+        # b might be 1 at the first forward, broadcast to all the rows.
+        self.k[layer_id, :, :, self.length:end] = k.detach()
+        self.v[layer_id, :, :, self.length:end] = v.detach()
+        self.pending_length = seq_len
+        return self.k[layer_id, :b, :, :end], self.v[layer_id, :b, :, :end]
+
+    def write_at(self, layer_id, k, v, positions):
+        '''static-shape write for the static decode mode (torch.compile / graph capture),
+            write k, v [b, nh, seq_len, hn] of `layer_id` at positions (LongTensor [seq_len]) and
+            return the whole buffers [b, nh, max_length, hn], the positions not written yet must be masked.
+            b might be 1 at the first forward, broadcast to all the rows. `length` is not tracked here.
+        '''
+        b = k.shape[0]
+        self.k[layer_id][:, :, positions] = k.detach()
+        self.v[layer_id][:, :, positions] = v.detach()
+        return self.k[layer_id][:b], self.v[layer_id][:b]
+
+    def commit(self):
+        self.length += self.pending_length
+        self.pending_length = 0
+
+    def reorder_(self, indices):
+        '''reorder the batch dimension in place, e.g. for beam search. indices: LongTensor [batch_size]'''
+        assert len(indices) == self.batch_size
+        # only the committed positions, the rest is overwritten before being read
+        for buf in (self.k, self.v):
+            buf[:, :, :, :self.length].copy_(buf[:, :, :, :self.length].index_select(1, indices))
+        return self
+
+    def reset(self):
+        self.length = 0
+        self.pending_length = 0
+
+
+class PagedKVCache:
+    '''Block-paged kv cache, can be passed to `filling_sequence` in place of `mems`.
+        k, v pool: [num_layers, num_blocks, num_heads, block_size, head_dim]
+        Each sequence owns a block table (list of block ids) and a length, blocks are allocated on demand,
+        so the memory is bounded by the total tokens in flight instead of batch_size * max_length.
+        Forked sequences (e.g. beams) share their prefix blocks, a shared block is copied before written (copy-on-write).
+        `set_batch` decides which sequences are the rows of the next forward.
+        Inference only, the cached keys/values are detached.
+    '''
+    def __init__(self, num_layers, num_blocks, block_size, num_heads, head_dim, dtype=torch.float, device=torch.device('cpu')):
+        shape = (num_layers, num_blocks, num_heads, block_size, head_dim)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.free_blocks = list(range(num_blocks))
+        self.ref_counts = [0] * num_blocks
+        self.block_tables = {} # seq_id -> list of block ids
+        self.seq_lengths = {} # seq_id -> number of committed positions
+        self.batch = []
+        self._next_seq_id = 0
+        self._forward_state = None # slot mapping and gather table of the current forward, shared by all layers
+
+    @classmethod
+    def from_model(cls, model, num_blocks, block_size=16):
+        attention = model.transformer.layers[0].attention
+        param = next(model.parameters())
+        return cls(len(model.transformer.layers), num_blocks, block_size,
+            attention.num_attention_heads_per_partition, attention.hidden_size_per_attention_head,
+            dtype=param.dtype, device=param.device)
+
+    @property
+    def batch_size(self):
+        return len(self.batch)
+
+    @property
+    def length(self):
+        return max((self.seq_lengths[s] for s in self.batch), default=0)
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def blocks_needed(self, num_tokens):
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    # sequence management
+    def add_sequence(self):
+        seq_id = self._next_seq_id
+        self._next_seq_id += 1
+        self.block_tables[seq_id] = []
+        self.seq_lengths[seq_id] = 0
+        return seq_id
+
+    def fork_sequence(self, seq_id):
+        '''a new sequence sharing all the blocks of `seq_id`.'''
+        new_id = self.add_sequence()
+        self.block_tables[new_id] = list(self.block_tables[seq_id])
+        self.seq_lengths[new_id] = self.seq_lengths[seq_id]
+        for block in self.block_tables[new_id]:
+            self.ref_counts[block] += 1
+        return new_id
+
+    def free_sequence(self, seq_id):
+        for block in self.block_tables.pop(seq_id):
+            self._release(block)
+        del self.seq_lengths[seq_id]
+
+    def _allocate(self):
+        if not self.free_blocks:
+            raise RuntimeError(f'PagedKVCache out of blocks ({self.num_blocks} blocks of size {self.block_size}).')
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def _release(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def set_batch(self, seq_ids):
+        self.batch = list(seq_ids)
+        self._forward_state = None
+
+    def reorder_(self, indices):
+        '''replace the batch by forks of its rows at `indices`, e.g. for beam search or expanding one prompt to a batch.'''
+        old_batch = self.batch
+        self.set_batch([self.fork_sequence(old_batch[i]) for i in indices.tolist()])
+        for seq_id in old_batch:
+            self.free_sequence(seq_id)
+        return self
+
+    # forward
+    def _prepare(self, seq_len):
+        '''reserve positions [length, length + seq_len) for each row, with copy-on-write for shared blocks.'''
+        device = self.k.device
+        blocks, offsets = [], []
+        for seq_id in self.batch:
+            table, start = self.block_tables[seq_id], self.seq_lengths[seq_id]
+            if start % self.block_size != 0 and self.ref_counts[table[-1]] > 1:
+                new_block = self._allocate()
+                self.k[:, new_block] = self.k[:, table[-1]]
+                self.v[:, new_block] = self.v[:, table[-1]]
+                self._release(table[-1])
+                table[-1] = new_block
+            while len(table) < self.blocks_needed(start + seq_len):
+                table.append(self._allocate())
+            positions = range(start, start + seq_len)
+            blocks.append([table[p // self.block_size] for p in positions])
+            offsets.append([p % self.block_size for p in positions])
+        kv_length = max(self.seq_lengths[s] for s in self.batch) + seq_len
+        num_gather_blocks = self.blocks_needed(kv_length)
+        gather_table = [self.block_tables[s] + [0] * (num_gather_blocks - len(self.block_tables[s])) for s in self.batch]
+        self._forward_state = (
+            seq_len,
+            torch.tensor(blocks, dtype=torch.long, device=device),
+            torch.tensor(offsets, dtype=torch.long, device=device),
+            torch.tensor([t[:num_gather_blocks] for t in gather_table], dtype=torch.long, device=device),
+            kv_length
+        )
+
+    def write(self, layer_id, k, v):
+        '''write k, v [b, nh, seq_len, hn] of `layer_id` after each row's committed positions,
+            return k, v gathered through the block tables, [b, nh, max(length) + seq_len, hn].
+            Rows shorter than the longest one contain stale positions, which must be masked by the caller.
+        '''
+        b, nh, seq_len, hn = k.shape
+        assert b == self.batch_size, 'call set_batch before the forward.'
+        if layer_id == 0 or self._forward_state is None: # idempotent until commit
+            self._prepare(seq_len)
+        _, blocks, offsets, gather_table, kv_length = self._forward_state
+        self.k[layer_id][blocks, :, offsets] = k.detach().transpose(1, 2)
+        self.v[layer_id][blocks, :, offsets] = v.detach().transpose(1, 2)
+        # [b, num_gather_blocks, nh, block_size, hn] -> [b, nh, num_gather_blocks * block_size, hn]
+        k = self.k[layer_id][gather_table].transpose(1, 2).reshape(b, nh, -1, hn)[:, :, :kv_length]
+        v = self.v[layer_id][gather_table].transpose(1, 2).reshape(b, nh, -1, hn)[:, :, :kv_length]
+        return k, v
+
+    def commit(self, lengths=None):
+        '''lengths: optional list of the real new lengths per row (e.g. right-padded prompts), default all written positions.'''
+        if self._forward_state is None:
+            return
+        seq_len = self._forward_state[0]
+        if lengths is None:
+            lengths = [seq_len] * self.batch_size
+        for seq_id, n in zip(self.batch, lengths):
+            self.seq_lengths[seq_id] += n
+            table = self.block_tables[seq_id]
+            while len(table) > self.blocks_needed(self.seq_lengths[seq_id]):
+                self._release(table.pop())
+        self._forward_state = None
+
+
+class CrossAttentionKVCache:
+    '''k, v of the encoder outputs for each decoder layer, pass it as `cross_kv_cache` to the decoder.
+        They are projected from `encoder_outputs` at the first forward, and reused by the following decoding steps.
+        Only valid for the same encoder_outputs, inference only.
+    '''
+    def __init__(self):
+        self.kv = {} # layer_id -> (k, v) [b, nh, enc_length, hn]
+
+    def __contains__(self, layer_id):
+        return layer_id in self.kv
+
+    def __getitem__(self, layer_id):
+        return self.kv[layer_id]
+
+    def __setitem__(self, layer_id, kv):
+        self.kv[layer_id] = tuple(x.detach() for x in kv)
+
+    def reorder_(self, indices):
+        '''reorder the batch dimension, e.g. for beam search over several encoder inputs. indices: LongTensor'''
+        for layer_id, (k, v) in self.kv.items():
+            if k.shape[0] == 1: # shared by all the rows
+                continue
+            self.kv[layer_id] = (k.index_select(0, indices), v.index_select(0, indices))
+        return self
+
+    def reset(self):
+        self.kv.clear()
+
+
 class CachedAutoregressiveMixin(BaseMixin):
     def __init__(self):
         super().__init__()     
            
+    @sdpa_compatible
     @non_conflict
     def attention_fn(self, q, k, v, mask, dropout_fn, mems=None, cross_attention=False, old_impl=standard_attention,
                      **kw_args):
-        if not cross_attention:
+        if not cross_attention and kw_args.get('cache_positions', None) is not None: # static decode mode
+            k, v = mems.write_at(int(kw_args['layer_id']), k, v, kw_args['cache_positions'])
+        elif not cross_attention and isinstance(mems, (StaticKVCache, PagedKVCache)):
+            k, v = mems.write(int(kw_args['layer_id']), k, v)
+        elif not cross_attention:
             mem = mems[kw_args['layer_id']] if mems is not None else None # 2, batch, head, seqlen, hidden_size
             b, nh, seq_len, hidden_size = k.shape
 
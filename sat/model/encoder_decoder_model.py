@@ -14,6 +14,7 @@ import random
 import torch
 import argparse
 from .base_model import BaseModel, BaseMixin
+from .cached_autoregressive_model import CachedAutoregressiveMixin, CrossAttentionKVCache
 from sat.mpu.mappings import copy_to_model_parallel_region
 from sat import update_args_with_file
 from sat.training.deepspeed_training import load_checkpoint, get_model
@@ -86,6 +87,33 @@ class EncoderDecoderModel(torch.nn.Module):
         decoder_outputs, *mems = self.decode(dec_input_ids, dec_position_ids, dec_attention_mask, encoder_outputs=encoder_outputs, cross_attention_mask=cross_attention_mask, **kw_args)
         return (encoder_outputs, decoder_outputs, *mems)
 
+    @torch.no_grad()
+    def generate(self, enc_input_ids, dec_input_ids, max_new_tokens, strategy, *, enc_position_ids=None,
+                 enc_attention_mask=None, batch_size=1, **kw_args):
+        '''Autoregressive decoding conditioned on one encoder input.
+            The encoder runs once, its outputs are projected to k, v once per decoder layer (CrossAttentionKVCache),
+            and the decoder self-attention is cached incrementally (CachedAutoregressiveMixin, added if missing).
+            enc_input_ids: [1, enc_length]. dec_input_ids: [dec_length] the decoder prompt, e.g. the start token.
+            strategy: e.g. BaseStrategy or BeamSearchStrategy, batch_size: the number of rows (num_beams for beam search).
+            kw_args: passed to filling_sequence, e.g. get_masks_and_position_ids.
+            Returns: the output of filling_sequence, (tokens, mems) or (end_beams, mems) for beam search.
+        '''
+        from sat.generation.autoregressive_sampling import filling_sequence
+        if not any(isinstance(m, CachedAutoregressiveMixin) for m in self.decoder.mixins.values()):
+            self.decoder.add_mixin('auto-regressive', CachedAutoregressiveMixin())
+        enc_length = enc_input_ids.shape[1]
+        if enc_position_ids is None:
+            enc_position_ids = torch.arange(enc_length, device=enc_input_ids.device).unsqueeze(0)
+        if enc_attention_mask is None:
+            enc_attention_mask = torch.ones(1, 1, 1, enc_length, dtype=self.encoder.transformer.word_embeddings.weight.dtype,
+                                            device=enc_input_ids.device)
+        encoder_outputs, *_dumps = self.encoder(enc_input_ids, enc_position_ids, enc_attention_mask)
+        # the batch dim (1) of encoder_outputs, the cached k/v and the mask broadcasts to all the rows,
+        # so they stay valid when the beams are reordered.
+        seq = torch.cat((dec_input_ids, torch.full((max_new_tokens,), -1, dtype=dec_input_ids.dtype, device=dec_input_ids.device)))
+        return filling_sequence(self.decoder, seq, batch_size, strategy=strategy, encoder_outputs=encoder_outputs,
+                                cross_attention_mask=enc_attention_mask, cross_kv_cache=CrossAttentionKVCache(), **kw_args)
+
     @classmethod
     def add_model_specific_args(cls, parser):
         group = parser.add_argument_group('EncoderDecoderModel', 'T5 or Bart')
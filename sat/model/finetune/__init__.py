@@ -1,5 +1,5 @@
 from .mlp_head import MLPHeadMixin
 from .prompt_tuning import PrefixTuningMixin, PTuningV2Mixin
-from .lora import LoRAMixin
+from .lora import LoRAMixin, MultiLoRAMixin, merge_and_remove_lora
 from .adapter import AdapterMixin
 from .ffadd import FFADDMixin
\ No newline at end of file
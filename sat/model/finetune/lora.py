@@ -20,7 +20,9 @@ import torch
 import torch.nn as nn
 from sat.model.transformer import standard_attention
 from sat.model.base_model import BaseModel, BaseMixin, non_conflict
+from sat.transformer_defaults import HOOKS_DEFAULT
 from sat.mpu.utils import split_tensor_along_last_dim
+from sat import mpu
 import torch.nn.functional as F
 
 class LoRAMixin(BaseMixin):
@@ -60,9 +62,47 @@ class LoRAMixin(BaseMixin):
 
 
         self.scaling = self.lora_alpha / self.r
+        self.merged = False
 
+    def _deltas(self, layer_id):
+        '''the weight deltas of this model-parallel partition, (qkv [3 * p, hidden], dense [hidden, p]).
+            The partition of query_key_value is strided, [Q_p; K_p; V_p], the rows p * rank ~ p * (rank + 1) of each.
+        '''
+        lora_layer = self.lora_linear[layer_id]
+        layer = self.transformer.layers[layer_id].attention
+        p = layer.query_key_value.weight.shape[0] // 3
+        part = slice(p * mpu.get_model_parallel_rank(), p * (mpu.get_model_parallel_rank() + 1))
+        qkv = torch.cat([lora_layer[m+"_B"][part].float() @ lora_layer[m+"_A"].float() for m in "QKV"]) * self.scaling
+        dense = (lora_layer["O_B"].float() @ lora_layer["O_A"][:, part].float()) * self.scaling
+        return qkv, dense
+
+    @torch.no_grad()
+    def merge_lora(self):
+        '''fold the LoRA deltas into query_key_value.weight and dense.weight, the forward then skips the LoRA matmuls.
+            For inference only, the LoRA parameters are not trained while merged.
+        '''
+        assert not self.merged, 'LoRA is already merged.'
+        for layer_id in self.layer_range:
+            layer = self.transformer.layers[layer_id].attention
+            qkv, dense = self._deltas(layer_id)
+            layer.query_key_value.weight += qkv.to(layer.query_key_value.weight.dtype)
+            layer.dense.weight += dense.to(layer.dense.weight.dtype)
+        self.merged = True
+
+    @torch.no_grad()
+    def unmerge_lora(self):
+        '''subtract the LoRA deltas merged by merge_lora, e.g. to continue training.'''
+        assert self.merged, 'LoRA is not merged.'
+        for layer_id in self.layer_range:
+            layer = self.transformer.layers[layer_id].attention
+            qkv, dense = self._deltas(layer_id)
+            layer.query_key_value.weight -= qkv.to(layer.query_key_value.weight.dtype)
+            layer.dense.weight -= dense.to(layer.dense.weight.dtype)
+        self.merged = False
 
     def attention_forward(self, hidden_states, mask, layer_id, **kw_args):
+        if self.merged:
+            return HOOKS_DEFAULT['attention_forward'](self, hidden_states, mask, layer_id=layer_id, **kw_args)
         attention_fn = standard_attention
         if 'attention_fn' in self.transformer.hooks:
             attention_fn = self.transformer.hooks['attention_fn']
@@ -98,4 +138,114 @@ class LoRAMixin(BaseMixin):
 
         if self.training:
             output = layer.output_dropout(output)
-        return output
\ No newline at end of file
+        return output
+
+def merge_and_remove_lora(model):
+    '''merge all the LoRAMixins of model into the base weights and delete them, in place.
+        The result is a plain model (no LoRA hooks or parameters), e.g. to export a merged checkpoint:
+            save_checkpoint(iteration, merge_and_remove_lora(model), None, None, args)
+    '''
+    for name, mixin in list(model.mixins.items()):
+        if isinstance(mixin, LoRAMixin):
+            if not mixin.merged:
+                mixin.merge_lora()
+            model.del_mixin(name)
+    return model
+
+
+class MultiLoRAMixin(BaseMixin):
+    '''A bank of up to `max_adapters` LoRAs on one base model, for batched serving of many fine-tunes.
+        Each row of a batch selects its adapter by `adapter_ids` [batch] (-1 for the base model),
+        passed as a kw_arg of the forward, e.g. model(..., adapter_ids=mixin.adapter_ids(['a', None, 'b'])).
+        The deltas are computed by gathered low-rank matmuls (BGMV), so one forward serves mixed adapters.
+        Adapters are copied into preallocated buffers by load_adapter/unload_adapter,
+        which neither rebuild the model nor recollect the hooks. LoRAs of rank <= r are zero-padded.
+        params_dtype: dtype of the bank, it is cast once to the dtype of the model at load_adapter if they differ.
+    '''
+    def __init__(self, hidden_size, layer_num=24, r=8, max_adapters=16, params_dtype=torch.float):
+        super().__init__()
+        self.r = r
+        self.max_adapters = max_adapters
+        # [layer, Q/K/V/O, adapter, ...], not in the state_dict, adapters are loaded at serving time.
+        self.register_buffer('lora_A', torch.zeros(layer_num, 4, max_adapters, r, hidden_size, dtype=params_dtype), persistent=False)
+        self.register_buffer('lora_B', torch.zeros(layer_num, 4, max_adapters, hidden_size, r, dtype=params_dtype), persistent=False)
+        self.register_buffer('scalings', torch.zeros(max_adapters), persistent=False)
+        self.adapters = {} # name -> slot
+
+    @torch.no_grad()
+    def load_adapter(self, name, lora):
+        '''copy the weights of a LoRAMixin `lora` into a free slot. Return the slot.'''
+        assert name not in self.adapters, f'adapter {name} is already loaded.'
+        assert lora.r <= self.r, f'the rank {lora.r} of adapter {name} exceeds {self.r}.'
+        free_slots = sorted(set(range(self.max_adapters)) - set(self.adapters.values()))
+        if not free_slots:
+            raise ValueError(f'all the {self.max_adapters} adapter slots are in use, unload one first.')
+        slot = free_slots[0]
+        dtype = self.transformer.word_embeddings.weight.dtype
+        if self.lora_A.dtype != dtype: # e.g. added after model.half(), not cast again per forward
+            self.lora_A, self.lora_B = self.lora_A.to(dtype), self.lora_B.to(dtype)
+        self.lora_A[:, :, slot].zero_()
+        self.lora_B[:, :, slot].zero_()
+        for layer_id in lora.layer_range:
+            for i, matrix in enumerate("QKVO"):
+                self.lora_A[layer_id, i, slot, :lora.r] = lora.lora_linear[layer_id][matrix+"_A"]
+                self.lora_B[layer_id, i, slot, :, :lora.r] = lora.lora_linear[layer_id][matrix+"_B"]
+        self.scalings[slot] = lora.scaling
+        self.adapters[name] = slot
+        return slot
+
+    def unload_adapter(self, name):
+        slot = self.adapters.pop(name)
+        self.scalings[slot] = 0 # rows still pointing at the slot fall back to the base model
+
+    def adapter_ids(self, names):
+        '''adapter names (None for the base model) -> adapter_ids [batch].'''
+        return torch.tensor([-1 if name is None else self.adapters[name] for name in names],
+                            dtype=torch.long, device=self.scalings.device)
+
+    def _bgmv(self, x, layer_id, matrix, adapter_ids, in_part=slice(None), out_part=slice(None), reduce=False):
+        '''the scaled delta x @ A.T @ B.T [b, s, out] of x [b, s, in], with the adapter of each row.
+            reduce: all-reduce the low-rank x @ A.T, if x is partitioned along in (the input of a RowParallelLinear).
+        '''
+        slots = adapter_ids.clamp(min=0)
+        scale = self.scalings[slots] * (adapter_ids >= 0)
+        # only the slots of the rows are gathered (and cast, a no-op in the model dtype)
+        lora_A = self.lora_A[layer_id, matrix][slots][:, :, in_part].to(x.dtype) # [b, r, in]
+        lora_B = self.lora_B[layer_id, matrix][slots][:, out_part].to(x.dtype) # [b, out, r]
+        xa = torch.bmm(x, lora_A.transpose(1, 2)) * scale[:, None, None].to(x.dtype)
+        if reduce:
+            xa = mpu.reduce_from_model_parallel_region(xa)
+        return torch.bmm(xa, lora_B.transpose(1, 2))
+
+    def attention_forward(self, hidden_states, mask, layer_id, adapter_ids=None, **kw_args):
+        if adapter_ids is None:
+            return HOOKS_DEFAULT['attention_forward'](self, hidden_states, mask, layer_id=layer_id, **kw_args)
+        attention_fn = standard_attention
+        if 'attention_fn' in self.transformer.hooks:
+            attention_fn = self.transformer.hooks['attention_fn']
+        layer = self.transformer.layers[layer_id].attention
+        layer_id = int(layer_id)
+        if adapter_ids.shape[0] != hidden_states.shape[0]:
+            adapter_ids = adapter_ids.expand(hidden_states.shape[0])
+
+        # the same partitions as LoRAMixin._deltas
+        p = layer.query_key_value.weight.shape[0] // 3
+        part = slice(p * mpu.get_model_parallel_rank(), p * (mpu.get_model_parallel_rank() + 1))
+        mixed_raw_layer = layer.query_key_value(hidden_states)
+        mixed_layers = list(split_tensor_along_last_dim(mixed_raw_layer, 3))
+        for i in range(3):
+            mixed_layers[i] = mixed_layers[i] + self._bgmv(hidden_states, layer_id, i, adapter_ids, out_part=part)
+
+        dropout_fn = layer.attention_dropout if self.training else None
+        query_layer, key_layer, value_layer = [layer._transpose_for_scores(x) for x in mixed_layers]
+        context_layer = attention_fn(query_layer, key_layer, value_layer, mask, dropout_fn, **kw_args)
+
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (layer.hidden_size_per_partition,)
+        context_layer = context_layer.view(*new_context_layer_shape)
+        output = layer.dense(context_layer)
+        output = output + self._bgmv(context_layer, layer_id, 3, adapter_ids, in_part=part, reduce=True)
+
+        if self.training:
+            output = layer.output_dropout(output)
+        return output
@@ -14,7 +14,7 @@ import random
 import torch
 
 from sat.model.transformer import standard_attention
-from sat.model.base_model import BaseModel, BaseMixin, non_conflict
+from sat.model.base_model import BaseModel, BaseMixin, non_conflict, sdpa_compatible
 
 
 class PrefixTuningMixin(BaseMixin):
@@ -26,6 +26,7 @@ class PrefixTuningMixin(BaseMixin):
         ])
         self.prefix_len = prefix_len
 
+    @sdpa_compatible
     @non_conflict
     def attention_fn(self, q, k, v, mask, dropout_fn, old_impl=standard_attention, **kw_args):
         prefix_k, prefix_v = self.prefix[kw_args['layer_id']]
@@ -13,6 +13,42 @@ import math
 import random
 
 import torch
-from .base_model import BaseMixin
+from .base_model import BaseMixin, non_conflict, sdpa_compatible
 from .cached_autoregressive_model import CachedAutoregressiveMixin
 from .finetune import *
+from sat.transformer_defaults import standard_attention, chunked_attention, varlen_attention
+
+class ChunkedAttentionMixin(BaseMixin):
+    '''replace standard_attention by chunked_attention, to save memory for long sequences.
+        Add it before the non_conflict attention_fn mixins (e.g. CachedAutoregressiveMixin), they will wrap it.
+    '''
+    def __init__(self, chunk_size=1024, is_causal=False):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.is_causal = is_causal
+
+    def attention_fn(self, q, k, v, mask, dropout_fn, **kw_args):
+        kw_args.update(chunk_size=self.chunk_size, is_causal=self.is_causal)
+        return chunked_attention(q, k, v, mask, dropout_fn, **kw_args)
+
+
+class PackedAttentionMixin(BaseMixin):
+    '''attend within the documents of packed sequences, if the forward is given `cu_seqlens`
+        (see sat.data_utils.PackingCollator), by varlen_attention. Otherwise it falls back to the old attention_fn.
+    '''
+    def __init__(self, is_causal=True):
+        super().__init__()
+        self.is_causal = is_causal
+        self._bounds = (None, None) # (cu_seqlens tensor, list), to sync once per forward instead of per layer
+
+    @sdpa_compatible
+    @non_conflict
+    def attention_fn(self, q, k, v, mask, dropout_fn, old_impl=standard_attention, cu_seqlens=None, **kw_args):
+        if cu_seqlens is None:
+            return old_impl(q, k, v, mask, dropout_fn, **kw_args)
+        if isinstance(cu_seqlens, torch.Tensor):
+            if self._bounds[0] is not cu_seqlens:
+                self._bounds = (cu_seqlens, cu_seqlens.tolist())
+            cu_seqlens = self._bounds[1]
+        kw_args.pop('is_causal', None)
+        return varlen_attention(q, k, v, mask, dropout_fn, cu_seqlens=cu_seqlens, is_causal=self.is_causal, **kw_args)
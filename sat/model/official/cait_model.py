@@ -6,6 +6,7 @@ from sat.model.base_model import BaseMixin, BaseModel, non_conflict
 from sat.model.official.vit_model import ViTModel, ClsMixin
 from sat.model.mixins import BaseMixin
 from sat import mpu
+from sat.transformer_defaults import apply_attention_mask
 
 class AttnMixin(BaseMixin):
     def __init__(self, num_heads, num_layers):
@@ -25,10 +26,7 @@ class AttnMixin(BaseMixin):
         
         attention_scores = self.proj_l[kwargs['layer_id']](attention_scores.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
 
-        if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
-            # if auto-regressive, skip
-            attention_scores = torch.mul(attention_scores, attention_mask) - \
-                            10000.0 * (1.0 - attention_mask)
+        attention_scores = apply_attention_mask(attention_scores, attention_mask, kwargs.get('mask_info'))
 
         attention_probs = F.softmax(attention_scores, dim=-1)
 
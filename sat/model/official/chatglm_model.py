@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from sat.model.base_model import BaseMixin, BaseModel
 import math
 from sat import mpu
+from sat.transformer_defaults import apply_attention_mask
 from sat.mpu.utils import split_tensor_along_last_dim
 
 @torch.jit.script
@@ -47,10 +48,7 @@ class ChatGLMAttnMixin(BaseMixin):
         if log_attention_weights is not None:
             attention_scores += log_attention_weights
 
-        if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
-            # if auto-regressive, skip
-            attention_scores = torch.mul(attention_scores, attention_mask) - \
-                            10000.0 * (1.0 - attention_mask)
+        attention_scores = apply_attention_mask(attention_scores, attention_mask, kwargs.get('mask_info'))
         attention_scores = attention_scores.float()
         attention_scores = attention_scores * query_key_layer_scaling_coeff
         attention_probs = F.softmax(attention_scores, dim=-1)
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from sat.model.base_model import BaseMixin, BaseModel
 import math
 from sat import mpu
+from sat.transformer_defaults import apply_attention_mask
 from transformers.activations import ACT2FN
 
 gelu = ACT2FN["gelu_new"]
@@ -44,10 +45,7 @@ class GPT2AttnMixin(BaseMixin):
         if log_attention_weights is not None:
             attention_scores += log_attention_weights
 
-        if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
-            # if auto-regressive, skip
-            attention_scores = torch.mul(attention_scores, attention_mask) - \
-                            10000.0 * (1.0 - attention_mask)
+        attention_scores = apply_attention_mask(attention_scores, attention_mask, kwargs.get('mask_info'))
 
         attention_probs = F.softmax(attention_scores, dim=-1)
 
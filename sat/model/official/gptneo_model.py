@@ -63,7 +63,12 @@ class GPTNeoAttentionMixin(BaseMixin):
         if log_attention_weights is not None:
             attention_scores += log_attention_weights
 
-        if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
+        mask_info = kwargs.get('mask_info')
+        if mask_info is not None and mask_info.mask is attention_mask and mask_info.binary:
+            # classified once per forward, a causal mask is already covered by the bias above
+            if mask_info.kind not in ('full', 'causal'):
+                attention_scores = attention_scores.masked_fill(mask_info.masked_out, mask_value)
+        elif not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
             # if auto-regressive, skip
             attention_scores = torch.where(attention_mask.to(attention_scores.device), attention_scores, mask_value)
             # attention_scores = torch.mul(attention_scores, attention_mask) - \
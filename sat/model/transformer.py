@@ -32,7 +32,7 @@ from sat.mpu.utils import divide, sqrt, scaled_init_method, unscaled_init_method
 from sat.mpu.utils import split_tensor_along_last_dim
 from sat.ops import LayerNorm
 
-from sat.transformer_defaults import HOOKS_DEFAULT, standard_attention
+from sat.transformer_defaults import HOOKS_DEFAULT, HookPlan, MaskInfo, is_compiling, standard_attention
 
 
 class SelfAttention(torch.nn.Module):
@@ -369,6 +369,9 @@ class BaseTransformer(torch.nn.Module):
         self.max_sequence_length = max_sequence_length
         self.layernorm_order = layernorm_order
         self.hooks = copy.copy(hooks)  # hooks will be updated each forward
+        self.hook_plan = None # HookPlan of self.hooks, set by BaseModel.forward
+        self._layer_ids = [] # cached layer_id tensors
+        self.attention_paths = {} # layer_id -> the last attention path, see MaskInfo
         object.__setattr__(self, 'transformer', self) # to give the default hooks the same api as outer hooks
 
         # create embedding parameters
@@ -433,22 +436,24 @@ class BaseTransformer(torch.nn.Module):
             )  # None means full attention
         assert len(attention_mask.shape) == 2 or \
                len(attention_mask.shape) == 4 and attention_mask.shape[1] == 1
+        # classify the mask once for all the layers, see MaskInfo
+        if kw_args.get('mask_info', None) is None:
+            kw_args['mask_info'] = MaskInfo(attention_mask)
+        kw_args['mask_info'].attention_paths = self.attention_paths
 
         # initial output_cross_layer might be generated by word/position_embedding_forward
         output_cross_layer = {}
 
+        # resolved hooks, standalone transformers (without BaseModel) resolve them per forward
+        plan = self.hook_plan if self.hook_plan is not None else HookPlan.build(self.hooks, self)
+
         # embedding part
-        if 'word_embedding_forward' in self.hooks:
-            hidden_states = self.hooks['word_embedding_forward'](input_ids, output_cross_layer=output_cross_layer, **kw_args)
-        else:  # default
-            hidden_states = HOOKS_DEFAULT['word_embedding_forward'](self, input_ids, output_cross_layer=output_cross_layer,**kw_args)
+        hidden_states = plan.word_embedding_forward(input_ids, output_cross_layer=output_cross_layer, **kw_args)
 
-        if 'position_embedding_forward' in self.hooks:
-            position_embeddings = self.hooks['position_embedding_forward'](position_ids, output_cross_layer=output_cross_layer, **kw_args)
-        else:
+        if plan.default_position_embedding:
             assert len(position_ids.shape) <= 2
             assert position_ids.shape[-1] == hidden_states.shape[1], (position_ids.shape, hidden_states.shape)
-            position_embeddings = HOOKS_DEFAULT['position_embedding_forward'](self, position_ids, output_cross_layer=output_cross_layer, **kw_args)
+        position_embeddings = plan.position_embedding_forward(position_ids, output_cross_layer=output_cross_layer, **kw_args)
         if position_embeddings is not None:
             hidden_states = hidden_states + position_embeddings
         hidden_states = self.embedding_dropout(hidden_states)
@@ -473,8 +478,8 @@ class BaseTransformer(torch.nn.Module):
                     output_per_layers_part = []
                     for i, layer in enumerate(layers_):
                         output_this_layer_obj, output_cross_layer_obj = {}, {}
-                        if 'layer_forward' in self.hooks:
-                            layer_ret = self.hooks['layer_forward'](
+                        if plan.layer_forward is not None:
+                            layer_ret = plan.layer_forward(
                                 x_, mask, layer_id=layer.layer_id,
                                 **kw_args, position_ids=position_ids, **output_cross_layer,
                                 output_this_layer=output_this_layer_obj,
@@ -543,21 +548,25 @@ class BaseTransformer(torch.nn.Module):
                 l += chunk_length
         else:
             output_this_layer = []
-            for i, layer in enumerate(self.layers):
+            if len(self._layer_ids) != len(self.layers):
+                self._layer_ids = [torch.tensor(i) for i in range(len(self.layers))]
+            # python ints under torch.compile (as in the checkpointing path), indexing by a tensor breaks the graph
+            layer_ids = range(len(self.layers)) if is_compiling() else self._layer_ids
+            for layer, layer_id in zip(self.layers, layer_ids):
                 args = [hidden_states, attention_mask]
 
                 output_this_layer_obj, output_cross_layer_obj = {}, {}
 
-                if 'layer_forward' in self.hooks: # customized layer_forward
-                    layer_ret = self.hooks['layer_forward'](*args,
-                        layer_id=torch.tensor(i),
+                if plan.layer_forward is not None: # customized layer_forward
+                    layer_ret = plan.layer_forward(*args,
+                        layer_id=layer_id,
                         **kw_args,
                         position_ids=position_ids,
                         **output_cross_layer,
                         output_this_layer=output_this_layer_obj, output_cross_layer=output_cross_layer_obj
                     )
                 else:
-                    layer_ret = layer(*args, layer_id=torch.tensor(i), **kw_args, **output_cross_layer,
+                    layer_ret = layer(*args, layer_id=layer_id, **kw_args, **output_cross_layer,
                         output_this_layer=output_this_layer_obj, output_cross_layer=output_cross_layer_obj)
                 if isinstance(layer_ret, tuple):
                     layer_ret = layer_ret[0] # for legacy API
@@ -574,10 +583,7 @@ class BaseTransformer(torch.nn.Module):
             logits = hidden_states
 
         logits = copy_to_model_parallel_region(logits)
-        if 'final_forward' in self.hooks:
-            logits_parallel = self.hooks['final_forward'](logits, **kw_args)
-        else:
-            logits_parallel = HOOKS_DEFAULT['final_forward'](self, logits, **kw_args)
+        logits_parallel = plan.final_forward(logits, **kw_args)
 
         if not self.parallel_output:
             logits_parallel = gather_from_model_parallel_region(logits_parallel)
@@ -18,6 +18,7 @@ import torch
 from .initialize import get_model_parallel_group
 from .initialize import get_model_parallel_rank
 from .initialize import get_model_parallel_src_rank
+from .initialize import get_model_parallel_world_size
 
 
 _MAX_DATA_DIM = 5
@@ -82,7 +83,19 @@ def broadcast_data(keys, data, datatype):
         data: data dictionary of string keys and cpu tensor values.
         datatype: torch data type of all tensors in data associated
                   with keys.
+
+    With model parallel size 1 nothing is broadcast, the tensors are only
+    moved to GPU: the outputs alias the inputs that are already contiguous
+    GPU tensors (e.g. prefetched by DevicePrefetcher) instead of being
+    fresh copies, do not modify them in place if the inputs are reused.
     """
+    if get_model_parallel_world_size() == 1:
+        # the same checks as the broadcast path
+        for key in keys:
+            assert data[key].dim() < _MAX_DATA_DIM, 'you should increase MAX_DATA_DIM'
+        _check_data_types(keys, data, datatype)
+        return {key: data[key].contiguous().cuda(non_blocking=True) for key in keys}
+
     # Build (key, size) and (key, number of elements) dictionaries along
     # with the total number of elements on all ranks.
     key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys,
@@ -0,0 +1,2 @@
+from .quantized_linear import quantize, quantize_weight, dequantize_weight, QuantizedColumnParallelLinear, QuantizedRowParallelLinear
+from .cpu_inference import prepare_cpu_inference, cpu_forward, to_torch_modules
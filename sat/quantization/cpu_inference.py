@@ -0,0 +1,62 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   cpu_inference.py
+'''
+
+# here put the import lib
+import torch
+
+from sat import mpu
+from sat.mpu.layers import ColumnParallelLinear, RowParallelLinear
+
+
+def to_torch_modules(model):
+    '''replace the SAT-specific modules of model by their plain torch equivalents, in place:
+        ColumnParallelLinear / RowParallelLinear -> torch.nn.Linear (only valid for model-parallel size 1, where they are plain linears),
+        apex FusedLayerNorm (the sat.ops.LayerNorm if apex is installed, cuda only) -> torch.nn.LayerNorm.
+    '''
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) in (ColumnParallelLinear, RowParallelLinear):
+                assert mpu.get_model_parallel_world_size() == 1, 'only model-parallel size 1 can be converted to torch.nn.Linear.'
+                linear = torch.nn.Linear(child.input_size, child.output_size, bias=child.bias is not None,
+                                         device=child.weight.device, dtype=child.weight.dtype)
+                linear.weight = child.weight
+                if child.bias is not None:
+                    linear.bias = child.bias
+                setattr(module, name, linear)
+            elif type(child).__name__ == 'LayerNorm' and not isinstance(child, torch.nn.LayerNorm) \
+                    and hasattr(child, 'normalized_shape'):
+                if getattr(child, 'pb_relax', False):
+                    continue # the rescaling before the norm is kept with the original module
+                layernorm = torch.nn.LayerNorm(child.normalized_shape, eps=child.eps, elementwise_affine=child.elementwise_affine,
+                                               device=child.weight.device, dtype=child.weight.dtype)
+                if child.elementwise_affine:
+                    layernorm.weight, layernorm.bias = child.weight, child.bias
+                setattr(module, name, layernorm)
+    return model
+
+
+def prepare_cpu_inference(model, num_threads=None, quantize=True):
+    '''convert a loaded model for inference on CPU, in place when possible. Return the converted model.
+        The model is moved to fp32 on CPU, switched to eval mode with all the dropout probabilities set to 0,
+        its parallel linears and layernorms are replaced by torch modules, and (if quantize) all the nn.Linear
+        are dynamically quantized to int8 (int8 weights, activations quantized per batch) by torch.ao.quantization.
+        The word embeddings (and the tied output projection) stay in fp32.
+        num_threads: intra-op threads of torch, default unchanged.
+        Run it with `cpu_forward(model, ...)`, or under `torch.inference_mode()`.
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = to_torch_modules(model.float().cpu()).eval()
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+@torch.inference_mode()
+def cpu_forward(model, *args, **kwargs):
+    return model(*args, **kwargs)
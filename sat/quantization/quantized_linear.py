@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   quantized_linear.py
+'''
+
+# here put the import lib
+import torch
+
+from sat.mpu.layers import ColumnParallelLinear, RowParallelLinear
+
+
+def pack_int4(q):
+    '''q: int8 [out, in] in [-8, 7] -> uint8 [out, in // 2], two values per byte (the even index in the low nibble).'''
+    u = (q & 0xF).to(torch.uint8)
+    return u[:, 0::2] | (u[:, 1::2] << 4)
+
+def unpack_int4(packed):
+    '''inverse of pack_int4, uint8 [out, in // 2] -> int8 [out, in].'''
+    nibbles = torch.stack((packed & 0xF, packed >> 4), dim=-1).view(packed.shape[0], -1)
+    return (nibbles.to(torch.int8) ^ 8) - 8
+
+def quantize_weight(weight, bits=8, group_size=None):
+    '''symmetric round-to-nearest quantization of weight [out, in],
+        with one scale per output channel (group_size None), or per group of `group_size` consecutive inputs.
+        return: qweight (int8 [out, in], or uint8 [out, in // 2] packed for 4 bits), scale [out, in // group_size]
+    '''
+    assert bits in (4, 8), 'only 8 or 4 bits are supported.'
+    out_features, in_features = weight.shape
+    group_size = group_size or in_features
+    assert in_features % group_size == 0, f'group_size {group_size} must divide the input size {in_features}.'
+    w = weight.float().view(out_features, in_features // group_size, group_size)
+    qmax = 2 ** (bits - 1) - 1
+    scale = w.abs().amax(dim=-1).clamp_(min=1e-8) / qmax
+    q = torch.round(w / scale[..., None]).clamp_(-qmax, qmax).to(torch.int8).view(out_features, in_features)
+    if bits == 4:
+        q = pack_int4(q)
+    return q, scale.to(weight.dtype)
+
+def dequantize_weight(qweight, scale, bits=8):
+    '''inverse of quantize_weight, in the dtype of scale.'''
+    q = unpack_int4(qweight) if bits == 4 else qweight
+    out_features, num_groups = scale.shape
+    w = q.view(out_features, num_groups, -1).to(scale.dtype) * scale[..., None]
+    return w.view(out_features, -1)
+
+
+class QuantizedLinearBase(torch.nn.Module):
+    '''Weight-only quantized replacement of a ColumnParallelLinear / RowParallelLinear, keeping its partition.
+        The weight is stored as `weight_q` and `weight_scale` buffers (in the state_dict),
+        and `weight` is dequantized on the fly, so the forward (and the model-parallel communication)
+        of the original class is unchanged.
+    '''
+    def __init__(self, layer, bits=8, group_size=None, empty_init=False):
+        # the original __init__ would allocate and initialize a full precision weight, only copy its attributes.
+        torch.nn.Module.__init__(self)
+        for name, value in vars(layer).items():
+            if not name.startswith('_') and name not in ('training', 'master_weight'):
+                setattr(self, name, value)
+        self.bits = bits
+        self.group_size = group_size
+        weight = layer.weight.data
+        if empty_init: # the quantized weights will be loaded
+            out_features, in_features = weight.shape
+            num_groups = in_features // (group_size or in_features)
+            qweight = torch.zeros(out_features, in_features if bits == 8 else in_features // 2,
+                                  dtype=torch.int8 if bits == 8 else torch.uint8, device=weight.device)
+            scale = torch.zeros(out_features, num_groups, dtype=weight.dtype, device=weight.device)
+        else:
+            qweight, scale = quantize_weight(weight, bits, group_size)
+        self.register_buffer('weight_q', qweight)
+        self.register_buffer('weight_scale', scale)
+        self.register_parameter('bias', layer.bias)
+        self.train(layer.training)
+
+    @property
+    def weight(self):
+        return dequantize_weight(self.weight_q, self.weight_scale, self.bits)
+
+    def extra_repr(self):
+        return f'bits={self.bits}, group_size={self.group_size}'
+
+
+class QuantizedColumnParallelLinear(QuantizedLinearBase, ColumnParallelLinear):
+    pass
+
+class QuantizedRowParallelLinear(QuantizedLinearBase, RowParallelLinear):
+    pass
+
+
+def quantize(model, bits=8, group_size=None, empty_init=False):
+    '''replace all the ColumnParallelLinear and RowParallelLinear of model by weight-only quantized ones, in place.
+        group_size: None for per-channel scales, else the number of inputs sharing a scale (per partition).
+        empty_init: only change the structure, e.g. before loading a quantized checkpoint.
+        The config is recorded as model.quantization, and saved into the checkpoints by model_io.
+    '''
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is ColumnParallelLinear:
+                setattr(module, name, QuantizedColumnParallelLinear(child, bits, group_size, empty_init))
+            elif type(child) is RowParallelLinear:
+                setattr(module, name, QuantizedRowParallelLinear(child, bits, group_size, empty_init))
+    model.quantization = {'bits': bits, 'group_size': group_size}
+    return model
@@ -36,7 +36,7 @@ from .utils import print_rank_0
 from .utils import get_sample_writer
 
 from sat import mpu
-from sat.data_utils import make_loaders
+from sat.data_utils import make_loaders, DevicePrefetcher
 from sat.ops import LayerNorm
 from sat.arguments import set_random_seed, initialize_distributed
 
@@ -65,6 +65,9 @@ def training_main(args, model_cls, forward_step_function, create_dataset_functio
 
     # Data stuff.
     train_data, val_data, test_data = make_loaders(args, hooks['create_dataset_function'], collate_fn=collate_fn)
+    for data_loader in (train_data, val_data, test_data):
+        if isinstance(data_loader, DevicePrefetcher): # report the time waiting for the data
+            data_loader.timers = timers
     if args.epochs:
         args.train_iters = len(train_data)
         if args.eval_interval is None:
@@ -472,9 +475,17 @@ def evaluate(data_iterator, model, eval_iters, args, timers, split, verbose=Fals
                     metrics_total[name] = []
                 is_scalar[name] = True if len(metrics[name].shape)==0 else False
                 shape = list(metrics[name].shape)
-                if not is_scalar[name] and is_last and metrics[name].shape[0] != last_shape[0]:
+                pad_to = last_shape[0] if is_last else shape[0]
+                sizes = None
+                if not is_scalar[name] and getattr(args, 'max_tokens', None) is not None:
+                    # token-budget batches differ in size across ranks, pad them to the largest and trim after gathering.
+                    sizes = [torch.zeros(1, dtype=torch.long, device=metrics[name].device) for _ in range(args.world_size)]
+                    torch.distributed.all_gather(sizes, torch.tensor([shape[0]], dtype=torch.long, device=metrics[name].device))
+                    sizes = [int(size) for size in sizes]
+                    pad_to = max(sizes)
+                if not is_scalar[name] and metrics[name].shape[0] != pad_to:
                     # pad tensor's first dim to args.batch_size
-                    metrics[name] = torch.concat([metrics[name], torch.zeros([last_shape[0]-metrics[name].shape[0]] + shape[1:], dtype=metrics[name].dtype, device=metrics[name].device)])
+                    metrics[name] = torch.concat([metrics[name], torch.zeros([pad_to-metrics[name].shape[0]] + shape[1:], dtype=metrics[name].dtype, device=metrics[name].device)])
                 if rank==0:
                     metrics_gathered = [torch.zeros_like(metrics[name], dtype=metrics[name].dtype, device=metrics[name].device) for _ in range(args.world_size)]
                 else:
@@ -486,7 +497,9 @@ def evaluate(data_iterator, model, eval_iters, args, timers, split, verbose=Fals
                 if rank==0:
                     gathered_len = len(metrics_gathered) if not is_last else len(metrics_gathered) - drop_number
                     for i in range(gathered_len):
-                        if is_scalar[name] or not is_last:
+                        if sizes is not None:
+                            metrics_total[name].append(metrics_gathered[i][:sizes[i]].data.cpu())
+                        elif is_scalar[name] or not is_last:
                             metrics_total[name].append(metrics_gathered[i].data.cpu())
                         else:
                             metrics_total[name].append(metrics_gathered[i][:last_shape[i]].data.cpu())
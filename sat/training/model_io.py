@@ -60,7 +60,10 @@ def save_checkpoint(iteration, model, optimizer,
             save_ds_checkpoint(iteration, model, lr_scheduler, args)
     elif args.mode == 'inference':
         os.makedirs(os.path.join(args.save, str(iteration)), exist_ok=True)
-        torch.save({'module': model.state_dict()}, os.path.join(args.save, str(iteration), 'mp_rank_00_model_states.pt'))
+        sd = {'module': model.state_dict()}
+        if getattr(model, 'quantization', None) is not None: # see sat.quantization.quantize
+            sd['quantization'] = model.quantization
+        torch.save(sd, os.path.join(args.save, str(iteration), 'mp_rank_00_model_states.pt'))
     else:
         raise ValueError("training without deepspeed is not supported.")
     # Wait so everyone is done (necessary)
@@ -107,6 +110,8 @@ def save_ds_checkpoint(iteration, model, lr_scheduler, args):
         sd['np_rng_state'] = np.random.get_state()
         sd['torch_rng_state'] = torch.get_rng_state()
         sd['cuda_rng_state'] = torch.cuda.get_rng_state()
+    if getattr(model.module, 'quantization', None) is not None:
+        sd['quantization'] = model.module.quantization
     save_ds_checkpoint_no_optim(model, args.save, str(iteration), client_state=sd)
 
 
@@ -186,6 +191,12 @@ def load_checkpoint(model, args, load_path=None, prefix=''):
     else: # inference without deepspeed
         module = model
 
+    if sd.get('quantization') is not None and getattr(module, 'quantization', None) is None:
+        # a quantized checkpoint, quantize the structure before loading
+        from sat.quantization import quantize
+        print_rank_0(f'Loading a quantized checkpoint: {sd["quantization"]}.')
+        quantize(module, empty_init=True, **sd['quantization'])
+
     # only load module, other hyperparameters are just for recording.
     missing_keys, unexpected_keys = module.load_state_dict(sd['module'], strict=False)
     if len(unexpected_keys) > 0:
@@ -81,6 +81,11 @@ class Timers:
             self.elapsed_ += (time.time() - self.start_time)
             self.started_ = False
 
+        def add(self, seconds):
+            """Add a time measured elsewhere, skipped while the timer runs (then it is measured already)."""
+            if not self.started_:
+                self.elapsed_ += seconds
+
         def reset(self):
             """Reset timer."""
             self.elapsed_ = 0.0
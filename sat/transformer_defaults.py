@@ -9,6 +9,9 @@
 
 import math
 import copy
+import logging
+from functools import partial
+from collections import namedtuple
 import torch
 import torch.nn.functional as F
 
@@ -22,6 +25,87 @@ from deepspeed.runtime.activation_checkpointing.checkpointing import checkpoint
 from sat.mpu.utils import divide, sqrt, scaled_init_method, unscaled_init_method, gelu
 from sat.mpu.utils import split_tensor_along_last_dim
 
+def is_compiling():
+    '''whether traced by torch.compile, to keep python-side bookkeeping out of the graph.'''
+    return hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling') and torch.compiler.is_compiling()
+
+class MaskInfo:
+    '''Classification of an attention mask (1 or True = attend), done once per forward by BaseTransformer
+        and passed to the hooks as `mask_info`, instead of analysing the mask again in every layer.
+        kind: 'full' (no masking needed), 'causal' (key j visible to query i iff j <= i + sk - sq),
+            'causal_prefix' (causal, and the first prefix_length keys visible to all), 'padding' ([b, 1, 1, sk]),
+            or 'arbitrary'.
+        binary: all values are 0 or 1, then masking is a masked_fill with `masked_out` (True = masked, cached).
+        Attention functions must check `mask_info.mask is attention_mask`, a mixin might have changed the mask.
+        attention_paths: {layer_id: path} of the transformer running the forward (set by BaseTransformer),
+            the last path taken by sdpa_attention per layer, to log only the changes.
+    '''
+    def __init__(self, mask):
+        self.mask = mask
+        self.prefix_length = 0
+        self.attention_paths = None
+        self._masked_out, self._biases = None, {}
+        if mask is None:
+            self.kind, self.binary = 'full', True
+            return
+        valid = mask if mask.dtype == torch.bool else mask > 0
+        self.binary = mask.dtype == torch.bool or bool(((mask == 0) | (mask == 1)).all())
+        sq, sk = mask.shape[-2:]
+        if valid.all():
+            # non-binary masks with more than one row still scale the scores in standard_attention
+            self.kind = 'full' if self.binary or sq == 1 else 'arbitrary'
+        elif not self.binary:
+            self.kind = 'arbitrary'
+        elif sq == 1:
+            self.kind = 'padding'
+        else:
+            causal = torch.ones(sq, sk, dtype=torch.bool, device=mask.device).tril_(sk - sq)
+            if bool((valid == causal).all()):
+                self.kind = 'causal'
+            else:
+                visible = valid.reshape(-1, sq, sk).all(dim=1).all(dim=0) # [sk], visible to all the queries
+                prefix_length = int(visible.int().cumprod(dim=0).sum())
+                prefix = torch.arange(sk, device=mask.device) < prefix_length
+                if prefix_length > 0 and bool((valid == (causal | prefix)).all()):
+                    self.kind, self.prefix_length = 'causal_prefix', prefix_length
+                else:
+                    self.kind = 'arbitrary'
+        if self.binary and self.kind != 'full':
+            self._masked_out = ~valid
+
+    @classmethod
+    def known(cls, mask, kind, prefix_length=0):
+        '''a binary mask of a known kind, without analysing it (no device sync, no data-dependent branch).'''
+        info = cls(None)
+        info.mask, info.kind, info.prefix_length = mask, kind, prefix_length
+        if kind != 'full':
+            info._masked_out = ~mask if mask.dtype == torch.bool else mask <= 0
+        return info
+
+    @property
+    def masked_out(self):
+        return self._masked_out
+
+    def bias(self, dtype):
+        '''additive mask (0 or -10000) of a binary mask, cached per dtype.'''
+        if dtype not in self._biases:
+            self._biases[dtype] = torch.zeros(self.mask.shape, dtype=dtype, device=self.mask.device).masked_fill_(self._masked_out, -10000.0)
+        return self._biases[dtype]
+
+def apply_attention_mask(attention_scores, attention_mask, mask_info=None):
+    '''masking of standard_attention, skipped or done by masked_fill if mask_info (MaskInfo of attention_mask) allows.'''
+    if mask_info is None or mask_info.mask is not attention_mask:
+        if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
+            # if auto-regressive, skip
+            attention_scores = torch.mul(attention_scores, attention_mask) - \
+                               10000.0 * (1.0 - attention_mask)
+        return attention_scores
+    if mask_info.kind == 'full':
+        return attention_scores
+    if mask_info.binary:
+        return attention_scores.masked_fill(mask_info.masked_out, -10000.0)
+    return torch.mul(attention_scores, attention_mask) - 10000.0 * (1.0 - attention_mask)
+
 def standard_attention(query_layer, key_layer, value_layer, attention_mask,
                        attention_dropout=None, log_attention_weights=None, scaling_attention_score=True, **kwargs):
     # We disable the PB-relax-Attention and only changes the order of computation, because it is enough for most of training. 
@@ -33,10 +117,7 @@ def standard_attention(query_layer, key_layer, value_layer, attention_mask,
     if log_attention_weights is not None:
         attention_scores += log_attention_weights
 
-    if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
-        # if auto-regressive, skip
-        attention_scores = torch.mul(attention_scores, attention_mask) - \
-                           10000.0 * (1.0 - attention_mask)
+    attention_scores = apply_attention_mask(attention_scores, attention_mask, kwargs.get('mask_info'))
 
     attention_probs = F.softmax(attention_scores, dim=-1)
 
@@ -50,6 +131,145 @@ def standard_attention(query_layer, key_layer, value_layer, attention_mask,
     context_layer = torch.matmul(attention_probs, value_layer)
     return context_layer
 
+def chunked_attention(query_layer, key_layer, value_layer, attention_mask,
+                      attention_dropout=None, log_attention_weights=None, scaling_attention_score=True,
+                      chunk_size=1024, is_causal=False, **kwargs):
+    '''Same as standard_attention, but keys are processed in chunks with an online softmax,
+        so only [b, h, sq, chunk_size] scores are alive at a time (flash-attention style, in pure pytorch).
+        attention_mask: float (1 = attend) or bool (True = attend) mask, sliced per chunk, never expanded.
+        is_causal: derive the causal mask from the positions instead, the last query attends all the keys.
+    '''
+    mask_info = kwargs.get('mask_info')
+    if mask_info is not None and mask_info.mask is attention_mask and mask_info.kind in ('full', 'causal'):
+        attention_mask, is_causal = None, is_causal or mask_info.kind == 'causal'
+    if scaling_attention_score:
+        query_layer = query_layer / math.sqrt(query_layer.shape[-1])
+    sq, sk = query_layer.shape[-2], key_layer.shape[-2]
+    if attention_mask is not None and attention_mask.shape[-2] == 1 and attention_mask.dtype != torch.bool \
+            and (attention_mask > 0).all():
+        attention_mask = None # full attention, as the skip in standard_attention
+    if is_causal:
+        query_positions = torch.arange(sk - sq, sk, device=query_layer.device)[:, None]
+
+    max_score = torch.full(query_layer.shape[:-1] + (1,), -float('inf'), device=query_layer.device, dtype=torch.float)
+    normalizer = torch.zeros_like(max_score)
+    context_layer = torch.zeros(query_layer.shape[:-1] + (value_layer.shape[-1],), device=query_layer.device, dtype=torch.float)
+    for start in range(0, sk, chunk_size):
+        end = min(start + chunk_size, sk)
+        scores = torch.matmul(query_layer, key_layer[..., start:end, :].transpose(-1, -2)).float()
+        if log_attention_weights is not None:
+            bias = log_attention_weights if log_attention_weights.shape[-1] == 1 else log_attention_weights[..., start:end]
+            scores = scores + bias
+        if attention_mask is not None:
+            mask = attention_mask if attention_mask.shape[-1] == 1 else attention_mask[..., start:end]
+            if mask.dtype == torch.bool:
+                scores = scores.masked_fill(~mask, -10000.0)
+            else:
+                scores = torch.mul(scores, mask) - 10000.0 * (1.0 - mask)
+        if is_causal:
+            scores = scores.masked_fill(torch.arange(start, end, device=scores.device) > query_positions, -10000.0)
+
+        new_max_score = torch.maximum(max_score, scores.max(dim=-1, keepdim=True)[0])
+        probs = torch.exp(scores - new_max_score)
+        correction = torch.exp(max_score - new_max_score)
+        normalizer = normalizer * correction + probs.sum(dim=-1, keepdim=True)
+        if attention_dropout is not None: # dropout(p / l) == dropout(p) / l
+            if mpu.get_cuda_rng_tracker is not None:
+                with mpu.get_cuda_rng_tracker().fork():
+                    probs = attention_dropout(probs)
+            else:
+                probs = attention_dropout(probs)
+        context_layer = context_layer * correction + torch.matmul(probs.type_as(value_layer), value_layer[..., start:end, :]).float()
+        max_score = new_max_score
+    return (context_layer / normalizer).type_as(value_layer)
+
+def varlen_attention(query_layer, key_layer, value_layer, attention_mask,
+                     attention_dropout=None, log_attention_weights=None, scaling_attention_score=True,
+                     cu_seqlens=None, is_causal=True, **kwargs):
+    '''Attention within the documents of packed sequences, as flash-attention's varlen kernels, in pure pytorch.
+        The b rows of length l are flattened into b * l tokens, and cu_seqlens [num_docs + 1] (list or int tensor)
+        are the boundaries of the documents (padding included), e.g. from sat.data_utils.PackingCollator.
+        Each document is attended separately, so the cross-document scores are never computed.
+        attention_mask is ignored. Only for full sequences (no mems), log_attention_weights are not supported.
+    '''
+    assert log_attention_weights is None, 'log_attention_weights is not supported by varlen_attention.'
+    b, nh, l, hn = query_layer.shape
+    assert key_layer.shape[-2] == l, 'varlen_attention does not support mems.'
+    if isinstance(cu_seqlens, torch.Tensor):
+        cu_seqlens = cu_seqlens.tolist()
+    assert cu_seqlens[0] == 0 and cu_seqlens[-1] == b * l, 'cu_seqlens must cover all the tokens.'
+    # [b, nh, l, hn] -> [nh, b * l, hn]
+    q, k, v = [x.transpose(0, 1).reshape(nh, b * l, -1) for x in (query_layer, key_layer, value_layer)]
+    context_layer = torch.empty_like(v)
+    use_sdpa = scaling_attention_score and hasattr(F, 'scaled_dot_product_attention')
+    dropout_p = attention_dropout.p if attention_dropout is not None else 0.
+    for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+        if start == end:
+            continue
+        if use_sdpa:
+            if dropout_p > 0 and mpu.get_cuda_rng_tracker is not None:
+                with mpu.get_cuda_rng_tracker().fork():
+                    out = F.scaled_dot_product_attention(q[:, start:end], k[:, start:end], v[:, start:end], None, dropout_p, is_causal)
+            else:
+                out = F.scaled_dot_product_attention(q[:, start:end], k[:, start:end], v[:, start:end], None, dropout_p, is_causal)
+        else:
+            mask = torch.ones(end - start, end - start, device=q.device, dtype=q.dtype)
+            if is_causal:
+                mask.tril_()
+            out = standard_attention(q[:, start:end], k[:, start:end], v[:, start:end], mask, attention_dropout,
+                                     scaling_attention_score=scaling_attention_score)
+        context_layer[:, start:end] = out
+    return context_layer.view(nh, b, l, -1).transpose(0, 1)
+
+logger = logging.getLogger(__name__)
+
+def _log_attention_path(mask_info, layer_id, path):
+    if is_compiling() or mask_info is None or mask_info.attention_paths is None or layer_id is None:
+        return
+    layer_id = int(layer_id)
+    if mask_info.attention_paths.get(layer_id) != path:
+        mask_info.attention_paths[layer_id] = path
+        logger.info(f'attention of layer {layer_id}: {path}')
+
+def sdpa_attention(query_layer, key_layer, value_layer, attention_mask,
+                   attention_dropout=None, log_attention_weights=None, scaling_attention_score=True, **kwargs):
+    '''Same as standard_attention, computed by torch's fused F.scaled_dot_product_attention when possible.
+        Falls back to standard_attention with log_attention_weights, without score scaling, or without torch>=2.0.
+        The float mask (1 = attend) is turned into an additive -10000 bias (a bool mask means True = attend),
+        so it must be binary, unlike the multiplicative masking of standard_attention.
+        Collected by BaseModel when all the attention_fn hooks are the default one or marked by @sdpa_compatible.
+    '''
+    layer_id, mask_info = kwargs.get('layer_id'), kwargs.get('mask_info')
+    if log_attention_weights is not None or not scaling_attention_score or not hasattr(F, 'scaled_dot_product_attention'):
+        _log_attention_path(mask_info, layer_id, 'standard')
+        return standard_attention(query_layer, key_layer, value_layer, attention_mask, attention_dropout,
+                                  log_attention_weights, scaling_attention_score, **kwargs)
+    is_causal = False
+    if mask_info is not None and mask_info.mask is attention_mask:
+        if not mask_info.binary and mask_info.kind != 'full':
+            _log_attention_path(mask_info, layer_id, 'standard')
+            return standard_attention(query_layer, key_layer, value_layer, attention_mask, attention_dropout, **kwargs)
+        attn_mask = None if mask_info.kind == 'full' else mask_info.bias(query_layer.dtype)
+        if mask_info.kind == 'causal' and query_layer.shape[-2] == key_layer.shape[-2]:
+            attn_mask, is_causal = None, True
+    elif attention_mask is None or (attention_mask.dtype != torch.bool and attention_mask.shape[-2] == 1
+                                    and (attention_mask > 0).all()):
+        attn_mask = None # full attention, as the skip in standard_attention
+    elif attention_mask.dtype == torch.bool:
+        attn_mask = torch.zeros(attention_mask.shape, dtype=query_layer.dtype, device=query_layer.device)
+        attn_mask.masked_fill_(~attention_mask, -10000.0)
+    else:
+        # an additive bias instead of a bool mask, fully masked rows (e.g. padding) stay finite as in standard_attention.
+        attn_mask = ((attention_mask - 1.0) * 10000.0).to(query_layer.dtype)
+    dropout_p = attention_dropout.p if attention_dropout is not None else 0.
+    if dropout_p > 0 and mpu.get_cuda_rng_tracker is not None:
+        with mpu.get_cuda_rng_tracker().fork():
+            context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask, dropout_p, is_causal)
+    else:
+        context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask, dropout_p, is_causal)
+    _log_attention_path(mask_info, layer_id, 'sdpa')
+    return context_layer
+
 def attention_forward_default(self, hidden_states, mask, **kw_args):
     self = self.transformer.layers[kw_args['layer_id']].attention
     attention_fn = standard_attention
@@ -85,14 +305,22 @@ def cross_attention_forward_default(self, hidden_states, cross_attention_mask, e
         attention_fn = self.hooks['attention_fn']
 
     mixed_query_layer = self.query(hidden_states)
-    mixed_x_layer = self.key_value(encoder_outputs)
-    (mixed_key_layer, mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
-
     dropout_fn = self.attention_dropout if self.training else None
     # Reshape and transpose [b, np, s, hn]
     query_layer = self._transpose_for_scores(mixed_query_layer)
-    key_layer = self._transpose_for_scores(mixed_key_layer)
-    value_layer = self._transpose_for_scores(mixed_value_layer)
+
+    # the encoder outputs are fixed during decoding, project them once per layer with a CrossAttentionKVCache.
+    cross_kv_cache = kw_args.get('cross_kv_cache', None)
+    layer_id = int(kw_args['layer_id'])
+    if cross_kv_cache is not None and layer_id in cross_kv_cache:
+        key_layer, value_layer = cross_kv_cache[layer_id]
+    else:
+        mixed_x_layer = self.key_value(encoder_outputs)
+        (mixed_key_layer, mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
+        key_layer = self._transpose_for_scores(mixed_key_layer)
+        value_layer = self._transpose_for_scores(mixed_value_layer)
+        if cross_kv_cache is not None:
+            cross_kv_cache[layer_id] = (key_layer, value_layer)
 
     context_layer = attention_fn(query_layer, key_layer, value_layer, cross_attention_mask, dropout_fn, cross_attention=True, **kw_args)
     context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
@@ -182,3 +410,25 @@ HOOKS_DEFAULT = {
     'final_forward': final_forward_default,
     'layer_forward': layer_forward_default
 }
+
+class HookPlan(namedtuple('HookPlan', ['word_embedding_forward', 'position_embedding_forward', 'final_forward',
+                                         'layer_forward', 'default_position_embedding'])):
+    '''Immutable dispatch plan of the transformer-level hooks, built by BaseModel.collect_hooks_ when the mixins change.
+        Each hook is resolved once to a callable (the collected hook, or the default bound to `owner`),
+        so that BaseTransformer.forward neither looks up nor branches on the hooks dict per call.
+        The non_conflict chains are already flattened into single callables by collect_hooks_.
+        layer_forward is None if not hooked, then the layer modules are called.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, hooks, owner):
+        def resolve(name):
+            return hooks[name] if name in hooks else partial(HOOKS_DEFAULT[name], owner)
+        return cls(
+            word_embedding_forward=resolve('word_embedding_forward'),
+            position_embedding_forward=resolve('position_embedding_forward'),
+            final_forward=resolve('final_forward'),
+            layer_forward=hooks.get('layer_forward', None),
+            default_position_embedding='position_embedding_forward' not in hooks
+        )
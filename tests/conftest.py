@@ -0,0 +1,21 @@
+import os
+import pytest
+import torch
+
+@pytest.fixture(scope='session')
+def cpu_distributed():
+    # model-only mode assumes nccl, initialize a single-process gloo group for cpu tests instead.
+    if not torch.distributed.is_initialized():
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', '29533')
+        torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    from sat import mpu
+    if not mpu.model_parallel_is_initialized():
+        mpu.initialize_model_parallel(1)
+    yield
+
+@pytest.fixture
+def tiny_args(cpu_distributed):
+    from sat.model import BaseModel
+    return BaseModel.get_args(num_layers=2, vocab_size=100, hidden_size=32, num_attention_heads=4,
+                              max_sequence_length=64, hidden_dropout=0., attention_dropout=0.)
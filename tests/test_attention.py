@@ -0,0 +1,98 @@
+import torch
+from sat.transformer_defaults import standard_attention, chunked_attention, sdpa_attention
+
+def _qkv(b=2, h=3, sq=10, sk=10, d=8):
+    return torch.randn(b, h, sq, d), torch.randn(b, h, sk, d), torch.randn(b, h, sk, d)
+
+def test_chunked_attention_parity():
+    torch.manual_seed(0)
+    q, k, v = _qkv()
+    causal = torch.ones(1, 1, 10, 10).tril_()
+    padding = (torch.rand(2, 1, 1, 10) > 0.3).float()
+    bias = torch.randn(2, 3, 10, 10)
+    for chunk_size in (1, 3, 16):
+        for mask in (causal, padding, torch.ones(1, 1)):
+            expected = standard_attention(q, k, v, mask)
+            assert torch.allclose(chunked_attention(q, k, v, mask, chunk_size=chunk_size), expected, atol=1e-5)
+            assert torch.allclose(chunked_attention(q, k, v, mask > 0, chunk_size=chunk_size), expected, atol=1e-5)
+        expected = standard_attention(q, k, v, causal, log_attention_weights=bias)
+        assert torch.allclose(chunked_attention(q, k, v, causal, log_attention_weights=bias, chunk_size=chunk_size), expected, atol=1e-5)
+        # causal without a dense mask, also for the incremental (sq < sk) case
+        assert torch.allclose(chunked_attention(q, k, v, None, chunk_size=chunk_size, is_causal=True), standard_attention(q, k, v, causal), atol=1e-5)
+        expected = standard_attention(q[:, :, -2:], k, v, causal[..., -2:, :])
+        assert torch.allclose(chunked_attention(q[:, :, -2:], k, v, None, chunk_size=chunk_size, is_causal=True), expected, atol=1e-5)
+
+def test_chunked_attention_mixin_generation(tiny_args):
+    from sat.model import BaseModel, CachedAutoregressiveModel
+    from sat.model.mixins import ChunkedAttentionMixin, CachedAutoregressiveMixin
+    from sat.generation.autoregressive_sampling import filling_sequence
+    from sat.generation.sampling_strategies import BaseStrategy
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    chunked = BaseModel(tiny_args, transformer=model.transformer)
+    chunked.add_mixin('chunked-attention', ChunkedAttentionMixin(chunk_size=3))
+    chunked.add_mixin('auto-regressive', CachedAutoregressiveMixin())
+    seq = torch.tensor([5, 6, 7, 8, 9, 10, 11] + [-1] * 8)
+    with torch.no_grad():
+        expected, _ = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1))
+        output, _ = filling_sequence(chunked, seq, 2, strategy=BaseStrategy(top_k=1))
+    assert torch.equal(output, expected)
+
+def test_sdpa_attention(tiny_args):
+    from sat.model import BaseModel, CachedAutoregressiveModel
+    from sat.model.mixins import ChunkedAttentionMixin
+    torch.manual_seed(0)
+    q, k, v = _qkv()
+    causal = torch.ones(1, 1, 10, 10).tril_()
+    padding = (torch.rand(2, 1, 1, 10) > 0.3).float()
+    for mask in (causal, padding, torch.ones(1, 1)):
+        assert torch.allclose(sdpa_attention(q, k, v, mask), standard_attention(q, k, v, mask), atol=1e-5)
+        assert torch.allclose(sdpa_attention(q, k, v, mask > 0), standard_attention(q, k, v, mask), atol=1e-5)
+
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    assert model.hook_origins['attention_fn'] == 'auto-regressive -> default' # opt-in
+    model.use_sdpa = True
+    model.collect_hooks_()
+    assert model.hook_origins['attention_fn'] == 'auto-regressive -> sdpa'
+    reference = BaseModel(tiny_args, transformer=model.transformer)
+    reference.use_sdpa = False
+    reference.collect_hooks_()
+    assert 'attention_fn' not in reference.hooks
+    chunked = BaseModel(tiny_args, transformer=model.transformer)
+    chunked.add_mixin('chunked-attention', ChunkedAttentionMixin())
+    assert chunked.hook_origins['attention_fn'] == 'chunked-attention' # not compatible, keeps its own
+    tokens = torch.randint(100, (2, 10))
+    position_ids = torch.arange(10).expand(2, -1)
+    with torch.no_grad():
+        logits, *_ = model(tokens, position_ids, causal)
+        expected, *_ = reference(tokens, position_ids, causal)
+    assert torch.allclose(logits, expected, atol=1e-4)
+    # the paths are logged per transformer, by int layer ids
+    assert model.transformer.attention_paths == {0: 'sdpa', 1: 'sdpa'}
+    assert CachedAutoregressiveModel(tiny_args).transformer.attention_paths == {}
+
+def test_mask_info():
+    from sat.transformer_defaults import MaskInfo
+    torch.manual_seed(0)
+    causal = torch.ones(1, 1, 10, 10).tril_()
+    prefix = causal.clone()
+    prefix[..., :4] = 1
+    padding = torch.ones(2, 1, 1, 10)
+    padding[0, ..., 7:] = 0
+    arbitrary = (torch.rand(2, 1, 10, 10) > 0.5).float()
+    soft = torch.full((1, 1, 10, 10), 0.5)
+    cases = [(torch.ones(1, 1), 'full'), (causal, 'causal'), (causal[..., 6:, :], 'causal'), (prefix, 'causal_prefix'),
+             (padding, 'padding'), (arbitrary, 'arbitrary'), (soft, 'arbitrary'), (causal > 0, 'causal')]
+    q, k, v = _qkv()
+    for mask, kind in cases:
+        info = MaskInfo(mask)
+        assert info.kind == kind, (kind, info.kind)
+        if mask.dtype == torch.bool:
+            continue
+        sq = mask.shape[-2] if mask.dim() == 4 else 10
+        expected = standard_attention(q[:, :, -sq:], k, v, mask)
+        assert torch.allclose(standard_attention(q[:, :, -sq:], k, v, mask, mask_info=info), expected, atol=1e-5)
+        assert torch.allclose(chunked_attention(q[:, :, -sq:], k, v, mask, chunk_size=3, mask_info=info), expected, atol=1e-5)
+        if info.binary:
+            assert torch.allclose(sdpa_attention(q[:, :, -sq:], k, v, mask, mask_info=info), expected, atol=1e-5)
+    assert MaskInfo(prefix).prefix_length == 4
@@ -35,6 +35,28 @@ def test_auto_init_model_only():
 
     
     
+def test_hook_plan(tiny_args):
+    import copy
+    from sat.model import CachedAutoregressiveModel
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    plain = BaseModel(tiny_args, transformer=model.transformer).eval()
+    plain.use_sdpa = False
+    plain.collect_hooks_()
+    tokens, position_ids = torch.randint(100, (1, 6)), torch.arange(6)[None]
+    mask = torch.ones(1, 1, 6, 6).tril_()
+    with torch.no_grad():
+        _, *outputs = model(tokens, position_ids, mask)
+        assert 'mem_kv' in outputs[0]
+        _, *outputs = plain(tokens, position_ids, mask) # the shared transformer switches to the plain hooks
+        assert 'mem_kv' not in outputs[0] and 'attention_fn' not in model.transformer.hooks
+        plan = model.hook_plan
+        model.del_mixin('auto-regressive') # the plan is rebuilt with the mixins
+        assert model.hook_plan is not plan
+        _, *outputs = model(tokens, position_ids, mask)
+        assert 'mem_kv' not in outputs[0]
+        copy.deepcopy(model)(tokens, position_ids, mask)
+
 if __name__ == '__main__':
     from argparse import Namespace, ArgumentParser
     from sat.arguments import _simple_init, get_args
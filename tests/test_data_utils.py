@@ -0,0 +1,203 @@
+import torch
+from sat.data_utils import PackingCollator, packing_efficiency
+
+def test_packing_collator(tiny_args):
+    from sat.model import BaseModel
+    from sat.model.mixins import PackedAttentionMixin
+    torch.manual_seed(0)
+    samples = [{'input_ids': torch.randint(1, 100, (n,)).tolist()} for n in (9, 5, 12, 3, 7)]
+    samples[1]['labels'] = [-100] * 3 + samples[1]['input_ids'][3:]
+    batch = PackingCollator(16)(samples)
+    # 36 tokens in 3 rows: [12, 3], [9, 7], [5]
+    assert batch['input_ids'].shape == (3, 16) and packing_efficiency(batch) == 36 / 48
+    assert batch['position_ids'][0].tolist() == list(range(12)) + list(range(3)) + [0]
+    # the labels are shifted within the documents
+    row, start = 1, 9
+    assert batch['labels'][row, :start].tolist() == samples[0]['input_ids'][1:] + [-100]
+    assert batch['loss_mask'].sum() == 36 - 5 - 2 and batch['labels'][2, 5:].eq(-100).all()
+
+    model = BaseModel(tiny_args).eval()
+    packed_cu = PackingCollator(16, use_cu_seqlens=True)(samples)
+    assert packed_cu['cu_seqlens'].tolist() == [0, 12, 15, 16, 25, 32, 37, 48]
+    with torch.no_grad():
+        logits, *_ = model(batch['input_ids'], batch['position_ids'], batch['attention_mask'])
+        model.add_mixin('packed', PackedAttentionMixin())
+        logits_cu, *_ = model(packed_cu['input_ids'], packed_cu['position_ids'], packed_cu['attention_mask'],
+                              cu_seqlens=packed_cu['cu_seqlens'])
+        for i, s in enumerate(samples):
+            n = len(s['input_ids'])
+            expected, *_ = model(torch.tensor([s['input_ids']]), torch.arange(n)[None], torch.ones(1, 1, n, n).tril_())
+            for output in (logits, logits_cu):
+                assert torch.allclose(output[batch['document_ids'] == i], expected[0], atol=1e-5)
+
+def test_token_budget_batch_sampler(cpu_distributed):
+    from sat.data_utils.samplers import TokenBudgetBatchSampler
+    lengths = torch.randint(1, 64, (1000,), generator=torch.Generator().manual_seed(0)).numpy()
+    samplers = [TokenBudgetBatchSampler(lengths, 256, rank=r, world_size=2, seed=1, num_epochs=2, bucket_size=200)
+                for r in range(2)]
+    plans = [list(s) for s in samplers]
+    assert len(plans[0]) == len(plans[1]) == len(samplers[0])
+    # within the budget, and each sample once per epoch over the ranks
+    first_epoch = samplers[0].num_steps(0)
+    seen = sorted(i for plan in plans for batch in plan[:first_epoch] for i in batch)
+    last_shape, drop_number = samplers[0].last_shape()
+    assert drop_number in (0, 1) and len(last_shape) == 2
+    if len(samplers[0].steps(0)[-1]) == 1: # the dummy batch of rank 1 repeats a sample
+        seen.remove(plans[1][first_epoch - 1][0])
+    assert seen == list(range(1000))
+    assert all(len(b) * lengths[b].max() <= 256 for plan in plans for b in plan)
+    # fewer, fuller batches than fixed-size batching of the same budget
+    assert len(plans[0]) * 2 < 2 * 1000 / (256 // 63)
+
+    # deterministic, and resumable
+    resumed = TokenBudgetBatchSampler(lengths, 256, rank=1, world_size=2, seed=1, num_epochs=2, bucket_size=200,
+                                      gradient_accumulation_steps=2)
+    resumed.start_iter = 5
+    assert list(resumed) == plans[1][10:]
+    assert list(resumed) == plans[1] # start_iter is only used once
+    # many epochs: the length does not plan every epoch, and the epochs run num_steps(0) steps each
+    many = TokenBudgetBatchSampler(lengths, 256, seed=1, num_epochs=500, bucket_size=200)
+    assert len(many) == 500 * many.num_steps(0) and list(many._num_steps) == [0]
+    many.num_epochs = 3
+    assert len(list(many)) == len(many)
+
+    # through make_data_loader, by the length index of the dataset
+    import argparse
+    from sat.data_utils.configure_data import make_data_loader
+    class Dataset(torch.utils.data.Dataset):
+        def __init__(self, lengths):
+            self.lengths = lengths
+        def __len__(self):
+            return len(self.lengths)
+        def __getitem__(self, index):
+            return torch.ones(self.lengths[index], dtype=torch.long)
+    collate = lambda samples: torch.nn.utils.rnn.pad_sequence(samples, batch_first=True)
+    args = argparse.Namespace(max_tokens=256, train_iters=10, epochs=None, eval_interval=5, eval_iters=3, strict_eval=True,
+                              seed=1, num_workers=0, gradient_accumulation_steps=1)
+    loader = make_data_loader(Dataset(lengths), 4, args, 'val', collate_fn=collate)
+    batches = list(loader)
+    assert all(b.numel() <= 256 for b in batches) and sum(len(b) for b in batches) == 1000
+    assert args.val_last_shape == [len(batches[-1])] and args.val_drop_number == 0
+
+def test_random_mapping_dataset():
+    import numpy as np
+    from sat.data_utils.configure_data import RandomMappingDataset
+    ds = RandomMappingDataset(list(range(1000)), scale=20, seed=3)
+    indices = np.arange(len(ds))
+    mapped = ds.map_index(indices)
+    assert [ds[i] for i in range(0, 20000, 97)] == mapped[::97].tolist()
+    assert ds.__getitems__([5, 17, 19999]) == [ds[5], ds[17], ds[19999]]
+    # roughly uniform, and the seed changes the mapping
+    counts = np.bincount(mapped, minlength=1000)
+    assert counts.min() > 0 and counts.max() < 50
+    assert (RandomMappingDataset(list(range(1000)), scale=20).map_index(indices) != mapped).mean() > 0.9
+
+def test_mmap_tsv_dataset(tmp_path):
+    import os
+    from sat.data_utils import TSVDataset, MMapTSVDataset
+    from sat.data_utils.datasets import build_line_offsets
+    path = str(tmp_path / 'data.tsv')
+    with open(path, 'wb') as f:
+        f.write('text\tlabel\n'.encode() + b''.join(f'sample {i} \xe4\xbd\xa0\t{i % 2}\n'.encode() for i in range(50))
+                + 'windows\t1\r\n\tlast\tno newline'.encode())
+    expected = TSVDataset(path, process_fn=tuple)
+    dataset = MMapTSVDataset(path, process_fn=tuple)
+    assert dataset.heads == expected.heads and len(dataset) == len(expected) == 52
+    assert [dataset[i] for i in range(len(dataset))] == [expected[i] for i in range(len(expected))]
+    assert os.path.exists(path + '.offsets.npy')
+    # the cached offsets, and the chunked parallel build
+    assert MMapTSVDataset(path, process_fn=tuple, with_heads=False)[0] == ('text', 'label\n')
+    assert (build_line_offsets(path, num_workers=2, chunk_size=64) == dataset.offsets).all()
+    assert MMapTSVDataset(path, process_fn=tuple)._mmap is None # the heads are read without the mmap
+    assert dataset[-1] == expected[-1]
+    for content in (b'', b'text\tlabel\n'): # empty, or only the heads
+        with open(path, 'wb') as f:
+            f.write(content)
+        expected, dataset = TSVDataset(path, process_fn=tuple), MMapTSVDataset(path, process_fn=tuple)
+        assert len(dataset) == len(expected) == 0 and dataset.heads == expected.heads
+
+def test_indexed_dataset(tmp_path, monkeypatch):
+    import json
+    import numpy as np
+    from sat.data_utils import IndexedDataset, IndexedDatasetBuilder, FixedWindowDataset
+    from sat.data_utils.preprocess_indexed import get_args, preprocess
+    from sat.tokenization import get_tokenizer
+    documents = [list(range(n)) for n in (5, 1, 12, 0, 7)]
+    builder = IndexedDatasetBuilder(str(tmp_path / 'docs'), dtype=np.uint16)
+    for doc in documents:
+        builder.add_document(doc)
+    builder.finalize()
+    dataset = IndexedDataset(str(tmp_path / 'docs'))
+    assert [d.tolist() for d in dataset] == documents and dataset.lengths.tolist() == [5, 1, 12, 0, 7]
+    assert dataset.get(2, offset=3, length=4).tolist() == [3, 4, 5, 6] and isinstance(dataset[2], np.memmap)
+
+    windows = FixedWindowDataset(dataset, seq_length=4, process_fn=lambda w, b: (w.tolist(), b.tolist()), with_boundaries=True)
+    stream = sum(documents, [])
+    assert len(windows) == (len(stream) - 1) // 4
+    for i in range(len(windows)):
+        assert windows[i][0] == stream[i * 4:i * 4 + 5]
+    assert windows[1] == ([4, 0, 0, 1, 2], [1, 2]) # documents 1 and 2 start in the window
+
+    class CharTokenizer:
+        eos_token_id = 0
+        def __len__(self):
+            return 256
+        def encode(self, text):
+            return [ord(c) for c in text]
+    # get_tokenizer keeps the tokenizer in its attributes, restored after the test
+    for name in ('tokenizer', 'tokenizer_type'):
+        monkeypatch.setattr(get_tokenizer, name, getattr(get_tokenizer, name, None), raising=False)
+    get_tokenizer(outer_tokenizer=CharTokenizer())
+    with open(tmp_path / 'raw.jsonl', 'w') as f:
+        for text in ('hello', 'sat', 'indexed', 'dataset'):
+            f.write(json.dumps({'text': text}) + '\n')
+    for workers in (1, 2):
+        args = get_args(['--input', str(tmp_path / 'raw.jsonl'), '--output-prefix', str(tmp_path / f'out{workers}' / 'corpus'),
+                         '--append-eos', '--shard-size', '3', '--workers', str(workers), '--tokenizer-type', 'outer_tokenizer'])
+        prefixes = preprocess(args)
+        assert len(prefixes) == 2
+        shards = [IndexedDataset(prefix) for prefix in prefixes]
+        assert shards[0].dtype == np.uint16 and shards[1][0].tolist() == [ord(c) for c in 'dataset'] + [0]
+        assert ''.join(chr(t) for t in shards[0].tokens if t) == 'hellosatindexed'
+
+def test_lmdb_dataset(tmp_path):
+    import pickle
+    import numpy as np
+    pytest = __import__('pytest')
+    pytest.importorskip('lmdb')
+    from sat.data_utils import LMDBDataset
+    from sat.data_utils.datasets import write_lmdb_dataset
+    rows = [np.arange(i, i + 8, dtype=np.int32) for i in range(30)]
+    for serialization in ('pickle', 'msgpack', 'numpy'):
+        path = str(tmp_path / serialization)
+        write_lmdb_dataset(path, [r.tolist() if serialization == 'msgpack' else r for r in rows], serialization, dtype=np.int32)
+        dataset = LMDBDataset(path, process_fn=np.asarray, serialization=serialization, dtype=np.int32)
+        assert len(dataset) == 30 and dataset._env is None # not opened before the workers
+        assert (dataset[11] == rows[11]).all()
+        batch = dataset.__getitems__([25, 3, 11, 3])
+        assert all((b == rows[i]).all() for b, i in zip(batch, [25, 3, 11, 3]))
+        dataset = pickle.loads(pickle.dumps(dataset))
+        assert (dataset[29] == rows[29]).all()
+    with pytest.raises(ValueError):
+        LMDBDataset(path, process_fn=np.asarray, serialization='numpy')
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=2)
+    assert torch.equal(torch.cat(list(loader)), torch.from_numpy(np.stack(rows)))
+    assert (dataset[0] == rows[0]).all() # still open in the main process
+
+def test_device_prefetcher():
+    from collections import namedtuple
+    from sat.data_utils import DevicePrefetcher
+    from sat.data_utils.prefetcher import to_device
+    from sat.training.utils import Timers
+    Pair = namedtuple('Pair', ['a', 'b'])
+    batch = {'x': torch.ones(2), 'y': [Pair(torch.zeros(1), 'text'), (torch.ones(3),)]}
+    moved = to_device(batch, 'cpu', non_blocking=True)
+    assert isinstance(moved['y'][0], Pair) and moved['y'][0].b == 'text' and torch.equal(moved['y'][1][0], torch.ones(3))
+
+    loader = torch.utils.data.DataLoader(list(range(10)), batch_size=3)
+    timers = Timers()
+    prefetcher = DevicePrefetcher(loader, num_batches=2, device='cpu', timers=timers)
+    assert len(prefetcher) == 4 and prefetcher.batch_sampler is loader.batch_sampler
+    for _ in range(2): # can be iterated again, as a DataLoader
+        assert [b.tolist() for b in prefetcher] == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert prefetcher.wait_time > 0 and timers('data loader').elapsed_ == prefetcher.wait_time
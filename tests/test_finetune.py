@@ -0,0 +1,79 @@
+import copy
+import torch
+from sat.model import BaseModel
+from sat.model.finetune import LoRAMixin, MultiLoRAMixin, merge_and_remove_lora
+
+def test_lora_merge(tiny_args, tmp_path):
+    from sat.training.model_io import save_checkpoint, load_checkpoint
+    torch.manual_seed(0)
+    model = BaseModel(tiny_args).eval()
+    base = copy.deepcopy(model.state_dict())
+    model.add_mixin('lora', LoRAMixin(32, layer_num=2, r=4, lora_alpha=8, layer_range=[1]))
+    model.eval() # the mixin is added in training mode
+    for p in model.mixins['lora'].parameters():
+        torch.nn.init.normal_(p, std=0.1)
+    tokens, position_ids = torch.randint(100, (2, 8)), torch.arange(8).expand(2, -1)
+    mask = torch.ones(1, 1, 8, 8).tril_()
+    with torch.no_grad():
+        expected, *_ = model(tokens, position_ids, mask)
+        lora = model.get_mixin('lora')
+        lora.merge_lora()
+        assert torch.allclose(model(tokens, position_ids, mask)[0], expected, atol=1e-4)
+        lora.unmerge_lora()
+        for k, v in base.items():
+            assert torch.allclose(model.state_dict()[k], v, atol=1e-6)
+
+        # export a merged checkpoint, loaded by a plain model
+        merge_and_remove_lora(model)
+        assert 'lora' not in model.mixins and model.hook_origins.get('attention_forward') is None
+        args = copy.deepcopy(tiny_args)
+        args.deepspeed, args.mode, args.save, args.tokenizer_type = False, 'inference', str(tmp_path), 'fake'
+        save_checkpoint(1, model, None, None, args)
+        loaded = BaseModel(tiny_args).eval()
+        load_checkpoint(loaded, args, load_path=str(tmp_path))
+        assert torch.allclose(loaded(tokens, position_ids, mask)[0], expected, atol=1e-4)
+
+def test_multi_lora(tiny_args):
+    torch.manual_seed(0)
+    model = BaseModel(tiny_args).eval()
+    loras, references = {}, {}
+    tokens, position_ids = torch.randint(100, (3, 8)), torch.arange(8).expand(3, -1)
+    mask = torch.ones(1, 1, 8, 8).tril_()
+    with torch.no_grad():
+        references[None], *_ = model(tokens, position_ids, mask)
+        for name, r, layer_range in (('a', 4, [0, 1]), ('b', 2, [1]), ('c', 4, [0])):
+            single = copy.deepcopy(model)
+            single.add_mixin('lora', LoRAMixin(32, layer_num=2, r=r, lora_alpha=4, layer_range=layer_range))
+            single.eval()
+            for p in single.mixins['lora'].parameters():
+                torch.nn.init.normal_(p, std=0.1)
+            loras[name] = single.get_mixin('lora')
+            references[name], *_ = single(tokens, position_ids, mask)
+
+        model.add_mixin('multi-lora', MultiLoRAMixin(32, layer_num=2, r=4, max_adapters=2))
+        model.eval()
+        multi = model.get_mixin('multi-lora')
+        multi.load_adapter('a', loras['a'])
+        multi.load_adapter('b', loras['b'])
+        hooks = model.hooks
+        def check(names):
+            output, *_ = model(tokens, position_ids, mask, adapter_ids=multi.adapter_ids(names))
+            for i, name in enumerate(names):
+                assert torch.allclose(output[i], references[name][i], atol=1e-5), name
+        check(['a', None, 'b'])
+        assert torch.allclose(model(tokens, position_ids, mask)[0], references[None], atol=1e-5)
+
+        # swap adapters in place
+        multi.unload_adapter('a')
+        multi.load_adapter('c', loras['c'])
+        assert multi.adapters == {'c': 0, 'b': 1} and model.hooks is hooks
+        check(['b', 'c', None])
+
+    # the bank is allocated in params_dtype, and cast once to the model dtype at load_adapter
+    half = BaseModel(tiny_args).half()
+    half.add_mixin('multi-lora', MultiLoRAMixin(32, layer_num=2, r=4, max_adapters=2, params_dtype=torch.half))
+    assert half.get_mixin('multi-lora').lora_A.dtype == torch.half
+    model.half().get_mixin('multi-lora').float()
+    multi.unload_adapter('b')
+    multi.load_adapter('a', loras['a'])
+    assert multi.lora_A.dtype == multi.lora_B.dtype == torch.half
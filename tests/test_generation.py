@@ -0,0 +1,471 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from sat.model import CachedAutoregressiveModel
+from sat.model.cached_autoregressive_model import StaticKVCache
+from sat.generation.autoregressive_sampling import filling_sequence
+from sat.generation.sampling_strategies import BaseStrategy, BeamSearchStrategy
+
+def test_static_kv_cache_matches_dense(tiny_args):
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    seq = torch.tensor([5, 6, 7, 8] + [-1] * 12)
+    with torch.no_grad():
+        dense, _ = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1))
+        cache = StaticKVCache.from_model(model, 2, len(seq))
+        static, mems = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1), mems=cache)
+    assert torch.equal(dense, static)
+    assert mems is cache and cache.length == len(seq) - 1
+
+def test_static_kv_cache_beam_search(tiny_args):
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    seq = torch.tensor([5, 6, 7, 8] + [-1] * 6)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        dense, _ = filling_sequence(model, seq, 3, strategy=BeamSearchStrategy(3))
+        torch.manual_seed(1)
+        cache = StaticKVCache.from_model(model, 3, len(seq))
+        static, _ = filling_sequence(model, seq, 3, strategy=BeamSearchStrategy(3), mems=cache)
+        torch.manual_seed(1)
+        static_decode, _ = filling_sequence(model, seq, 3, strategy=BeamSearchStrategy(3), static_decode=True)
+    assert torch.equal(dense, static) and torch.equal(dense, static_decode)
+
+def test_static_decode_compiled(tiny_args):
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    seq = torch.tensor([5, 6, 7, 8] + [-1] * 8)
+    with torch.no_grad():
+        dense, _ = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1))
+        eager, cache = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1), static_decode=True)
+        compiled, _ = filling_sequence(model, seq, 2, strategy=BaseStrategy(top_k=1), static_decode=True,
+                                       compile_kwargs={'fullgraph': True, 'dynamic': False})
+        beams, _ = filling_sequence(model, seq, 3, strategy=BeamSearchStrategy(3), static_decode=True)
+        dense_beams, _ = filling_sequence(model, seq, 3, strategy=BeamSearchStrategy(3))
+    assert torch.equal(dense, eager) and torch.equal(eager, compiled)
+    assert torch.equal(beams, dense_beams)
+    assert cache.length == len(seq) - 1
+
+def test_static_decode_kw_args_and_compiled_reuse(tiny_args):
+    from sat.model.base_model import BaseMixin
+    from sat.transformer_defaults import final_forward_default
+    class LogitBiasMixin(BaseMixin):
+        def final_forward(self, logits, logit_bias=None, **kw_args):
+            logits = final_forward_default(self, logits, **kw_args)
+            return logits if logit_bias is None else logits + logit_bias
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    model.add_mixin('logit_bias', LogitBiasMixin())
+    seq = torch.tensor([5, 6, 7, 8] + [-1] * 6)
+    bias = torch.zeros(100)
+    bias[42] = 1e4
+    with torch.no_grad():
+        dense, _ = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1), logit_bias=bias)
+        static, cache = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1), static_decode=True, logit_bias=bias)
+        assert torch.equal(dense, static) and (static[0, 4:] == 42).all()
+        cache.reset()
+        filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1), static_decode=True, mems=cache, compile_kwargs={'dynamic': False})
+        compiled_step = next(iter(cache.compiled_steps.values()))
+        cache.reset()
+        again, _ = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1), static_decode=True, mems=cache, compile_kwargs={'dynamic': False})
+    assert len(cache.compiled_steps) == 1 and next(iter(cache.compiled_steps.values())) is compiled_step
+    assert torch.equal(again[:, :4], seq[None, :4])
+
+def test_generation_engine_matches_filling_sequence(tiny_args):
+    from sat.generation.engine import GenerationEngine
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    prompts = [[5, 6, 7, 8], [9, 10], [11, 12, 13], [14], [15, 16, 17, 18, 19]]
+    max_new_tokens = [6, 3, 8, 5, 4]
+    engine = GenerationEngine(model, max_batch_size=2, max_length=32)
+    ids = [engine.add_request(p, n) for p, n in zip(prompts, max_new_tokens)]
+    results = engine.run()
+    assert len(results) == len(prompts)
+    for rid, p, n in zip(ids, prompts, max_new_tokens):
+        seq = torch.tensor(p + [-1] * n)
+        with torch.no_grad():
+            expected, _ = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1))
+        assert results[rid].output == expected[0, len(p):].tolist()
+    stats = engine.stats()
+    assert stats['generated_tokens'] == sum(max_new_tokens)
+    assert stats['tokens_per_sec'] > 0
+
+def test_paged_kv_cache_copy_on_write(tiny_args):
+    from sat.model.cached_autoregressive_model import PagedKVCache
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    seq = torch.tensor([5, 6, 7, 8, 9] + [-1] * 10)
+    with torch.no_grad():
+        dense, _ = filling_sequence(model, seq, 3, strategy=BaseStrategy(top_k=1))
+        cache = PagedKVCache.from_model(model, num_blocks=16, block_size=4)
+        paged, _ = filling_sequence(model, seq, 3, strategy=BaseStrategy(top_k=1), mems=cache)
+    assert torch.equal(dense, paged)
+    # the first full prompt block is shared by all the rows
+    assert len(set(cache.block_tables[s][0] for s in cache.batch)) == 1
+    for seq_id in cache.batch:
+        cache.free_sequence(seq_id)
+    assert cache.num_free_blocks == 16
+
+def test_generation_engine_paged(tiny_args):
+    from sat.generation.engine import GenerationEngine
+    from sat.model.cached_autoregressive_model import PagedKVCache
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    prompts = [[5, 6, 7, 8], [9, 10], [11, 12, 13], [14], [15, 16, 17, 18, 19]]
+    dense = GenerationEngine(model, max_batch_size=4, max_length=32)
+    paged = GenerationEngine(model, max_batch_size=4, max_length=24, paged_cache=PagedKVCache.from_model(model, num_blocks=6, block_size=4))
+    for p in prompts:
+        dense.add_request(p, 6)
+        paged.add_request(p, 6)
+    expected, results = dense.run(), paged.run()
+    assert all(results[i].output == expected[i].output for i in expected)
+    assert paged.paged_cache.num_free_blocks == 6
+    # a short prompt prefilled next to a long one is right-padded, the padded blocks are reserved too
+    paged = GenerationEngine(model, max_batch_size=4, max_length=20, paged_cache=PagedKVCache.from_model(model, num_blocks=5, block_size=4))
+    paged.add_request(list(range(5, 17)), 1)
+    paged.add_request([9], 3)
+    results = paged.run()
+    assert len(results) == 2 and paged.paged_cache.num_free_blocks == 5
+    # requests that can never fit the pool are rejected, instead of blocking the queue forever
+    with pytest.raises(ValueError):
+        GenerationEngine(model, max_length=32, paged_cache=PagedKVCache.from_model(model, num_blocks=5, block_size=4))
+    paged.paged_cache.num_blocks = 4 # bypass the check of __init__, add_request checks too
+    with pytest.raises(ValueError):
+        paged.add_request(list(range(5, 17)), 5)
+    assert not paged.has_unfinished()
+
+def _reference_beam_search(logits_fn, tokens, num_beams, end_tokens, steps):
+    # the per-candidate python loop of the previous implementation, with topk candidates
+    import torch.nn.functional as F
+    scores = torch.full((num_beams,), -float('inf'))
+    scores[0] = 0
+    end_beams = []
+    for _ in range(steps):
+        logits = logits_fn(tokens)
+        vocab_size = logits.shape[-1]
+        next_scores = (F.log_softmax(logits, dim=-1) + scores[:, None]).view(-1)
+        next_scores, candidates = torch.topk(next_scores, (max(1, len(end_tokens)) + 1) * num_beams)
+        beams, scores_continue = [], []
+        for score, cand in zip(next_scores.tolist(), candidates.tolist()):
+            beam = torch.cat((tokens[cand // vocab_size], torch.tensor([cand % vocab_size])))
+            if cand % vocab_size in end_tokens:
+                end_beams.append((score / ((5. + len(beam)) / 6), beam.tolist()))
+            elif len(beams) < num_beams:
+                beams.append(beam)
+                scores_continue.append(score)
+            else:
+                break
+        tokens, scores = torch.stack(beams), torch.tensor(scores_continue)
+    return tokens, sorted(end_beams, key=lambda x: -x[0])[:num_beams]
+
+# the previous (single prompt, per-candidate loop) BeamSearchStrategy, verbatim
+class _LegacyBeamSearchStrategy:
+    def __init__(self, num_beams, length_penalty=1., consider_end=False,
+                end_tokens=[], invalid_slices=[], no_repeat_ngram_size=0, min_tgt_length=0):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.end_tokens = end_tokens
+        self.ngram = no_repeat_ngram_size
+        self.min_tgt_length = min_tgt_length
+        self.invalid_slices = invalid_slices
+        self.consider_end = consider_end
+        self._init_cache()
+
+    def _init_cache(self):
+        self.end_beams = [] # list of LongTensors
+        self.end_beams_penalized_scores = [] # list of LongTensors
+        self.cached_beam_scores = 0 # [batch_size]
+        self.cached_beam_ngram_bans = [{} for i in range(self.num_beams)]
+        self.is_done = False
+    
+    def _add_end_beams(self, score, beam):
+        score = score / ((5. + len(beam)) / 6) ** self.length_penalty # Magic number for OpenNMT 
+        for i in range(len(self.end_beams), -1, -1):
+            if i == 0 or score < self.end_beams_penalized_scores[i-1]:
+                break
+        self.end_beams.insert(i, beam)
+        self.end_beams_penalized_scores.insert(i, score)
+
+        self.end_beams = self.end_beams[:self.num_beams]
+        self.end_beams_penalized_scores = self.end_beams_penalized_scores[:self.num_beams]
+
+    def forward(self, logits, tokens, mems):
+        batch_size, vocab_size = logits.shape
+        seq_len = tokens.shape[-1]
+        logits = logits.float()
+        for invalid_slice in self.invalid_slices:
+            logits[..., invalid_slice] = -65504
+        if self.min_tgt_length > seq_len:
+            for end_token in self.end_tokens:
+                logits[..., end_token] = -65504
+        if self.ngram > 0 and seq_len > self.ngram:
+            for i in range(batch_size):
+                ngram_prefix = tokens[i, -(self.ngram-1):].tolist() # TODO ngram=1
+                for banned_index in self.cached_beam_ngram_bans[i].get(tuple(ngram_prefix), []):
+                    logits[i, banned_index] = -65504
+        
+        next_token_scores = F.log_softmax(logits, dim=-1) # [batch_size, vocab_size]
+        prev_scores = self.cached_beam_scores
+        if isinstance(self.cached_beam_scores, torch.Tensor):
+            prev_scores = prev_scores[:, None].expand_as(next_token_scores)
+        next_token_scores = next_token_scores + prev_scores
+        
+        next_token_scores = next_token_scores.view(batch_size * vocab_size)
+
+        probs = F.softmax(next_token_scores, dim=0)
+        next_tokens = torch.multinomial(probs, 
+            num_samples=(max(1,len(self.end_tokens))+1) * self.num_beams) # [2*nb]
+        next_token_scores = next_token_scores[next_tokens]
+        next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=0)
+        next_tokens = next_tokens[_indices]
+
+        next_indices = torch.div(next_tokens, vocab_size, rounding_mode='trunc')
+        next_tokens = next_tokens % vocab_size
+
+        # select out end beams or continue beams
+        if mems.shape[1] < batch_size:
+            mems = mems.expand(-1, batch_size, -1, -1)
+        beam_continue = []
+        scores_continue = []
+        bans_continue = []
+        mems_contiue = []
+        for i in range(len(next_tokens)):
+            beam = torch.cat((tokens[next_indices[i]], next_tokens[i:i+1]))
+            if int(next_tokens[i]) in self.end_tokens:
+                self._add_end_beams(next_token_scores[i], beam)
+            elif len(beam_continue) < self.num_beams:
+                beam_continue.append(beam)
+                mems_contiue.append(mems[:, next_indices[i]])
+                # update caches
+                scores_continue.append(next_token_scores[i])
+                if self.ngram > 0:
+                    bans = self.cached_beam_ngram_bans[next_indices[i]].copy()
+                    ngram_prefix = tuple(tokens[next_indices[i], -(self.ngram-1):].tolist()) # TODO ngram=1
+                    bans[ngram_prefix] = bans.get(ngram_prefix, tuple()) + (next_tokens[i],)
+                    bans_continue.append(bans)
+            else:
+                break
+        tokens = torch.stack(beam_continue)
+        mems = torch.stack(mems_contiue, dim=1)
+        self.cached_beam_scores = torch.tensor(scores_continue, device=logits.device)
+        self.cached_beam_ngram_bans = bans_continue
+
+        # TODO is_done
+        return tokens, mems
+
+    def finalize(self, tokens, mems):
+        if self.consider_end:
+            for i in range(tokens.shape[0]):
+                self._add_end_beams(self.cached_beam_scores[i], tokens[i])
+            mems = None
+            ret = self.end_beams
+        else:
+            ret = tokens
+        self._init_cache()
+        return ret, mems
+
+def test_beam_search_matches_legacy():
+    torch.manual_seed(0)
+    vocab_size, num_beams = 12, 3
+    table = torch.randn(vocab_size, vocab_size) * 3
+    logits_fn = lambda tokens: table[tokens[:, -1]]
+    as_mems = lambda tokens: tokens.float()[None, :, :, None] # to check the reordering of mems
+    legacy = _LegacyBeamSearchStrategy(num_beams, end_tokens=[0, 7], consider_end=True)
+    strategy = BeamSearchStrategy(num_beams, end_tokens=[0, 7], consider_end=True, sample_candidates=True)
+    # the legacy one starts from the prompt row, the batched one from num_beams copies of it
+    legacy_tokens = torch.tensor([[1, 2]])
+    tokens = legacy_tokens.expand(num_beams, -1)
+    for step in range(6):
+        torch.manual_seed(step)
+        legacy_tokens, legacy_mems = legacy.forward(logits_fn(legacy_tokens), legacy_tokens, as_mems(legacy_tokens))
+        torch.manual_seed(step)
+        tokens, mems = strategy.forward(logits_fn(tokens), tokens, as_mems(tokens))
+        assert torch.equal(tokens, legacy_tokens) and torch.equal(mems, legacy_mems)
+        assert torch.allclose(strategy.cached_beam_scores, legacy.cached_beam_scores)
+    legacy_end_beams, _ = legacy.finalize(legacy_tokens, legacy_mems)
+    end_beams, _ = strategy.finalize(tokens, mems)
+    assert [b.tolist() for b in end_beams] == [b.tolist() for b in legacy_end_beams]
+
+def test_beam_search_small_vocab():
+    # fewer finite candidates than (len(end_tokens) + 1) * num_beams at the first step
+    logits = torch.randn(1, 3).expand(2, -1)
+    for sample_candidates in (False, True):
+        strategy = BeamSearchStrategy(2, end_tokens=[2], sample_candidates=sample_candidates)
+        tokens, _ = strategy.forward(logits, torch.ones(2, 2, dtype=torch.long), None)
+        assert torch.isfinite(strategy.cached_beam_scores).all() and sorted(tokens[:, -1].tolist()) == [0, 1]
+        assert all(score > -float('inf') for score in strategy.end_beams_penalized_scores[0])
+
+def test_beam_search_batched_parity():
+    torch.manual_seed(0)
+    vocab_size, num_beams, steps = 12, 3, 5
+    table = torch.randn(vocab_size, vocab_size) * 3
+    logits_fn = lambda tokens: table[tokens[:, -1]]
+    prompts = [torch.tensor([1, 2]), torch.tensor([4, 5])]
+    strategy = BeamSearchStrategy(num_beams, end_tokens=[0, 7], consider_end=True)
+    tokens = torch.cat([p.expand(num_beams, -1) for p in prompts])
+    for _ in range(steps):
+        tokens, _ = strategy.forward(logits_fn(tokens), tokens, None)
+    batched_tokens = tokens
+    end_beams = [[b.tolist() for b in beams] for beams in strategy.end_beams]
+    strategy.finalize(tokens, None)
+    for i, p in enumerate(prompts):
+        ref_tokens, ref_end = _reference_beam_search(logits_fn, p.expand(num_beams, -1), num_beams, [0, 7], steps)
+        assert torch.equal(batched_tokens[i * num_beams: (i + 1) * num_beams], ref_tokens)
+        assert end_beams[i] == [b for _, b in ref_end]
+
+def test_ngram_banned_mask():
+    from sat.generation.sampling_strategies.base_strategy import ngram_banned_mask
+    torch.manual_seed(0)
+    tokens = torch.randint(0, 4, (8, 30))
+    for n in (1, 2, 3):
+        for start in (0, 10):
+            mask = ngram_banned_mask(tokens, n, 4, start=start)
+            for i in range(tokens.shape[0]):
+                row = tokens[i].tolist()
+                prefix = tuple(row[len(row)-n+1:]) if n > 1 else ()
+                expected = {row[j+n-1] for j in range(len(row)-n+1) if j+n-1 >= start and tuple(row[j:j+n-1]) == prefix}
+                assert set(mask[i].nonzero().view(-1).tolist()) == expected
+
+def test_top_k_logits_batched():
+    import torch.nn.functional as F
+    from sat.generation.sampling_strategies.base_strategy import top_k_logits
+    torch.manual_seed(0)
+    logits = torch.randn(6, 50) * 3
+    top_k = torch.tensor([0, 5, 0, 10, 3, 0])
+    top_p = torch.tensor([0.9, 0., 0.5, 0.8, 0., 0.])
+    min_p = torch.tensor([0., 0., 0., 0., 0., 0.2])
+    filtered = top_k_logits(logits.clone(), top_k, top_p, min_p=min_p)
+    for i in range(6):
+        row = logits[i].clone()
+        if top_k[i] > 0:
+            row[row < torch.topk(row, int(top_k[i]))[0][-1]] = -65504
+        sorted_logits, sorted_indices = torch.sort(row, descending=True)
+        probs = F.softmax(sorted_logits, dim=-1)
+        keep = torch.ones_like(row, dtype=torch.bool)
+        if top_p[i] > 0:
+            keep &= torch.cumsum(probs, dim=-1) - probs <= top_p[i]
+        keep &= probs >= min_p[i] * probs[0]
+        expected = set(sorted_indices[keep].tolist()) - set((row == -65504).nonzero().view(-1).tolist())
+        assert set((filtered[i] > -65504).nonzero().view(-1).tolist()) == expected
+    # scalar top_p now works for batches
+    assert top_k_logits(logits.clone(), 0, 0.5).shape == logits.shape
+
+def test_batched_sampling_strategy_done():
+    from sat.generation.sampling_strategies import BatchedSamplingStrategy
+    strategy = BatchedSamplingStrategy(temperature=torch.tensor([0., 0., 1.]), top_k=torch.tensor([0, 0, 1]), end_tokens=[3])
+    logits = torch.full((3, 5), -10.)
+    logits[0, 3] = logits[1, 1] = logits[2, 3] = 10.
+    tokens = torch.zeros(3, 2, dtype=torch.long)
+    tokens, _ = strategy.forward(logits, tokens, None)
+    assert tokens[:, -1].tolist() == [3, 1, 3] and strategy.done.tolist() == [True, False, True]
+    logits[0, 3], logits[0, 2] = -10., 10.
+    tokens, _ = strategy.forward(logits, tokens, None)
+    assert tokens[:, -1].tolist() == [3, 1, 3] and not strategy.is_done
+    logits[1, 3] = 20.
+    tokens, _ = strategy.forward(logits, tokens, None)
+    assert strategy.is_done
+
+def test_batched_sampling_strategy_filling_sequence(tiny_args):
+    from sat.generation.sampling_strategies import BatchedSamplingStrategy
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    seq = torch.tensor([5, 6, 5, 6] + [-1] * 8)
+    strategy = BatchedSamplingStrategy(temperature=0., repetition_penalty=1.2, no_repeat_ngram_size=2)
+    with torch.no_grad():
+        tokens, _ = filling_sequence(model, seq, 3, strategy=strategy)
+    assert tokens.shape == (3, len(seq))
+    # greedy rows agree, and no generated 2-gram repeats
+    assert torch.equal(tokens[0], tokens[1]) and torch.equal(tokens[0], tokens[2])
+    ngrams = [tuple(tokens[0, i:i+2].tolist()) for i in range(len(seq) - 1)]
+    assert all(ngrams[i] not in ngrams[:i] for i in range(4, len(ngrams)))
+
+def test_speculative_filling_sequence(tiny_args):
+    from sat.generation.autoregressive_sampling import speculative_filling_sequence
+    torch.manual_seed(0)
+    target = CachedAutoregressiveModel(tiny_args).eval()
+    draft_args = type(tiny_args)(**vars(tiny_args))
+    draft_args.num_layers = 1
+    draft = CachedAutoregressiveModel(draft_args).eval()
+    seq = torch.tensor([5, 6, 7, 8] + [-1] * 14)
+    with torch.no_grad():
+        expected, _ = filling_sequence(target, seq, 1, strategy=BaseStrategy(top_k=1))
+        for k in (1, 3, 5):
+            output, stats = speculative_filling_sequence(target, draft, seq, k=k, temperature=0)
+            assert torch.equal(output, expected)
+            assert stats['target_forwards'] < len(seq) - 4 or k == 1
+        output, stats = speculative_filling_sequence(target, target, seq, k=4, temperature=0)
+        assert torch.equal(output, expected) and stats['acceptance_rate'] == 1.
+        output, stats = speculative_filling_sequence(target, draft, seq, k=4, temperature=1.)
+        assert output.shape == expected.shape and 0 <= stats['acceptance_rate'] <= 1
+    # a larger draft vocabulary is masked to the target's
+    draft_args.vocab_size = 300
+    draft = CachedAutoregressiveModel(draft_args).eval()
+    with torch.no_grad():
+        output, _ = speculative_filling_sequence(target, draft, seq, k=3, temperature=0)
+        assert torch.equal(output, expected)
+        for _ in range(3):
+            output, _ = speculative_filling_sequence(target, draft, seq, k=3, temperature=1.)
+            assert output.shape == expected.shape and (output < 100).all()
+
+def test_prefix_cache(tiny_args):
+    from sat.generation.prefix_cache import PrefixCache
+    torch.manual_seed(0)
+    model = CachedAutoregressiveModel(tiny_args).eval()
+    system = list(range(10, 30))
+    cache = PrefixCache(max_bytes=1 << 20, block_size=4)
+    with torch.no_grad():
+        for user in ([40, 41, 42], [50, 51]):
+            seq = torch.tensor(system + user + [-1] * 6)
+            expected, _ = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1))
+            output, _ = filling_sequence(model, seq, 1, strategy=BaseStrategy(top_k=1), prefix_cache=cache)
+            assert torch.equal(output, expected)
+        # the second request reuses the system prompt
+        assert cache.hits == 1 and cache.hit_tokens == 20
+        # the whole last conversation is cached (block-aligned), a follow-up only forwards the rest
+        length, mems = cache.get(expected[0].tolist() + [60, 61])
+        assert length == 24 and mems.shape[2] == 24
+    small = PrefixCache(max_bytes=2 * (2 * 8 * 64 * 4), block_size=4) # two entries
+    for i in range(4):
+        small.put(torch.arange(i * 100, i * 100 + 8), torch.zeros(2, 1, 8, 64))
+    assert small.evictions == 2 and small.get(torch.arange(0, 8))[0] == 0 and small.get(torch.arange(300, 308))[0] == 8
+    # every block hash collides: the stored tokens tell the entries apart
+    colliding = PrefixCache(max_bytes=1 << 20, block_size=4)
+    def block_hashes(tokens, max_length=None):
+        tokens, keys = PrefixCache._block_hashes(colliding, tokens, max_length)
+        return tokens, [0] * len(keys)
+    colliding._block_hashes = block_hashes
+    colliding.put(torch.arange(8), torch.zeros(2, 1, 8, 64))
+    assert colliding.get(torch.arange(100, 108))[0] == 0
+    colliding.put(torch.arange(100, 108), torch.ones(2, 1, 8, 64))
+    assert len(colliding.entries) == 2
+    length, mems = colliding.get(torch.arange(10))
+    assert length == 8 and (mems == 0).all()
+    assert colliding.get(torch.tensor([0, 1, 2, 3, 9, 9, 9, 9]))[0] == 4
+
+def test_encoder_decoder_generate(tiny_args):
+    from sat.model import EncoderDecoderModel
+    from sat.model.cached_autoregressive_model import CrossAttentionKVCache
+    torch.manual_seed(0)
+    model = EncoderDecoderModel(tiny_args).eval()
+    enc_input_ids = torch.randint(1, 100, (1, 9))
+    calls = []
+    handle = model.decoder.transformer.layers[0].cross_attention.key_value.register_forward_hook(lambda *_: calls.append(1))
+    output, _ = model.generate(enc_input_ids, torch.tensor([1]), 6, BaseStrategy(top_k=1))
+    handle.remove()
+    assert len(calls) == 1 # projected once for all the steps
+    beams, _ = model.generate(enc_input_ids, torch.tensor([1]), 4, BeamSearchStrategy(2, consider_end=True), batch_size=2)
+    assert len(beams) == 2 and all(len(beam) == 5 for beam in beams)
+    # reference: re-run the whole decoder without any cache
+    tokens = torch.tensor([[1]])
+    with torch.no_grad():
+        encoder_outputs = model.encode(enc_input_ids, torch.arange(9)[None])
+        for _ in range(6):
+            logits, *_ = model.decode(tokens, torch.arange(tokens.shape[1])[None], None, encoder_outputs,
+                                      cross_attention_mask=torch.ones(1, 1, 1, 9))
+            tokens = torch.cat((tokens, logits[:, -1].argmax(dim=-1, keepdim=True)), dim=1)
+    assert torch.equal(output, tokens)
+
+    cache = CrossAttentionKVCache()
+    cache[0] = (torch.arange(3.).view(3, 1, 1, 1), torch.arange(3.).view(3, 1, 1, 1))
+    cache.reorder_(torch.tensor([2, 2, 0]))
+    assert cache[0][0].view(-1).tolist() == [2., 2., 0.]
@@ -0,0 +1,60 @@
+import copy
+import torch
+from sat.quantization import quantize, quantize_weight, dequantize_weight, QuantizedColumnParallelLinear
+
+def test_quantize_weight_error_bound():
+    torch.manual_seed(0)
+    weight = torch.randn(16, 64)
+    for bits in (8, 4):
+        for group_size in (None, 16):
+            qweight, scale = quantize_weight(weight, bits, group_size)
+            assert qweight.element_size() == 1 and qweight.shape[1] == (64 if bits == 8 else 32)
+            error = (dequantize_weight(qweight, scale, bits) - weight).abs().view(16, scale.shape[1], -1)
+            # round to nearest, at most half a step
+            assert (error <= scale[..., None] / 2 + 1e-6).all()
+    # smaller groups, smaller errors
+    errors = [(dequantize_weight(*quantize_weight(weight, 4, g), 4) - weight).abs().mean() for g in (None, 8)]
+    assert errors[1] < errors[0]
+
+def test_quantize_model(tiny_args, tmp_path):
+    from sat.model import BaseModel
+    from sat.training.model_io import save_checkpoint, load_checkpoint
+    torch.manual_seed(0)
+    model = BaseModel(tiny_args).eval()
+    tokens, position_ids = torch.randint(100, (2, 8)), torch.arange(8).expand(2, -1)
+    with torch.no_grad():
+        expected, *_ = model(tokens, position_ids, None)
+        quantized = quantize(copy.deepcopy(model), bits=8, group_size=8)
+        assert isinstance(quantized.transformer.layers[0].attention.query_key_value, QuantizedColumnParallelLinear)
+        assert not any('query_key_value.weight' in name for name, _ in quantized.named_parameters())
+        output, *_ = quantized(tokens, position_ids, None)
+        assert (output - expected).abs().max() < 0.02 * expected.abs().max()
+        int4, *_ = quantize(copy.deepcopy(model), bits=4, group_size=8)(tokens, position_ids, None)
+        assert (int4 - expected).abs().max() < 0.2 * expected.abs().max()
+
+        # save and load through model_io, the structure is quantized by the checkpoint
+        args = copy.deepcopy(tiny_args)
+        args.deepspeed, args.mode, args.save, args.tokenizer_type = False, 'inference', str(tmp_path), 'fake'
+        save_checkpoint(1, quantized, None, None, args)
+        loaded = BaseModel(tiny_args).eval()
+        load_checkpoint(loaded, args, load_path=str(tmp_path))
+        assert loaded.quantization == {'bits': 8, 'group_size': 8}
+        assert torch.equal(loaded(tokens, position_ids, None)[0], output)
+
+def test_cpu_inference(tiny_args):
+    from sat.model import BaseModel
+    from sat.quantization import prepare_cpu_inference, cpu_forward
+    torch.manual_seed(0)
+    model = BaseModel(tiny_args).eval()
+    tokens, position_ids = torch.randint(100, (2, 8)), torch.arange(8).expand(2, -1)
+    mask = torch.ones(1, 1, 8, 8)
+    with torch.no_grad():
+        expected, *_ = model(tokens, position_ids, mask)
+    converted = prepare_cpu_inference(copy.deepcopy(model), quantize=False)
+    from sat.mpu.layers import ColumnParallelLinear, RowParallelLinear
+    assert not any(isinstance(m, (ColumnParallelLinear, RowParallelLinear)) for m in converted.modules())
+    assert torch.allclose(cpu_forward(converted, tokens, position_ids, mask)[0], expected, atol=1e-5)
+    int8 = prepare_cpu_inference(copy.deepcopy(model))
+    assert isinstance(int8.transformer.layers[0].attention.query_key_value, torch.ao.nn.quantized.dynamic.Linear)
+    output, *_ = cpu_forward(int8, tokens, position_ids, mask)
+    assert output.is_inference() and (output - expected).abs().max() < 0.05 * expected.abs().max()